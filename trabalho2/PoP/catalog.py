@@ -0,0 +1,64 @@
+import threading
+import time
+
+
+def base_video(stream_key):
+    """The video a stream key (video or video@rendition) belongs to, as the origins advertise it."""
+    return stream_key.partition("@")[0]
+
+
+class CatalogIndex:
+    """Which origin has which video, learned from the video lists carried by the adverts.
+
+    Indexed both ways, origin -> videos and video -> origins, so each video can be routed
+    to the closest origin that actually has it. An origin whose adverts stop for timeout
+    seconds is dropped from the index.
+    """
+
+    def __init__(self, timeout=15):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.origin_videos = {}  # Origin id -> frozenset of its videos
+        self.video_origins = {}  # Video -> set of origin ids that have it
+        self.video_lists = {}  # Origin id -> the advertised video list, to skip unchanged ones
+        self.last_update = {}  # Origin id -> time of its last advert
+
+    def update(self, origin_id, video_list):
+        """Record the comma-separated video list advertised by an origin."""
+        with self.lock:
+            self.last_update[origin_id] = time.time()
+            if self.video_lists.get(origin_id) == video_list:
+                return
+            self.video_lists[origin_id] = video_list
+            self._remove(origin_id)
+            videos = frozenset(video for video in video_list.split(",") if video)
+            self.origin_videos[origin_id] = videos
+            for video in videos:
+                self.video_origins.setdefault(video, set()).add(origin_id)
+
+    def origins_for(self, stream_key):
+        """Ids of the live origins that have the video of a stream key."""
+        with self.lock:
+            self._expire()
+            return set(self.video_origins.get(base_video(stream_key), ()))
+
+    def videos(self):
+        """Every video available from some live origin, sorted."""
+        with self.lock:
+            self._expire()
+            return sorted(self.video_origins)
+
+    def _expire(self):
+        now = time.time()
+        for origin_id, updated in list(self.last_update.items()):
+            if now - updated > self.timeout:
+                del self.last_update[origin_id]
+                del self.video_lists[origin_id]
+                self._remove(origin_id)
+
+    def _remove(self, origin_id):
+        for video in self.origin_videos.pop(origin_id, ()):
+            origins = self.video_origins[video]
+            origins.discard(origin_id)
+            if not origins:
+                del self.video_origins[video]
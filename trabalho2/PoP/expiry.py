@@ -0,0 +1,44 @@
+import heapq
+import threading
+import time
+
+
+class ExpiryQueue:
+    """Deadlines of keys (client IPs) kept in a heap, so refreshing a key and finding the
+    expired ones cost O(log n) instead of a scan of every key.
+
+    Refreshing a key pushes a new entry and leaves the old one in the heap; stale entries
+    are skipped when they reach the top. Each key has at most timeout / refresh interval
+    entries, so the heap stays proportional to the number of keys.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.deadlines = {}  # Key -> current deadline
+        self.heap = []  # (deadline, key), possibly outdated
+
+    def touch(self, key, now=None):
+        deadline = (time.time() if now is None else now) + self.timeout
+        with self.lock:
+            self.deadlines[key] = deadline
+            heapq.heappush(self.heap, (deadline, key))
+
+    def discard(self, key):
+        with self.lock:
+            self.deadlines.pop(key, None)
+
+    def expired(self, now=None):
+        """Remove and return the keys whose deadline has passed."""
+        now = time.time() if now is None else now
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, key = heapq.heappop(self.heap)
+                if self.deadlines.get(key) == deadline:
+                    del self.deadlines[key]
+                    expired.append(key)
+        return expired
+
+    def __contains__(self, key):
+        return key in self.deadlines
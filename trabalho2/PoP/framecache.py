@@ -0,0 +1,101 @@
+import collections
+import time
+from packet import FLAG_PARITY, HEADER
+
+FRAME_CACHE_BYTES = 32 * 1024 * 1024  # Memory for cached packets, over all videos
+MAX_GOP_FRAMES = 30  # Frames cached per video, from the last full frame on
+FRAME_CACHE_AGE = 30  # Seconds after which the frames of a video that stopped are not served
+MAX_PENDING_FRAMES = 4  # Incomplete frames followed per video
+DELTA_MAGIC = b'DT'  # Delta frames start with it, full frames never do (see the server's delta.py)
+
+
+class FrameCache:
+    """The latest complete frames of every video, as the packets were received, for instant joins.
+
+    A video's cache starts at its last full frame and collects the delta frames that follow
+    it, so a new subscriber can decode it (without delta frames it is just the last frame).
+    Once a frame is lost nothing is cached until the next full frame.
+    Only the forwarding thread adds packets and calls join_packets(); frames() can be called
+    from any thread and returns an immutable tuple. When the cache is over max_bytes, the
+    videos updated least recently are evicted first.
+    """
+
+    def __init__(self, max_bytes=FRAME_CACHE_BYTES, max_frames=MAX_GOP_FRAMES, max_age=FRAME_CACHE_AGE):
+        self.max_bytes = max_bytes
+        self.max_frames = max_frames
+        self.max_age = max_age
+        self.published = {}  # Video id -> (time, tuple of packets), read by frames()
+        self.pending = {}  # Video id -> {frame seq: [packets, data packet indexes, packet count, full frame]}
+        self.gops = {}  # Video id -> list of (packets of a complete frame) since the last full frame
+        self.latest = {}  # Video id -> sequence number of the last complete frame
+        self.sizes = collections.OrderedDict()  # Video id -> cached bytes, least recently updated first
+        self.total = 0
+
+    def add(self, video_id, packet):
+        """Copy a forwarded packet, publishing its frame once every data packet is in."""
+        _, flags, _, frame_seq, _, packet_index, packet_count = HEADER.unpack_from(packet)[:7]
+        frames = self.pending.setdefault(video_id, {})
+        frame = frames.get(frame_seq)
+        if frame is None:
+            if len(frames) == MAX_PENDING_FRAMES:
+                del frames[min(frames)]  # Give up on the oldest incomplete frame
+            frame = frames[frame_seq] = [[], set(), packet_count, None]
+        frame[0].append(bytes(packet))
+        if not flags & FLAG_PARITY:
+            frame[1].add(packet_index)
+            if packet_index == 0:
+                frame[3] = packet[HEADER.size:HEADER.size + len(DELTA_MAGIC)] != DELTA_MAGIC
+
+        if len(frame[1]) == frame[2]:
+            for seq in [seq for seq in frames if seq <= frame_seq]:
+                del frames[seq]  # Older frames would be shown out of order
+            previous = self.latest.get(video_id)
+            self.latest[video_id] = frame_seq
+            self._complete(video_id, frame[0], frame[3], previous is not None and frame_seq == previous + 1)
+
+    def frames(self, video_id):
+        """Packets of the cached frames of a video, oldest first (empty if none or too old)."""
+        entry = self.published.get(video_id)
+        if entry is None or time.monotonic() - entry[0] > self.max_age:
+            return ()
+        return entry[1]
+
+    def join_packets(self, video_id):
+        """What a new subscriber needs before the live packets: the cached frames, then the packets
+        already forwarded of the frames still in progress (forwarding thread only)."""
+        packets = self.frames(video_id)
+        if not packets:
+            return ()
+        latest = self.latest.get(video_id, 0)
+        pending = self.pending.get(video_id, {})
+        return packets + tuple(packet for seq in sorted(pending) if seq > latest for packet in pending[seq][0])
+
+    def _complete(self, video_id, packets, full_frame, follows):
+        """Add a complete frame to the video's GOP; follows tells whether it comes right after
+        the previous complete frame, or frames in between were lost."""
+        gop = self.gops.get(video_id)
+        if full_frame:
+            gop = self.gops[video_id] = []
+        elif gop is None:
+            return  # A delta frame we can not serve without its full frame
+        elif not follows or len(gop) >= self.max_frames:
+            # A delta frame after a lost one can not be decoded from the cached frames, and
+            # without a frame the cached ones no longer lead up to the live stream, so there
+            # is nothing to serve until the next full frame
+            self._evict(video_id)
+            return
+        gop.append(packets)
+        published = tuple(packet for frame in gop for packet in frame)
+        self.published[video_id] = (time.monotonic(), published)
+
+        size = sum(len(packet) for packet in published)
+        self.total += size - self.sizes.pop(video_id, 0)
+        self.sizes[video_id] = size
+        while self.total > self.max_bytes and self.sizes:
+            self._evict(next(iter(self.sizes)))
+
+    def _evict(self, video_id):
+        """Drop the cached frames of a video; its frames in progress are kept."""
+        self.total -= self.sizes.pop(video_id, 0)
+        self.published.pop(video_id, None)
+        self.gops.pop(video_id, None)
@@ -1,105 +1,105 @@
 import time
 import threading
-import socket
+from advert import unpack_advert
+from catalog import CatalogIndex
+from probe import PROBE_PORT, Prober
+
+# Upstreams are ranked by a composite cost: the route latency in ms plus the load the origin
+# at the end of the route advertises, each figure weighted in ms per unit (egress in bytes/s,
+# deadline misses per advert interval). LatencyManager takes other weights as load_weights.
+LOAD_WEIGHTS = {"streams": 0.0, "subscribers": 0.5, "egress": 2 / 1_000_000, "deadline_misses": 1.0}
 
 class LatencyManager:
-    def __init__(self, timeout=15):
+    def __init__(self, timeout=15, load_weights=None):
         self.lock = threading.Lock()  # Ensure thread-safe access
-        self.server_latencies = {}  # Dictionary to store latencies for each server
-        self.last_update_time = {}  # Dictionary to store the last update time for each server
         self.timeout = timeout  # Timeout period in seconds
-        self.availableVideos = None
+        self.routes = {}  # (neighbour IP, origin id) -> (path cost in ms, time of the update)
+        self.catalog = CatalogIndex(timeout)  # Videos of each origin, origins of each video
+        self.origin_loads = {}  # Origin id -> OriginLoad from its latest advert
+        self.load_weights = dict(LOAD_WEIGHTS, **(load_weights or {}))
 
-    def update_latency(self, server_ip, latency, availableVideos):
-        """Update the latency for a given server."""
+    def update_latency(self, server_ip, latency, origin_id=0):
+        """Update the cost of the route to an origin through a given neighbour."""
         with self.lock:
-            self.server_latencies[server_ip] = latency
-            self.last_update_time[server_ip] = time.time()  # Record current time for last update
-            self.availableVideos = availableVideos
-            #print(f"Updated latency for {server_ip}: {latency:.2f} ms")
-
-    def delete_stale_servers(self):
-        """Remove servers that haven't updated latency within the timeout period."""
+            self.routes[(server_ip, origin_id)] = (latency, time.time())
+
+    def expire_routes(self):
+        """Drop the routes that were not advertised again within the timeout period (caller holds lock)."""
+        current_time = time.time()
+        for route, (_, updated) in list(self.routes.items()):
+            if current_time - updated > self.timeout:
+                print(f"Route to origin {route[1]} through {route[0]} expired.")
+                del self.routes[route]
+
+    def update_load(self, origin_id, load):
+        """Record the OriginLoad carried by an origin's latest advert."""
         with self.lock:
-            current_time = time.time()
-            for server_ip in list(self.server_latencies.keys()):
-                if current_time - self.last_update_time[server_ip] > self.timeout:
-                    print(f"Removing stale server {server_ip} due to timeout.")
-                    del self.server_latencies[server_ip]
-                    del self.last_update_time[server_ip]
-
-    def get_best_server(self):
-        """Get the best latency and its corresponding server IP."""
-        self.delete_stale_servers()  # Ensure stale servers are marked before selecting the best
+            self.origin_loads[origin_id] = load
+
+    def load_cost(self, origin_id):
+        """The load of an origin in ms of composite cost (caller holds lock)."""
+        load = self.origin_loads.get(origin_id)
+        if load is None:
+            return 0.0
+        return sum(weight * getattr(load, figure) for figure, weight in self.load_weights.items())
+
+    def video_costs(self, video_name, keep=None):
+        """Composite cost of the cheapest fresh route through each neighbour to an origin that has the video.
+
+        Routes to saturated origins are left out, except through keep (the neighbour the video
+        already comes from) or when every origin with the video is saturated.
+        """
+        origins = self.catalog.origins_for(video_name)
         with self.lock:
-            if not self.server_latencies:
-                return None, None, None
-            best_server = min(self.server_latencies, key=self.server_latencies.get)
-            return best_server, self.server_latencies[best_server], self.availableVideos
-
-
-    def print_latencies(self):
-        """Print the current latencies for all tracked servers."""
+            now = time.time()
+            costs, saturated_costs = {}, {}
+            for (neighbour, origin), (cost, updated) in self.routes.items():
+                if origin not in origins or now - updated > self.timeout:
+                    continue
+                load = self.origin_loads.get(origin)
+                candidates = saturated_costs if load and load.saturated and neighbour != keep else costs
+                cost += self.load_cost(origin)
+                if cost < candidates.get(neighbour, float('inf')):
+                    candidates[neighbour] = cost
+            return costs or saturated_costs
+
+    def best_latency(self):
+        """The cost of our cheapest fresh route to any origin and the videos of every live origin,
+        or (None, None) without routes."""
         with self.lock:
-            print("Current latencies for connected servers:")
-            for server, latency in self.server_latencies.items():
-                print(f"Server {server}: {latency:.2f} ms")
+            self.expire_routes()
+            if not self.routes:
+                return None, None
+            best_latency = min(cost for cost, _ in self.routes.values())
+        return best_latency, ",".join(self.catalog.videos())
+
 
 class LatencyHandler:
     def __init__(self, port, latency_manager):
         self.port = port
         self.latency_manager = latency_manager  # Reference to the LatencyManager instance
-
-    def start(self):
-        """Start the thread to receive timestamps."""
-        self.latency_thread = threading.Thread(target=self.receive_timestamps)
-        self.latency_thread.start()
-
-    def receive_timestamps(self):
-        """Listen for incoming timestamp messages containing latency and additional data from multiple servers."""
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind(('0.0.0.0', self.port))
-        server_socket.listen(5)
-
-        print(f"PoP listening for timestamp messages on port {self.port}...")
-
-        while True:
-            client_socket, addr = server_socket.accept()
-            #print(f"Connection established with {addr}")
-            client_socket.settimeout(5)  # Set timeout for receiving data
-
-            try:
-                # Receive the combined timestamp and additional data from the server
-                data = client_socket.recv(1024).decode()
-                if not data:
-                    client_socket.close()
-                    continue
-
-                # Parse the incoming data (format: "TIMESTAMP,video1,video2,...")
-                data_parts = data.split(',', 1)  # Split only once to separate timestamp from video list
-                if len(data_parts) < 2:
-                    print(f"Invalid data format received from {addr}: {data}")
-                    client_socket.close()
-                    continue
-
-                # Extract and parse timestamp and video list
-                sent_time = float(data_parts[0])
-                additional_data = data_parts[1]  # This part contains the video list
-                received_time = time.time()
-
-                # Calculate latency
-                latency = (received_time - sent_time) * 1000  # Convert to milliseconds
-                self.latency_manager.update_latency(addr[0], latency, additional_data)
-
-                # Close the connection after processing the data
-                client_socket.close()
-
-            except socket.timeout:
-                print(f"Connection with {addr} timed out. No data received.")
-                client_socket.close()
-            except ValueError:
-                print(f"Failed to parse timestamp from {addr}. Data received: {data}")
-                client_socket.close()
-            except Exception as e:
-                print(f"Error while receiving or processing timestamp from {addr}: {e}")
-                client_socket.close()
+        self.neighbours = set()  # Nodes that send us adverts, learned at runtime
+        self.prober = Prober(lambda: self.neighbours)  # RTT of the link to each of them
+
+    def start(self, control_plane):
+        """Serve adverts and link probes on the control plane."""
+        control_plane.add_channel(self.port, self.handle_adverts)
+        control_plane.add_datagram(PROBE_PORT, self.prober)
+
+    def handle_adverts(self, adverts, addr):
+        """Record the route cost and video list of adverts flooded by the origins."""
+        self.neighbours.add(addr[0])
+        for data in adverts:
+            advert = unpack_advert(data)
+            if advert is None:
+                print(f"Invalid advert received from {addr}")
+                continue
+            origin_id, _, _, path_cost, video_list, load = advert
+            self.latency_manager.catalog.update(origin_id, video_list)
+            self.latency_manager.update_load(origin_id, load)
+
+            # Route cost through this neighbour: its path cost plus the RTT of our link to it
+            link_cost = self.prober.link_cost(addr[0])
+            if link_cost is None or path_cost == float('inf'):
+                continue  # Not probed yet, or the neighbour has no route to the origin itself
+            self.latency_manager.update_latency(addr[0], path_cost + link_cost, origin_id)
@@ -2,9 +2,17 @@ from server import OverlayNode
 import sys
 
 def main():
+    # Optional number of forwarding processes (see forwardpool.py), for hosts with several cores
+    workers = 0
+    if "--workers" in sys.argv:
+        index = sys.argv.index("--workers")
+        if index + 1 >= len(sys.argv) or not sys.argv[index + 1].isdigit():
+            print("Usage: python3 main.py [--workers <N>]")
+            sys.exit(1)
+        workers = int(sys.argv[index + 1])
 
     #A porta 12346 vai ser sempre a porta da stream
-    server = OverlayNode(streaming_port=12346)
+    server = OverlayNode(streaming_port=12346,forwarding_workers=workers)
     server.start()
 
 if __name__ == "__main__":
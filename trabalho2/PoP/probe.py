@@ -0,0 +1,89 @@
+import asyncio
+import itertools
+import struct
+import time
+
+# Per-link round-trip time, measured with UDP echo probes. The prober stamps each request with
+# its own monotonic clock and the neighbour sends the datagram straight back, so the RTT only
+# ever compares two readings of the same clock: it is unaffected by clock skew between nodes.
+PROBE_PORT = 13338
+PROBE_VERSION = 1
+PROBE_REQUEST = 0
+PROBE_REPLY = 1
+PROBE = struct.Struct('>BBIQ')  # version, type, probe id, send time (monotonic nanoseconds)
+PROBE_INTERVAL = 1  # Seconds between probes to each neighbour
+LINK_TIMEOUT = 5  # Seconds without a reply before a link is considered down
+
+
+class LinkEstimator:
+    """Smoothed RTT and RTT variation (jitter) of one link, as in TCP's RTO estimator (RFC 6298)."""
+
+    def __init__(self, alpha=1 / 8, beta=1 / 4):
+        self.alpha = alpha
+        self.beta = beta
+        self.srtt = None  # Milliseconds
+        self.rttvar = None  # Milliseconds
+        self.last_reply = None  # Monotonic time of the last reply
+        self.sent = 0
+        self.replies = 0
+
+    def update(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self.last_reply = time.monotonic()
+        self.replies += 1
+
+    def cost(self):
+        """Link cost in milliseconds (smoothed RTT plus jitter), or None if the link is down."""
+        if self.last_reply is None or time.monotonic() - self.last_reply > LINK_TIMEOUT:
+            return None
+        return self.srtt + self.rttvar
+
+
+class Prober(asyncio.DatagramProtocol):
+    """Echo the probes of our neighbours and probe the links to the targets.
+
+    Serves PROBE_PORT on the control plane loop (see ControlPlane.add_datagram). targets
+    is a callable returning the IPs to probe, so the set can change at runtime; a node
+    that only answers probes passes None.
+    """
+
+    def __init__(self, targets=None, interval=PROBE_INTERVAL):
+        self.targets = targets
+        self.interval = interval
+        self.links = {}  # Neighbour IP -> LinkEstimator
+        self.ids = itertools.count()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.targets is not None:
+            asyncio.get_running_loop().create_task(self.send_probes())
+
+    def datagram_received(self, data, addr):
+        if len(data) != PROBE.size or data[0] != PROBE_VERSION:
+            return
+        _, kind, _, sent_ns = PROBE.unpack(data)
+        if kind == PROBE_REQUEST:
+            self.transport.sendto(data[:1] + bytes([PROBE_REPLY]) + data[2:], addr)
+        elif kind == PROBE_REPLY and addr[0] in self.links:
+            self.links[addr[0]].update((time.monotonic_ns() - sent_ns) / 1e6)
+
+    async def send_probes(self):
+        while True:
+            for ip in list(self.targets()):
+                self.links.setdefault(ip, LinkEstimator()).sent += 1
+                probe = PROBE.pack(PROBE_VERSION, PROBE_REQUEST, next(self.ids) & 0xFFFFFFFF, time.monotonic_ns())
+                try:
+                    self.transport.sendto(probe, (ip, PROBE_PORT))
+                except OSError as e:
+                    print(f"Failed to probe {ip}. Error: {e}")
+            await asyncio.sleep(self.interval)
+
+    def link_cost(self, ip):
+        link = self.links.get(ip)
+        return link.cost() if link else None
@@ -0,0 +1,44 @@
+import unittest
+from advert import ADVERT, ADVERT_VERSION, LOAD_SATURATED
+from latency import LatencyHandler, LatencyManager
+from probe import LinkEstimator
+
+NEIGHBOUR = ("10.0.0.1", 13334)
+
+
+def advert(origin_id, seq, cost, videos, saturated=False):
+    video_list = ",".join(videos).encode()
+    flags = LOAD_SATURATED if saturated else 0
+    return ADVERT.pack(ADVERT_VERSION, 1, origin_id, seq, cost, flags, 1, 2, 1000, 0, len(video_list)) + video_list
+
+
+class HandleAdvertsTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = LatencyManager()
+        self.handler = LatencyHandler(NEIGHBOUR[1], self.manager)
+
+    def probe(self, rtt):
+        self.handler.prober.links[NEIGHBOUR[0]] = LinkEstimator()
+        self.handler.prober.links[NEIGHBOUR[0]].update(rtt)
+
+    def test_catalog_is_learned_before_the_link_is_probed(self):
+        self.handler.handle_adverts([advert(7, 1, 10.0, ["videoA", "videoB"])], NEIGHBOUR)
+        self.assertEqual(self.manager.catalog.videos(), ["videoA", "videoB"])
+        self.assertEqual(self.manager.routes, {})
+
+    def test_catalog_is_learned_without_a_route_to_the_origin(self):
+        self.probe(4)
+        self.handler.handle_adverts([advert(7, 1, float('inf'), ["videoA"])], NEIGHBOUR)
+        self.assertEqual(self.manager.catalog.origins_for("videoA"), {7})
+        self.assertEqual(self.manager.routes, {})
+
+    def test_route_cost_adds_the_link_cost(self):
+        self.probe(4)  # Smoothed RTT 4 ms plus 2 ms of jitter
+        self.handler.handle_adverts([advert(7, 1, 10.0, ["videoA"], saturated=True)], NEIGHBOUR)
+        self.assertEqual(self.manager.routes[(NEIGHBOUR[0], 7)][0], 16.0)
+        self.assertTrue(self.manager.origin_loads[7].saturated)
+        self.assertEqual(self.manager.best_latency(), (16.0, "videoA"))
+
+
+if __name__ == "__main__":
+    unittest.main()
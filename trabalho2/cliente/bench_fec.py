@@ -0,0 +1,54 @@
+import random
+import sys
+from fec import FrameAssembler, protect
+from packet import max_payload_size
+
+# Frame delivery rate under emulated independent packet loss, with and without XOR FEC.
+# Usage: python3 bench_fec.py [--frames N] [--frame-size BYTES] [--chunk BYTES] [--group K]
+
+
+def parse_args():
+    options = {"--frames": 2000, "--frame-size": 60000, "--chunk": max_payload_size(), "--group": 4}
+    args = sys.argv[1:]
+    for flag in options:
+        if flag in args:
+            options[flag] = int(args[args.index(flag) + 1])
+    return options
+
+
+def delivery_rate(frames, frame_size, chunk_size, group_size, loss, rng):
+    """Fraction of frames that could be rebuilt when each packet is dropped with probability loss."""
+    payload = bytes(rng.getrandbits(8) for _ in range(frame_size))
+    chunks = [payload[offset:offset + chunk_size] for offset in range(0, frame_size, chunk_size)]
+    packets = protect(chunks, group_size)
+
+    delivered = 0
+    for _ in range(frames):
+        assembler = FrameAssembler(frame_size, len(chunks))
+        data = None
+        for is_parity, packet_index, chunk in packets:
+            if rng.random() >= loss:
+                data = assembler.add(is_parity, packet_index, group_size, chunk) or data
+        if data == payload:
+            delivered += 1
+    return delivered / frames, len(packets)
+
+
+def main():
+    options = parse_args()
+    rng = random.Random(1)
+    frames, frame_size, chunk_size, group_size = (
+        options["--frames"], options["--frame-size"], options["--chunk"], options["--group"]
+    )
+
+    print(f"{frames} frames of {frame_size} bytes in {chunk_size}-byte packets, FEC group size {group_size}")
+    print(f"{'loss':>6} {'no FEC':>8} {'FEC':>8}")
+    for loss in (0.0, 0.001, 0.005, 0.01, 0.02, 0.05):
+        plain, plain_packets = delivery_rate(frames, frame_size, chunk_size, 0, loss, rng)
+        protected, protected_packets = delivery_rate(frames, frame_size, chunk_size, group_size, loss, rng)
+        print(f"{loss:>6.1%} {plain:>8.1%} {protected:>8.1%}")
+    print(f"Overhead: {protected_packets - plain_packets} parity packets per {plain_packets} data packets")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import random
+import sys
+from fec import FrameAssembler, protect
+from packet import max_payload_size
+
+# Frame completion rate under emulated independent packet loss on each of two paths, receiving
+# the stream from one PoP or from two PoPs merged per packet slot (client --redundant).
+# Usage: python3 bench_redundancy.py [--frames N] [--frame-size BYTES] [--chunk BYTES] [--group K]
+
+
+def parse_args():
+    options = {"--frames": 2000, "--frame-size": 60000, "--chunk": max_payload_size(), "--group": 4}
+    args = sys.argv[1:]
+    for flag in options:
+        if flag in args:
+            options[flag] = int(args[args.index(flag) + 1])
+    return options
+
+
+def completion_rate(frames, frame_size, chunk_size, group_size, paths, loss, rng):
+    """Fraction of frames that could be rebuilt when every path drops each packet with probability loss."""
+    payload = bytes(rng.getrandbits(8) for _ in range(frame_size))
+    chunks = [payload[offset:offset + chunk_size] for offset in range(0, frame_size, chunk_size)]
+    packets = protect(chunks, group_size)
+
+    completed = 0
+    for _ in range(frames):
+        assembler = FrameAssembler(frame_size, len(chunks))
+        data = None
+        # The copies of a packet from every path go into the same slot, the first one to arrive wins
+        for is_parity, packet_index, chunk in packets:
+            for _ in range(paths):
+                if rng.random() >= loss:
+                    data = assembler.add(is_parity, packet_index, group_size, chunk) or data
+        if data == payload:
+            completed += 1
+    return completed / frames
+
+
+def main():
+    options = parse_args()
+    rng = random.Random(1)
+    frames, frame_size, chunk_size, group_size = (
+        options["--frames"], options["--frame-size"], options["--chunk"], options["--group"]
+    )
+
+    print(f"{frames} frames of {frame_size} bytes in {chunk_size}-byte packets, FEC group size {group_size}")
+    print(f"{'loss':>6} {'1 path':>8} {'2 paths':>8} {'1 + FEC':>8} {'2 + FEC':>8}")
+    for loss in (0.0, 0.01, 0.02, 0.05, 0.1, 0.2):
+        rates = [
+            completion_rate(frames, frame_size, chunk_size, fec_group, paths, loss, rng)
+            for fec_group in (0, group_size) for paths in (1, 2)
+        ]
+        print(f"{loss:>6.1%} " + " ".join(f"{rate:>8.1%}" for rate in rates))
+    print("Loss is per path and independent; two paths cost twice the downstream bandwidth")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,12 @@ import time
 import socket
 from latency import LatencyMonitor
 from stream_rcv import StreamReceiver
+from switching import SwitchPolicy
 from utils import get_and_choose_video
 
 class Client:
-    def __init__(self, ip_list, port=13333, stream_port=12346,heartbeat_port=22222):
+    def __init__(self, ip_list, port=13333, stream_port=12346,heartbeat_port=22222, rendition=None, make_before_break=True,
+                 redundant=False):
         self.port = port
         self.stream_port = stream_port
         self.heartbeat_port = heartbeat_port
@@ -14,9 +16,18 @@ class Client:
         self.monitors = []  # List to keep track of monitor threads
         self.ip_list = ip_list
         self.current_stream_ip = None
+        self.switch_policy = SwitchPolicy()  # Hysteresis for stream switches
+        self.make_before_break = make_before_break  # Subscribe to the new PoP before leaving the old one
+        # Redundant mode: also receive from the best other PoP and merge both streams per packet
+        self.redundant = redundant
+        self.backup_ip = None
+        self.backup_policy = SwitchPolicy()  # Hysteresis for the choice of the backup PoP
         self.lock = threading.Lock()
 
         self.wantedVideo = get_and_choose_video(ip_list,13335)
+        if rendition:
+            # Subscribe to a specific rendition of the video instead of the default encoding
+            self.wantedVideo = f"{self.wantedVideo}@{rendition}"
 
         self.start_monitoring()
         # Initialize a single StreamReceiver to receive data on stream_port
@@ -39,16 +50,17 @@ class Client:
         return True
                                 
     def send_heartbeat(self):
-        """Periodically send a 'heartbeat' message to the current server via UDP."""
+        """Periodically send a 'heartbeat' message to the servers we receive from via UDP."""
         while True:
-            if self.current_stream_ip:
+            # Both PoPs during a make-before-break switch
+            for server_ip in self.stream_receiver.sources():
                 try:
                     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as heartbeat_socket:
                         message = "HEARTBEAT"
-                        heartbeat_socket.sendto(message.encode(), (self.current_stream_ip, self.heartbeat_port))
-                        #print(f"Sent HEARTBEAT to {self.current_stream_ip}:{self.heartbeat_port} via UDP")
+                        heartbeat_socket.sendto(message.encode(), (server_ip, self.heartbeat_port))
+                        #print(f"Sent HEARTBEAT to {server_ip}:{self.heartbeat_port} via UDP")
                 except Exception as e:
-                    print(f"Failed to send 'HEARTBEAT' to {self.current_stream_ip} via UDP. Error: {e}")
+                    print(f"Failed to send 'HEARTBEAT' to {server_ip} via UDP. Error: {e}")
             time.sleep(2)  # Send heartbeat every 2 seconds
 
 
@@ -76,21 +88,51 @@ class Client:
             time.sleep(5)  # Wait 3 seconds to check latency updates
             
             with self.lock:
-                # Find the IP with the highest latency
-                best_ip = min(self.latency_dict, key=self.latency_dict.get, default=None)
-                if best_ip is None:
-                    continue
-                
-                best_latency = self.latency_dict[best_ip]
-                #print(f"Best available latency: {best_latency} ms from {best_ip}")
-
-                # Switch to the new stream if it's better than the current one
-                if self.current_stream_ip != best_ip:
+                # Only switch when another PoP is clearly and persistently better (see switching.py)
+                best_ip = self.switch_policy.choose(self.current_stream_ip, self.latency_dict)
+                if best_ip is not None:
                     print(f"Switching to the stream from {best_ip}")
                     self.switch_stream(best_ip)
+                if self.redundant:
+                    self.update_backup()
+
+    def update_backup(self):
+        """Keep the best PoP other than the current one streaming to us as a backup path."""
+        latencies = {ip: latency for ip, latency in self.latency_dict.items() if ip != self.current_stream_ip}
+        current_backup = self.backup_ip if self.backup_ip != self.current_stream_ip else None
+        backup_ip = self.backup_policy.choose(current_backup, latencies)
+        if backup_ip is None:
+            if current_backup is None and self.backup_ip:
+                self.backup_ip = None  # The backup became our primary and there is no other PoP
+                self.stream_receiver.set_backup_ip(None)
+            return
+
+        if current_backup:
+            self.send_stop_stream(current_backup)
+        self.backup_ip = backup_ip
+        self.send_start_stream(backup_ip)
+        self.stream_receiver.set_backup_ip(backup_ip)
 
     def switch_stream(self, new_ip):
-        """Stop the current stream and start a new one from the given IP."""
+        """Move the stream to the given IP, without a gap in make-before-break mode."""
+        if self.redundant and new_ip == self.backup_ip:
+            # The backup already streams to us: swap roles, update_backup then picks a new backup
+            self.backup_ip, self.current_stream_ip = self.current_stream_ip, new_ip
+            self.stream_receiver.set_target_ip(new_ip)
+            self.stream_receiver.set_backup_ip(self.backup_ip)
+            return
+
+        if self.make_before_break and self.current_stream_ip:
+            # Subscribe to the new server first; the receiver accepts both and releases the
+            # old one once the new one has delivered a complete frame
+            previous_pending = self.stream_receiver.pending_ip
+            self.send_start_stream(new_ip)
+            self.current_stream_ip = new_ip
+            self.stream_receiver.switch_to(new_ip, self.send_stop_stream)
+            if previous_pending and previous_pending != new_ip:
+                self.send_stop_stream(previous_pending)  # A switch that never completed
+            return
+
         # Stop the current stream from the previous server and notify the server to stop
         if self.current_stream_ip:
             self.send_stop_stream(self.current_stream_ip)
@@ -0,0 +1,72 @@
+# Forward error correction: after the data packets of a frame, the sender adds one XOR parity
+# packet per group of K consecutive data packets. The receiver can rebuild any single lost
+# packet of a group from the parity and the other members, without asking for a retransmission.
+#
+# Parity packets carry FLAG_PARITY, the group index as their packet index and K in the
+# FEC group size field of the stream header (see packet.py).
+
+
+def xor_parity(chunks):
+    """XOR of the chunks, each zero-padded on the right to the longest one."""
+    size = max(len(chunk) for chunk in chunks)
+    acc = 0
+    for chunk in chunks:
+        acc ^= int.from_bytes(chunk, 'big') << (8 * (size - len(chunk)))
+    return acc.to_bytes(size, 'big')
+
+
+def protect(chunks, group_size):
+    """Return (is_parity, packet_index, payload) triples: every data chunk followed by one parity per group."""
+    packets = [(False, packet_index, chunk) for packet_index, chunk in enumerate(chunks)]
+    if group_size:
+        for group, start in enumerate(range(0, len(chunks), group_size)):
+            packets.append((True, group, xor_parity(chunks[start:start + group_size])))
+    return packets
+
+
+class FrameAssembler:
+    """Collect the packets of one frame, repairing one lost packet per parity group."""
+
+    def __init__(self, frame_size, packet_count):
+        self.frame_size = frame_size
+        self.packet_count = packet_count
+        self.chunks = [None] * packet_count
+        self.received = 0
+        self.parities = {}  # Group index -> (group size, parity payload)
+        self.recovered = 0
+
+    def add(self, is_parity, packet_index, group_size, payload):
+        """Store a packet and return the whole frame once it can be rebuilt, else None."""
+        if is_parity:
+            self.parities[packet_index] = (group_size, bytes(payload))
+        elif packet_index < self.packet_count and self.chunks[packet_index] is None:
+            self.chunks[packet_index] = bytes(payload)
+            self.received += 1
+        return self.assemble()
+
+    def assemble(self):
+        if self.received < self.packet_count and self.parities:
+            self._recover()
+        if self.received < self.packet_count:
+            return None
+        data = b"".join(self.chunks)
+        return data if len(data) == self.frame_size else None
+
+    def _recover(self):
+        for group, (group_size, parity) in list(self.parities.items()):
+            start = group * group_size
+            members = range(start, min(start + group_size, self.packet_count))
+            missing = [packet_index for packet_index in members if self.chunks[packet_index] is None]
+            if len(missing) != 1:
+                continue
+
+            packet_index = missing[0]
+            others = [self.chunks[member] for member in members if member != packet_index]
+            payload = xor_parity([parity] + others)
+            # Every packet has the parity's length except the last one of the frame
+            if packet_index == self.packet_count - 1 and others:
+                payload = payload[:self.frame_size - packet_index * len(parity)]
+            self.chunks[packet_index] = payload
+            self.received += 1
+            self.recovered += 1
+            del self.parities[group]
@@ -0,0 +1,15 @@
+import struct
+
+# Receiver reports flow upstream over UDP, from clients to their PoP and from every overlay node
+# to its current upstream, until they reach the origin. Each node merges the reports of its
+# downstream receivers per video before forwarding them, so the origin sees one report per
+# neighbour instead of one per client.
+FEEDBACK_PORT = 13336
+FEEDBACK_INTERVAL = 2  # Seconds between reports
+FEEDBACK_VERSION = 1
+# version, video id, frames received, frames lost, frames late, jitter (ms), worst loss fraction, receivers
+FEEDBACK = struct.Struct('>BIIIIffH')
+
+
+def pack_report(video_id, received, lost, late, jitter, worst_loss, receivers=1):
+    return FEEDBACK.pack(FEEDBACK_VERSION, video_id, received, lost, late, jitter, worst_loss, receivers)
@@ -14,9 +14,25 @@ def main():
         print("No --ip flag provided.")
         sys.exit(1)
 
+    # When switching PoPs, --break-before-make leaves the old one before joining the new one
+    make_before_break = "--break-before-make" not in args
+
+    # With --redundant, the stream is received from the two best PoPs at once and merged
+    redundant = "--redundant" in args
+
+    # Optional rendition of the video configured on the server (e.g. --rendition low)
+    rendition = None
+    if "--rendition" in args:
+        rendition_index = args.index("--rendition") + 1
+        if rendition_index >= len(args) or args[rendition_index].startswith("--"):
+            print("No rendition name provided after --rendition.")
+            sys.exit(1)
+        rendition = args[rendition_index]
+
     if ip_list:
         # Start the client
-        client = Client(ip_list)
+        client = Client(ip_list, rendition=rendition, make_before_break=make_before_break,
+                        redundant=redundant)
     else:
         print("No IP addresses provided.")
         sys.exit(1)
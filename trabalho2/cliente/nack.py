@@ -0,0 +1,163 @@
+import struct
+from packet import FLAG_PARITY, HEADER
+
+# Hop-by-hop repair of lost stream packets. The origin and every overlay node keep the packets
+# they sent for a short while in a RetransmitBuffer. A receiver (overlay node or client) that
+# sees a gap in a frame sends a NACK to the hop the frame came from, which sends the missing
+# packets again to its stream port. An overlay node that lost the packets itself has seen the
+# same gap and asked its own upstream; the repair is then forwarded to its subscribers like
+# any other packet, so every loss is repaired by the nearest hop that still holds the packets.
+NACK_PORT = 13339
+NACK_VERSION = 1
+# version, video id, frame sequence number, number of packet indexes (none asks for the whole frame),
+# followed by the 2-byte indexes of the missing data packets
+NACK = struct.Struct('>BIIH')
+NACK_INDEX = struct.Struct('>H')
+MAX_NACK_INDEXES = 512
+
+
+REORDER_DELAY = 0.005  # Seconds a gap may stay open before it is NACKed, late packets fill it meanwhile
+NACK_RETRY = 0.03  # Seconds between NACKs for the same frame
+POLL_INTERVAL = 0.005  # Seconds between checks for gaps while no packet arrives
+REPAIR_FRAMES = 2  # A frame is repaired for this many frame intervals after its first packet...
+MIN_REPAIR_TIME = 0.05  # ...but never less than this...
+MAX_REPAIR_TIME = 0.5  # ...nor more than this (seconds)
+MAX_MISSING_FRAMES = 4  # Frames skipped entirely that are NACKed when the next one arrives
+MAX_SEQ_JUMP = 300  # A sequence number further away than this means the stream restarted
+
+
+def pack_nack(video_id, frame_seq, indexes=()):
+    indexes = list(indexes)[:MAX_NACK_INDEXES]
+    return NACK.pack(NACK_VERSION, video_id, frame_seq, len(indexes)) + b"".join(NACK_INDEX.pack(i) for i in indexes)
+
+
+class FrameGaps:
+    """Reception state of one frame while it can still be repaired."""
+
+    __slots__ = ("source_ip", "packet_count", "received", "highest", "deadline", "next_nack", "nacked", "nacked_all")
+
+    def __init__(self, source_ip, packet_count, deadline):
+        self.source_ip = source_ip  # NACKs go to the hop the frame came from
+        self.packet_count = packet_count  # None until a packet of a frame skipped entirely arrives
+        self.received = set()  # Data packet indexes
+        self.highest = -1
+        self.deadline = deadline
+        self.next_nack = None  # When the open gaps are NACKed (again)
+        self.nacked = set()
+        self.nacked_all = False
+
+
+class VideoGaps:
+    """Frames of one video that are being received or repaired."""
+
+    def __init__(self, frame_seq, timestamp_us):
+        self.latest = frame_seq  # Highest frame sequence number seen
+        self.latest_time = timestamp_us
+        self.floor = frame_seq - 1  # Frames up to here are complete or given up
+        self.frame_interval = 1 / 30  # Smoothed seconds between frames, from their timestamps
+        self.frames = {}  # Frame seq -> FrameGaps
+
+
+class LossDetector:
+    """Find the packets lost on the hop we receive from, and NACK them until their frame's deadline.
+
+    observe() is called with every stream packet received and poll() regularly, from the same
+    thread; poll() returns the NACKs to send. A frame is repaired until REPAIR_FRAMES frame
+    intervals after its first packet, after that its missing packets count as unrecoverable.
+    """
+
+    def __init__(self):
+        self.videos = {}  # Video id -> VideoGaps
+        self.nacks_sent = 0
+        self.recovered = 0  # NACKed packets that arrived in time
+        self.unrecoverable = 0  # Packets still missing at their frame's deadline (a frame never seen counts as one)
+
+    def observe(self, source_ip, packet, now):
+        _, flags, video_id, frame_seq, timestamp_us, packet_index, packet_count = HEADER.unpack_from(packet)[:7]
+        video = self.videos.get(video_id)
+        if video is None or abs(frame_seq - video.latest) > MAX_SEQ_JUMP:
+            video = self.videos[video_id] = VideoGaps(frame_seq, timestamp_us)  # New or restarted stream
+
+        frame = video.frames.get(frame_seq)
+        if frame is None:
+            if frame_seq <= video.floor:
+                return  # Late copy of a frame that is complete or was given up
+            deadline = now + min(max(REPAIR_FRAMES * video.frame_interval, MIN_REPAIR_TIME), MAX_REPAIR_TIME)
+            if frame_seq > video.latest:
+                if timestamp_us > video.latest_time:
+                    interval = (timestamp_us - video.latest_time) / 1_000_000 / (frame_seq - video.latest)
+                    video.frame_interval += 0.125 * (min(max(interval, 1 / 120), 1 / 5) - video.frame_interval)
+                # Frames skipped entirely are NACKed whole, their size is unknown
+                for missing_seq in range(max(video.latest + 1, frame_seq - MAX_MISSING_FRAMES, video.floor + 1), frame_seq):
+                    video.frames[missing_seq] = FrameGaps(source_ip, None, deadline)
+                video.latest, video.latest_time = frame_seq, timestamp_us
+            frame = video.frames[frame_seq] = FrameGaps(source_ip, packet_count, deadline)
+        elif frame.packet_count is None:
+            frame.packet_count = packet_count
+
+        if flags & FLAG_PARITY or packet_index in frame.received:
+            return
+        frame.received.add(packet_index)
+        if packet_index > frame.highest:
+            frame.highest = packet_index
+        if frame.nacked_all or packet_index in frame.nacked:
+            self.recovered += 1
+
+    def skip_to(self, video_id, frame_seq):
+        """Stop repairing the frames of a video up to frame_seq, which was just shown (receivers that display)."""
+        video = self.videos.get(video_id)
+        if video is None:
+            return
+        for seq in [seq for seq in video.frames if seq <= frame_seq]:
+            frame = video.frames.pop(seq)
+            if seq != frame_seq:
+                self._give_up(frame)
+        video.floor = max(video.floor, frame_seq)
+
+    def restart(self, video_id):
+        """Forget a video whose sequence numbers start over (new origin)."""
+        self.videos.pop(video_id, None)
+
+    def poll(self, now):
+        """Return the NACKs due, as (source IP, message), and drop the frames that are done."""
+        nacks = []
+        for video_id, video in self.videos.items():
+            for frame_seq, frame in list(video.frames.items()):
+                complete = frame.packet_count is not None and len(frame.received) >= frame.packet_count
+                if complete or now >= frame.deadline:
+                    if not complete:
+                        self._give_up(frame)
+                    del video.frames[frame_seq]
+                    video.floor = max(video.floor, frame_seq)
+                    continue
+
+                missing = ()  # The whole frame
+                if frame.packet_count is not None:
+                    # The tail of a frame is only known to be missing once a later frame started
+                    end = frame.packet_count if frame_seq < video.latest else frame.highest + 1
+                    missing = [index for index in range(end) if index not in frame.received]
+                    if not missing:
+                        frame.next_nack = None
+                        continue
+                if frame.next_nack is None:
+                    frame.next_nack = now + REORDER_DELAY
+                if now < frame.next_nack:
+                    continue
+                frame.next_nack = now + NACK_RETRY
+                if missing:
+                    frame.nacked.update(missing)
+                else:
+                    frame.nacked_all = True
+                nacks.append((frame.source_ip, pack_nack(video_id, frame_seq, missing)))
+                self.nacks_sent += 1
+        return nacks
+
+    def waiting(self):
+        """Whether any frame is still being received or repaired (poll() is due)."""
+        return any(video.frames for video in self.videos.values())
+
+    def _give_up(self, frame):
+        if frame.packet_count is None:
+            self.unrecoverable += 1
+        else:
+            self.unrecoverable += frame.packet_count - len(frame.received)
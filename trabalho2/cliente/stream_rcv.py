@@ -1,10 +1,73 @@
 import socket
 import struct
+import threading
+import time
 import cv2
 import numpy as np
+from feedback import FEEDBACK_INTERVAL, FEEDBACK_PORT, pack_report
+from fec import FrameAssembler
+from nack import NACK_PORT, LossDetector
+from packet import FLAG_PARITY, HEADER, unpack_header
+
+# Delta frames (server started with --delta) carry only the tiles that changed since the last frame
+DELTA_MAGIC = b'DT'
+DELTA_HEADER = struct.Struct('>2sHHHH')  # magic, tile size, frame width, frame height, tile count
+TILE_HEADER = struct.Struct('>HHI')  # tile column, tile row, JPEG size
+
+MAX_PENDING_FRAMES = 4  # Incomplete frames kept while waiting for missing packets
+MAX_REORDER = 300  # A sequence number further back than this means the stream restarted
+
+LATE_THRESHOLD = 0.1  # Extra delay (s) over the fastest frame seen after which a frame counts as late
+
+class ReceptionStats:
+    """Frames received, lost and late plus interarrival jitter, reported upstream every interval."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.video_id = None
+        self.received = 0
+        self.lost = 0
+        self.late = 0
+        self.jitter = 0.0  # Smoothed variation of the transit time, in seconds (RFC 3550 style)
+        self.last_transit = None
+        self.min_transit = None
+
+    def frame_completed(self, video_id, frames_skipped, timestamp_us):
+        """Account for a frame that was fully received, after frames_skipped lost ones."""
+        # The clocks of the origin and this host are not synchronized, but only differences
+        # between transit times are used, so the offset cancels out
+        transit = time.time() - timestamp_us / 1_000_000
+        with self.lock:
+            self.video_id = video_id
+            self.received += 1
+            self.lost += frames_skipped
+            if self.last_transit is not None:
+                self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16
+            self.last_transit = transit
+            if self.min_transit is None or transit < self.min_transit:
+                self.min_transit = transit
+            elif transit - self.min_transit > LATE_THRESHOLD:
+                self.late += 1
+
+    def restart(self):
+        """Forget the timing baseline when the stream comes from a new origin."""
+        with self.lock:
+            self.last_transit = None
+            self.min_transit = None
+
+    def drain(self):
+        """Return the packed report for the interval that just ended, or None before any frame."""
+        with self.lock:
+            if self.video_id is None:
+                return None
+            total = self.received + self.lost
+            report = pack_report(self.video_id, self.received, self.lost, self.late, self.jitter * 1000,
+                                 self.lost / total if total else 0.0)
+            self.received = self.lost = self.late = 0
+            return report
 
 class StreamReceiver:
-    def __init__(self, port=12346, max_packet_size=60000):
+    def __init__(self, port=12346, max_packet_size=65535):
         self.port = port
         self.max_packet_size = max_packet_size
         self.running = True
@@ -12,56 +75,177 @@ class StreamReceiver:
         self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Allow socket reuse
         self.client_socket.bind(('', self.port))
         self.target_ip = None  # Initialize target IP
+        # Make-before-break switching: the new source is accepted alongside the current one until
+        # it has delivered a complete frame, then on_switched(old_ip) releases the old one
+        self.pending_ip = None
+        self.on_switched = None
+        # Redundant mode: a second PoP streams the same video and its packets fill the slots
+        # lost on the path from the target, whichever copy arrives first is used
+        self.backup_ip = None
+        self.canvas = None  # Last displayed image, delta tiles are composited onto it
+        self.stats = ReceptionStats()  # Reported to the PoP we receive from (see send_reports)
+        self.loss = LossDetector()  # Lost packets are NACKed to the PoP they came from (see nack.py)
 
     def set_target_ip(self, ip):
         """Set the target IP address for receiving data from the specified server."""
         self.target_ip = ip
+        self.pending_ip = None
         print(f"Set new target IP for stream: {self.target_ip}")
 
+    def switch_to(self, ip, on_switched):
+        """Start accepting the stream from ip as well, and switch to it after its first complete frame.
+
+        Frames are deduplicated by sequence number while both sources are accepted, so
+        the switch does not stall the picture. on_switched(old_ip) is called from the
+        receiver thread once the old source is no longer needed.
+        """
+        if self.target_ip is None:
+            self.set_target_ip(ip)
+            return
+        self.on_switched = on_switched
+        self.pending_ip = ip
+        print(f"Receiving the stream from {self.target_ip} and {ip} until {ip} delivers a frame")
+
+    def set_backup_ip(self, ip):
+        """Merge the stream from a second IP into the frames received from the target (None to stop)."""
+        self.backup_ip = ip
+        if ip:
+            print(f"Merging the redundant stream from {ip}")
+
+    def sources(self):
+        """The IPs the stream is currently accepted from."""
+        return [ip for ip in dict.fromkeys((self.target_ip, self.pending_ip, self.backup_ip)) if ip]
+
+    def _complete_switch(self):
+        old_ip, self.target_ip, self.pending_ip = self.target_ip, self.pending_ip, None
+        print(f"Switched stream to {self.target_ip}")
+        self.stats.restart()  # New path, new transit time baseline
+        if self.on_switched:
+            self.on_switched(old_ip)
+
     def start_stream(self):
         """Start receiving video stream from the target IP."""
         print(f"Receiving stream on port {self.port}")
-        data = b""
-        expected_frame_size = None
+        threading.Thread(target=self.send_reports, daemon=True).start()
+        frames = {}  # Frames being assembled, keyed by frame sequence number
+        last_frame_seq = 0  # Last frame displayed; older packets are late duplicates or parity
 
         while self.running:
             try:
                 # Receive a packet
                 packet, addr = self.client_socket.recvfrom(self.max_packet_size)
-                # Check if packet is from the correct target IP
-                if self.target_ip and addr[0] != self.target_ip:
+                # Check if packet is from the correct target IP (or the one we are switching to)
+                source_ip = addr[0]
+                if self.target_ip and source_ip not in (self.target_ip, self.pending_ip, self.backup_ip):
                     continue  # Ignore packets from other IPs
-                
-                # Unpack the 16-byte video ID, 2-byte packet ID, and 4-byte frame size
-                video_id, packet_id, frame_size = struct.unpack('>16sHI', packet[:22])
-                video_id = video_id.decode().strip()  # Decode and strip padding
+
+                header = unpack_header(packet)
+                if header is None:
+                    continue  # Not a v2 stream packet
+                (_, flags, video_id, frame_seq, timestamp_us, packet_index, packet_count,
+                 fec_group_size, _, payload_size, frame_size) = header
+
+                # Packets of frames already shown, including the copies sent by the other source
+                # during a switch or in redundant mode, are duplicates
+                if last_frame_seq - MAX_REORDER < frame_seq <= last_frame_seq:
+                    continue
+                if source_ip == self.backup_ip and source_ip != self.target_ip and not (
+                        last_frame_seq < frame_seq <= last_frame_seq + MAX_REORDER):
+                    continue  # The backup only fills in frames near ours, it may be fed by another origin
+                if frame_seq < last_frame_seq:
+                    if source_ip == self.pending_ip:
+                        # The new source is fed by another origin, whose sequence numbers can not
+                        # be merged with ours: hand over at once
+                        self._complete_switch()
+                    elif self.pending_ip:
+                        continue
+                    # The sequence restarted (new origin or restarted server)
+                    frames.clear()
+                    last_frame_seq = 0
+                    self.stats.restart()
+                    self.loss.restart(video_id)
+
+                now = time.monotonic()
+                self.loss.observe(source_ip, packet, now)
+                for nack_ip, nack in self.loss.poll(now):
+                    self.client_socket.sendto(nack, (nack_ip, NACK_PORT))
 
                 # Initialize frame buffer if this is a new frame
-                if expected_frame_size is None or frame_size != expected_frame_size:
-                    expected_frame_size = frame_size
-                    data = b""
+                assembler = frames.get(frame_seq)
+                if assembler is None:
+                    if len(frames) == MAX_PENDING_FRAMES:
+                        del frames[min(frames)]  # Give up on the oldest incomplete frame
+                    assembler = frames[frame_seq] = FrameAssembler(frame_size, packet_count)
+                elif (assembler.frame_size, assembler.packet_count) != (frame_size, packet_count):
+                    continue  # Same sequence number from another origin, not the same frame
+
+                # Parity packets let us rebuild one lost packet per FEC group
+                payload = packet[HEADER.size:HEADER.size + payload_size]
+                data = assembler.add(flags & FLAG_PARITY, packet_index, fec_group_size, payload)
 
-                data += packet[22:]  # Append data excluding the header
-                
                 # If we've collected the whole frame, decode and display it
-                if len(data) >= expected_frame_size:
-                    frame = np.frombuffer(data, dtype=np.uint8)
-                    
+                if data is not None:
+                    if source_ip == self.pending_ip:
+                        self._complete_switch()
+                    skipped = frame_seq - last_frame_seq - 1 if last_frame_seq else 0
+                    self.stats.frame_completed(video_id, skipped, timestamp_us)
+                    last_frame_seq = frame_seq
+                    self.loss.skip_to(video_id, frame_seq)
+                    for pending_seq in [seq for seq in frames if seq <= frame_seq]:
+                        del frames[pending_seq]  # Older frames can no longer be shown in order
                     try:
-                        frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
+                        frame = self.decode_frame(data)
                         if frame is not None:
                             cv2.imshow("Video Stream", frame)
                             cv2.waitKey(1)
                     except cv2.error as e:
                         print("Frame decoding error:", e)
-                    
-                    data = b""  # Reset for next frame
 
             except socket.timeout:
                 print("Stream receiver timeout. No data received.")
             except Exception as e:
                 print("Error receiving stream:", e)
 
+    def send_reports(self):
+        """Periodically send reception statistics to the node we receive the stream from."""
+        repairs = (0, 0)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as report_socket:
+            while self.running:
+                time.sleep(FEEDBACK_INTERVAL)
+                if (self.loss.recovered, self.loss.unrecoverable) != repairs:
+                    repairs = (self.loss.recovered, self.loss.unrecoverable)
+                    print(f"Lost packets: {repairs[0]} recovered after a NACK, {repairs[1]} unrecoverable")
+                report = self.stats.drain()
+                if report is None or not self.target_ip:
+                    continue
+                try:
+                    report_socket.sendto(report, (self.target_ip, FEEDBACK_PORT))
+                except Exception as e:
+                    print(f"Failed to send receiver report to {self.target_ip}. Error: {e}")
+
+    def decode_frame(self, data):
+        """Decode a full JPEG frame, or composite the tiles of a delta frame onto the last image."""
+        if data[:2] != DELTA_MAGIC:
+            frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if frame is not None:
+                self.canvas = frame
+            return frame
+
+        _, tile_size, width, height, tile_count = DELTA_HEADER.unpack_from(data)
+        if self.canvas is None or self.canvas.shape[:2] != (height, width):
+            return None  # Joined between keyframes, wait for the next full frame
+
+        offset = DELTA_HEADER.size
+        for _ in range(tile_count):
+            col, row, size = TILE_HEADER.unpack_from(data, offset)
+            offset += TILE_HEADER.size
+            tile = cv2.imdecode(np.frombuffer(data, dtype=np.uint8, count=size, offset=offset), cv2.IMREAD_COLOR)
+            offset += size
+            if tile is not None:
+                y, x = row * tile_size, col * tile_size
+                self.canvas[y:y + tile_size, x:x + tile_size] = tile
+        return self.canvas
+
     def stop_stream(self):
         """Stop receiving video stream and reset the state."""
         self.running = False
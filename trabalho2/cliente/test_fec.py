@@ -0,0 +1,65 @@
+import unittest
+from fec import FrameAssembler, protect, xor_parity
+
+
+def split(frame, packet_size):
+    return [frame[start:start + packet_size] for start in range(0, len(frame), packet_size)]
+
+
+def assemble(frame, chunks, group_size, lost):
+    """Feed every packet of protect() except the lost data packet indexes; return the assembler and its result."""
+    assembler = FrameAssembler(len(frame), len(chunks))
+    result = None
+    for is_parity, packet_index, payload in protect(chunks, group_size):
+        if not is_parity and packet_index in lost:
+            continue
+        result = assembler.add(is_parity, packet_index, group_size, payload) or result
+    return assembler, result
+
+
+class XorParityTest(unittest.TestCase):
+    def test_shorter_chunks_are_padded(self):
+        self.assertEqual(xor_parity([b"\x01\x02", b"\x03"]), b"\x02\x02")
+
+    def test_protect_adds_one_parity_per_group(self):
+        packets = protect([b"a", b"b", b"c", b"d", b"e"], 2)
+        self.assertEqual([(is_parity, index) for is_parity, index, _ in packets],
+                         [(False, 0), (False, 1), (False, 2), (False, 3), (False, 4), (True, 0), (True, 1), (True, 2)])
+        self.assertEqual(protect([b"a", b"b"], 0), [(False, 0, b"a"), (False, 1, b"b")])
+
+
+class FrameAssemblerTest(unittest.TestCase):
+    frame = bytes(range(256)) * 3 + b"tail"  # 772 bytes: 7 packets of 100, the last one shorter
+
+    def test_complete_frame(self):
+        chunks = split(self.frame, 100)
+        assembler, result = assemble(self.frame, chunks, 3, lost=())
+        self.assertEqual(result, self.frame)
+        self.assertEqual(assembler.recovered, 0)
+
+    def test_recovers_one_lost_packet_per_group(self):
+        chunks = split(self.frame, 100)
+        assembler, result = assemble(self.frame, chunks, 3, lost={1, 4})
+        self.assertEqual(result, self.frame)
+        self.assertEqual(assembler.recovered, 2)
+
+    def test_recovers_the_short_last_packet(self):
+        chunks = split(self.frame, 100)
+        assembler, result = assemble(self.frame, chunks, 3, lost={len(chunks) - 1})
+        self.assertEqual(result, self.frame)
+        self.assertEqual(assembler.recovered, 1)
+
+    def test_two_losses_in_a_group_are_not_recovered(self):
+        chunks = split(self.frame, 100)
+        assembler, result = assemble(self.frame, chunks, 3, lost={0, 2})
+        self.assertIsNone(result)
+        self.assertEqual(assembler.recovered, 0)
+
+    def test_no_recovery_without_fec(self):
+        chunks = split(self.frame, 100)
+        _, result = assemble(self.frame, chunks, 0, lost={3})
+        self.assertIsNone(result)
+
+
+if __name__ == "__main__":
+    unittest.main()
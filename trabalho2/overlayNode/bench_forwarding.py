@@ -0,0 +1,114 @@
+import multiprocessing
+import socket
+import sys
+import threading
+import time
+from forwarding import Forwarder
+from packet import HEADER, STREAM_VERSION, VIDEO_ID, VIDEO_ID_OFFSET, pack_header
+
+# Packets per second one forwarding thread takes off the stream socket, with the previous
+# per-packet path (lock held over the fan-out, a new socket for every send) and with Forwarder.
+# A separate process floods the forwarder over loopback; subscribers are sockets on 127.0.0.x
+# that are never read, so the kernel drops what they receive.
+# Usage: python3 bench_forwarding.py [--subscribers N] [--seconds S] [--size BYTES] [--port PORT]
+
+
+def parse_args():
+    options = {"--subscribers": 4, "--seconds": 3, "--size": 1400, "--port": 22346}
+    args = sys.argv[1:]
+    for flag in options:
+        if flag in args:
+            options[flag] = int(args[args.index(flag) + 1])
+    return options
+
+
+def flood(port, size, stop):
+    """Send stream packets of one video to the forwarder as fast as possible."""
+    payload_size = size - HEADER.size
+    packet = pack_header(0, 1, 1, 0, 0, 1, 0, payload_size, payload_size) + bytes(payload_size)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+        while not stop.is_set():
+            for _ in range(1000):
+                sender.sendto(packet, ("127.0.0.1", port))
+
+
+class PerPacketForwarder:
+    """The forwarding path before Forwarder, kept here for comparison."""
+
+    def __init__(self, receive_socket, port, client_ips):
+        self.receive_socket = receive_socket
+        self.port = port
+        self.lock = threading.Lock()
+        self.video_client_map = {"video": set(client_ips)}
+        self.video_names = {1: "video"}
+        self.packets_received = 0
+
+    def run(self):
+        while True:
+            data, addr = self.receive_socket.recvfrom(65535)
+            self.packets_received += 1
+            if len(data) < HEADER.size or data[0] != STREAM_VERSION:
+                continue
+            video_id = VIDEO_ID.unpack_from(data, VIDEO_ID_OFFSET)[0]
+            with self.lock:
+                video_name = self.video_names.get(video_id)
+                if video_name in self.video_client_map:
+                    for client_ip in self.video_client_map[video_name]:
+                        client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                        client_socket.sendto(data, (client_ip, self.port))
+                        client_socket.close()
+
+
+def measure(forwarder, seconds):
+    """Packets per second the forwarder handles over the given time."""
+    threading.Thread(target=forwarder.run, daemon=True).start()
+    time.sleep(0.5)  # Let the flood fill the socket buffer
+    start_count, start = forwarder.packets_received, time.perf_counter()
+    time.sleep(seconds)
+    return (forwarder.packets_received - start_count) / (time.perf_counter() - start)
+
+
+def run(kind, options, result):
+    """Measure one forwarder in a process of its own, so the two runs do not share a GIL."""
+    port, subscribers = options["--port"], options["--subscribers"]
+    client_ips = [f"127.0.0.{index + 2}" for index in range(subscribers)]
+    sinks = []
+    for client_ip in client_ips:
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind((client_ip, port))
+        sinks.append(sink)
+
+    receive_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receive_socket.bind(("127.0.0.1", port))
+    if kind == "forwarder":
+        forwarder = Forwarder(receive_socket, port)
+        forwarder.set_subscribers(1, client_ips)
+    else:
+        forwarder = PerPacketForwarder(receive_socket, port, client_ips)
+
+    stop = multiprocessing.Event()
+    sender = multiprocessing.Process(target=flood, args=(port, options["--size"], stop), daemon=True)
+    sender.start()
+    result.put(measure(forwarder, options["--seconds"]))
+    stop.set()
+    sender.join()
+
+
+def main():
+    options = parse_args()
+    print(f"{options['--size']}-byte packets of one video to {options['--subscribers']} subscribers, "
+          f"{options['--seconds']} s per run")
+    rates = {}
+    for kind in ("per-packet", "forwarder"):
+        result = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run, args=(kind, options, result))
+        process.start()
+        rates[kind] = result.get()
+        process.join()
+        print(f"{kind:>10}: {rates[kind]:>10,.0f} packets/s in, "
+              f"{rates[kind] * options['--subscribers']:>10,.0f} packets/s out")
+    print(f"Speedup: {rates['forwarder'] / rates['per-packet']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
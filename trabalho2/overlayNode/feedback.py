@@ -0,0 +1,55 @@
+import struct
+import threading
+
+# Receiver reports flow upstream over UDP, from clients to their PoP and from every overlay node
+# to its current upstream, until they reach the origin. Each node merges the reports of its
+# downstream receivers per video before forwarding them, so the origin sees one report per
+# neighbour instead of one per client.
+FEEDBACK_PORT = 13336
+FEEDBACK_INTERVAL = 2  # Seconds between reports
+FEEDBACK_VERSION = 1
+# version, video id, frames received, frames lost, frames late, jitter (ms), worst loss fraction, receivers
+FEEDBACK = struct.Struct('>BIIIIffH')
+
+
+def pack_report(video_id, received, lost, late, jitter, worst_loss, receivers=1):
+    return FEEDBACK.pack(FEEDBACK_VERSION, video_id, received, lost, late, jitter, worst_loss, receivers)
+
+
+def unpack_report(data):
+    """Return (video_id, received, lost, late, jitter, worst_loss, receivers), or None if malformed."""
+    if len(data) != FEEDBACK.size or data[0] != FEEDBACK_VERSION:
+        return None
+    return FEEDBACK.unpack(data)[1:]
+
+
+class FeedbackAggregator:
+    """Merge the receiver reports of one reporting interval, per video."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reports = {}  # Video id -> [received, lost, late, jitter, worst_loss, receivers]
+
+    def add(self, report):
+        video_id, received, lost, late, jitter, worst_loss, receivers = report
+        with self.lock:
+            total = self.reports.get(video_id)
+            if total is None:
+                self.reports[video_id] = [received, lost, late, jitter, worst_loss, receivers]
+                return
+            total[0] += received
+            total[1] += lost
+            total[2] += late
+            total[3] = max(total[3], jitter)  # Report the worst path, that is what adaptation must protect
+            total[4] = max(total[4], worst_loss)
+            total[5] += receivers
+
+    def drain(self):
+        """Return the packed aggregate report of every video and start a new interval."""
+        with self.lock:
+            reports, self.reports = self.reports, {}
+        return {
+            video_id: pack_report(video_id, *(min(int(value), 0xFFFFFFFF) for value in total[:3]),
+                                  total[3], total[4], min(total[5], 0xFFFF))
+            for video_id, total in reports.items()
+        }
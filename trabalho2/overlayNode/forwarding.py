@@ -0,0 +1,170 @@
+import select
+import socket
+import threading
+import time
+from nack import NACK_PORT, POLL_INTERVAL
+from packet import HEADER, STREAM_VERSION, VIDEO_ID, VIDEO_ID_OFFSET
+
+MAX_DATAGRAM = 65535
+FORWARD_BATCH = 64  # Packets received back to back before they are forwarded
+
+
+class Forwarder:
+    """Fast path of a node: forward each stream packet to the subscribers of its video.
+
+    Packets are received into preallocated buffers, as many as are already queued (up to
+    FORWARD_BATCH) per wakeup, and sent from one long-lived socket. The subscriber table
+    maps video ids to tuples of addresses and is never modified: set_subscribers replaces
+    it with an updated copy, so the forwarding loop reads it without taking any lock.
+    In a worker process the table comes from shared_table instead (see forwardpool.py).
+
+    accept, when set, is called as accept(video_id, source_ip, packet) before a packet is
+    forwarded and may drop it (see Handover). Leave it None when there is nothing to filter.
+    cache, when set, gets a copy of every forwarded packet (see FrameCache). A new subscriber
+    of a video the cache holds frames of is then only added to the table by the forwarding
+    loop, right after it sent the subscriber those frames, so the live packets follow them.
+    retransmit and loss, when set, keep the forwarded packets for the repairs asked by our
+    subscribers and NACK the packets lost on the way from our upstream (see nack.py).
+    """
+
+    def __init__(self, receive_socket, port):
+        self.receive_socket = receive_socket
+        self.port = port  # Subscribers receive the stream on this port
+        self.send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.table = {}  # Video id -> tuple of subscriber addresses
+        self.shared_table = None
+        self.accept = None
+        self.cache = None
+        self.retransmit = None  # RetransmitBuffer
+        self.loss = None  # LossDetector, only used by the forwarding thread
+        self.packets_received = 0  # Stream packets taken off the socket, counted once per batch
+        self.table_lock = threading.Lock()  # Serializes the table updates, the forwarding loop reads without it
+        self.joining = {}  # Video id -> subscriber IPs waiting for the cached frames
+        # Wakes the forwarding loop up when subscribers join while no packet arrives
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+
+    def set_subscribers(self, video_id, client_ips):
+        """Publish the subscribers of a video; always succeeds."""
+        with self.table_lock:
+            client_ips = set(client_ips)
+            joining = self.joining.pop(video_id, set()) & client_ips
+            if self.cache is not None and self.cache.frames(video_id):
+                joining |= client_ips - {target[0] for target in self.table.get(video_id, ())}
+            self._publish(video_id, client_ips - joining)
+            if joining:
+                self.joining[video_id] = joining
+                self.wakeup_sender.send(b"\0")
+        return True
+
+    def _publish(self, video_id, client_ips):
+        """Replace the table with one where a video has these subscribers (caller holds table_lock)."""
+        table = dict(self.table)
+        if client_ips:
+            table[video_id] = tuple((client_ip, self.port) for client_ip in sorted(client_ips))
+        else:
+            table.pop(video_id, None)
+        self.table = table
+
+    def send_joins(self):
+        """Send the joining subscribers the cached frames, then start forwarding to them (forwarding thread)."""
+        with self.table_lock:
+            joining, self.joining = self.joining, {}
+            for video_id, client_ips in joining.items():
+                packets = self.cache.join_packets(video_id)
+                for client_ip in client_ips:
+                    try:
+                        for packet in packets:
+                            self.send_socket.sendto(packet, (client_ip, self.port))
+                    except OSError as e:
+                        print(f"Failed to send cached frames to {client_ip}. Error: {e}")
+                self._publish(video_id, {target[0] for target in self.table.get(video_id, ())} | client_ips)
+
+    def handle_wakeup(self):
+        """Empty the wakeup socket, then send the pending joins (forwarding thread).
+
+        Called whenever the socket is readable, even with no join pending: a join may have
+        been sent by an earlier send_joins() call after its byte was written, and a byte left
+        unread would keep the poll returning at once.
+        """
+        try:
+            while self.wakeup_receiver.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+        if self.joining:
+            self.send_joins()
+
+    def repair(self, client_ip, video_id, frame_seq, indexes):
+        """Send a subscriber the packets of a frame it NACKed, if we still hold them."""
+        if self.retransmit is None or (client_ip, self.port) not in self.table.get(video_id, ()):
+            return
+        for packet in self.retransmit.get(video_id, frame_seq, indexes):
+            self.send_socket.sendto(packet, (client_ip, self.port))
+
+    def run(self):
+        self.receive_socket.setblocking(False)
+        poller = select.poll()
+        poller.register(self.receive_socket, select.POLLIN)
+        self.wakeup_receiver.setblocking(False)
+        poller.register(self.wakeup_receiver, select.POLLIN)
+        wakeup_fd = self.wakeup_receiver.fileno()
+        buffers = [bytearray(MAX_DATAGRAM) for _ in range(FORWARD_BATCH)]
+        views = [memoryview(buffer) for buffer in buffers]
+        received = [(0, None)] * FORWARD_BATCH  # (size, source address) of every buffer
+        recvfrom_into = self.receive_socket.recvfrom_into
+        sendto = self.send_socket.sendto
+        shared_table = self.shared_table
+        loss = self.loss
+
+        while True:
+            try:
+                # While frames are being repaired, wake up to NACK their gaps even if nothing arrives
+                events = poller.poll(POLL_INTERVAL * 1000 if loss is not None and loss.waiting() else None)
+                if any(fd == wakeup_fd for fd, _ in events):
+                    self.handle_wakeup()
+                count = 0
+                try:
+                    while count < FORWARD_BATCH:
+                        received[count] = recvfrom_into(buffers[count])
+                        count += 1
+                except BlockingIOError:
+                    pass  # Nothing more queued
+                except OSError as e:
+                    print(f"Error while receiving stream data: {e}")
+
+                self.packets_received += count
+                table = self.table if shared_table is None else shared_table.snapshot()
+                accept = self.accept
+                cache = self.cache
+                retransmit = self.retransmit
+                now = time.monotonic()
+                for index in range(count):
+                    size, addr = received[index]
+                    buffer = buffers[index]
+                    # Route on the numeric video id at a fixed offset of the v2 header
+                    if size < HEADER.size or buffer[0] != STREAM_VERSION:
+                        continue
+                    video_id = VIDEO_ID.unpack_from(buffer, VIDEO_ID_OFFSET)[0]
+                    packet = views[index][:size]
+                    if accept is not None and not accept(video_id, addr[0], packet):
+                        continue
+                    for target in table.get(video_id, ()):
+                        try:
+                            sendto(packet, target)
+                        except OSError as e:
+                            print(f"Failed to forward data to {target[0]}. Error: {e}")
+                    if cache is not None:
+                        cache.add(video_id, packet)
+                    if retransmit is not None:
+                        retransmit.add(packet, now)
+                    if loss is not None:
+                        loss.observe(addr[0], packet, now)
+
+                if loss is not None:
+                    for upstream, nack in loss.poll(now):
+                        try:
+                            sendto(nack, (upstream, NACK_PORT))
+                        except OSError as e:
+                            print(f"Failed to send NACK to {upstream}. Error: {e}")
+            except Exception as e:
+                print(f"Error during retransmission: {e}")
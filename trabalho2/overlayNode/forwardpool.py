@@ -0,0 +1,165 @@
+import ctypes
+import multiprocessing
+import socket
+import struct
+from multiprocessing import shared_memory
+from forwarding import Forwarder
+from packet import VIDEO_ID_OFFSET
+
+# Worker-pool forwarding: N processes each bind the stream port with SO_REUSEPORT and run a
+# Forwarder. A classic BPF program on the group picks the worker from the video id in the
+# packet (video id mod N), so every packet of a video is handled by the same worker and stays
+# in order. Without the program (older kernels) the kernel hashes each flow, which keeps
+# per-upstream order instead.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+SO_ATTACH_REUSEPORT_CBPF = 51
+
+# The subscriber table lives in shared memory and is written by the control process only:
+# a generation counter, odd while an update is in progress, then TABLE_SLOTS slots of
+# in use flag, video id, subscriber count and MAX_SUBSCRIBERS IPv4 addresses.
+TABLE_HEADER = struct.Struct('>Q')
+SLOT_HEADER = struct.Struct('>BIH')
+TABLE_SLOTS = 256
+MAX_SUBSCRIBERS = 64
+SLOT_SIZE = SLOT_HEADER.size + 4 * MAX_SUBSCRIBERS
+
+
+class SubscriberTable:
+    """Video id -> subscriber IPs in shared memory, written by one process and read by the workers."""
+
+    def __init__(self, shm, port):
+        self.shm = shm
+        self.port = port  # Subscribers receive the stream on this port
+        self.slots = {}  # Writer side: video id -> slot index
+        self.generation = None  # Reader side: generation of the cached snapshot
+        self.snapshot_table = {}
+
+    @classmethod
+    def create(cls, port):
+        shm = shared_memory.SharedMemory(create=True, size=TABLE_HEADER.size + TABLE_SLOTS * SLOT_SIZE)
+        shm.buf[:TABLE_HEADER.size] = TABLE_HEADER.pack(0)
+        return cls(shm, port)
+
+    def set(self, video_id, client_ips):
+        """Publish the subscribers of a video (control process; callers serialize their updates).
+
+        Returns False, leaving the table as it was, if they do not fit: more than MAX_SUBSCRIBERS
+        subscribers, or a new video while all TABLE_SLOTS slots are in use.
+        """
+        client_ips = list(client_ips)
+        if len(client_ips) > MAX_SUBSCRIBERS:
+            print(f"Video {video_id} can not have {len(client_ips)} subscribers, the forwarding table holds {MAX_SUBSCRIBERS}.")
+            return False
+
+        slot = self.slots.get(video_id)
+        if slot is None:
+            if not client_ips:
+                return True
+            free = set(range(TABLE_SLOTS)) - set(self.slots.values())
+            if not free:
+                print(f"Subscriber table full ({TABLE_SLOTS} videos), video {video_id} can not be forwarded.")
+                return False
+            slot = self.slots[video_id] = min(free)
+
+        generation, = TABLE_HEADER.unpack_from(self.shm.buf)
+        TABLE_HEADER.pack_into(self.shm.buf, 0, generation + 1)
+        offset = TABLE_HEADER.size + slot * SLOT_SIZE
+        SLOT_HEADER.pack_into(self.shm.buf, offset, 1 if client_ips else 0, video_id, len(client_ips))
+        for index, client_ip in enumerate(client_ips):
+            self.shm.buf[offset + SLOT_HEADER.size + 4 * index:offset + SLOT_HEADER.size + 4 * (index + 1)] = \
+                socket.inet_aton(client_ip)
+        TABLE_HEADER.pack_into(self.shm.buf, 0, generation + 2)
+        if not client_ips:
+            del self.slots[video_id]
+        return True
+
+    def snapshot(self):
+        """Video id -> tuple of subscriber addresses, as Forwarder reads it (worker side).
+
+        The table is only read again when its generation changed; an update in progress
+        leaves the previous snapshot in use until the next call.
+        """
+        generation, = TABLE_HEADER.unpack_from(self.shm.buf)
+        if generation == self.generation or generation % 2:
+            return self.snapshot_table
+
+        table = {}
+        for slot in range(TABLE_SLOTS):
+            offset = TABLE_HEADER.size + slot * SLOT_SIZE
+            in_use, video_id, count = SLOT_HEADER.unpack_from(self.shm.buf, offset)
+            if in_use:
+                addresses = offset + SLOT_HEADER.size
+                table[video_id] = tuple(
+                    (socket.inet_ntoa(bytes(self.shm.buf[addresses + 4 * index:addresses + 4 * (index + 1)])), self.port)
+                    for index in range(count)
+                )
+        if TABLE_HEADER.unpack_from(self.shm.buf)[0] == generation:
+            self.generation, self.snapshot_table = generation, table
+        return self.snapshot_table
+
+    def close(self):
+        self.shm.close()
+
+
+def reuseport_sockets(port, workers):
+    """Bind one socket per worker to the stream port and steer packets to them by video id."""
+    sockets = []
+    for _ in range(workers):
+        worker_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        worker_socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        worker_socket.bind(("0.0.0.0", port))
+        sockets.append(worker_socket)
+
+    # A = 32-bit word at the video id offset of the UDP payload; A %= workers; return A,
+    # the index of the socket in the group (in bind order)
+    program = [(0x20, 0, 0, VIDEO_ID_OFFSET), (0x94, 0, 0, workers), (0x16, 0, 0, 0)]
+    filters = ctypes.create_string_buffer(b"".join(struct.pack('HBBI', *instruction) for instruction in program))
+    try:
+        sockets[0].setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF,
+                              struct.pack('HP', len(program), ctypes.addressof(filters)))
+    except OSError as e:
+        print(f"Could not steer stream packets by video id, falling back to per-flow hashing. Error: {e}")
+    return sockets
+
+
+def run_forwarding_worker(receive_socket, table):
+    """Entry point of a forwarding process."""
+    forwarder = Forwarder(receive_socket, table.port)
+    forwarder.shared_table = table
+    forwarder.run()
+
+
+class ForwardingPool:
+    """Forward with several processes, for nodes with more than one core.
+
+    Used by the node like a Forwarder: set_subscribers updates the shared table the workers
+    read on their next batch. The workers can not see the node's handovers, so accept is
+    ignored and the node switches upstreams without overlap (break before make). There is
+    no frame cache either, so new subscribers wait for the next full frame, and lost
+    packets are not repaired (see nack.py). The workers are forked here, so create the pool
+    before any thread is started.
+    """
+
+    def __init__(self, port, workers):
+        self.port = port
+        self.table = SubscriberTable.create(port)
+        self.accept = None
+        self.cache = None
+        self.retransmit = None
+        self.loss = None
+        self.processes = []
+        for worker_socket in reuseport_sockets(port, workers):
+            process = multiprocessing.Process(target=run_forwarding_worker, args=(worker_socket, self.table), daemon=True)
+            process.start()
+            worker_socket.close()  # The worker has its own copy
+            self.processes.append(process)
+        print(f"Forwarding with {workers} worker processes on UDP port {port}")
+
+    def set_subscribers(self, video_id, client_ips):
+        return self.table.set(video_id, client_ips)
+
+    def run(self):
+        """Wait for the workers; they only exit if they fail."""
+        for process in self.processes:
+            process.join()
+            print(f"Forwarding worker (pid {process.pid}) exited with code {process.exitcode}.")
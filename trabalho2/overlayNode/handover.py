@@ -0,0 +1,70 @@
+import time
+from packet import FLAG_PARITY, HEADER, video_id_for
+
+HANDOVER_TIMEOUT = 3  # Seconds the old upstream is kept at most when the new one is slow to deliver
+# Both paths of the same origin deliver nearly the same frames; a sequence number further than
+# this from the old upstream's means the new upstream is fed by another origin
+SEQ_WINDOW = 90
+
+
+class Handover:
+    """Make-before-break switch between two upstreams.
+
+    Both upstreams feed the node while the switch is in progress. Packets already
+    forwarded from either one are dropped, so downstream never sees a copy twice. The
+    switch is complete once the new upstream has delivered a whole frame of every video
+    being watched, or after the timeout, and then the old upstream can be released.
+
+    Each video picks its upstream on its own, so the new upstream may be fed by another
+    origin, whose sequence numbers can not be merged with the old ones. An origin stamps a
+    frame once, so a sequence number that comes back with another timestamp, or one far
+    from the old upstream's, gives that away: the video is then cut over to the new
+    upstream at once and the old upstream's packets are dropped.
+    """
+
+    def __init__(self, old, new, video_names, active_videos, timeout=HANDOVER_TIMEOUT):
+        self.old = old
+        self.new = new
+        self.video_names = video_names  # Videos to stop at the old upstream once the switch completes
+        # Ids of the watched videos the new upstream has not delivered a whole frame of yet
+        self.waiting = {video_id_for(video_name) for video_name in active_videos}
+        self.deadline = time.monotonic() + timeout
+        self.forwarded = set()  # (video id, frame seq, flags, packet index) of packets already forwarded
+        self.received = {}  # (video id, frame seq) -> data packets of the frame received from the new upstream
+        self.timestamps = {}  # (video id, frame seq) -> timestamp of the frame first forwarded
+        self.old_latest = {}  # Video id -> highest frame seq forwarded from the old upstream
+        self.cut = set()  # Ids of the videos cut over to the new upstream (another origin)
+
+    def accept(self, source_ip, packet):
+        """Return True if the packet should be forwarded, False if it is a duplicate."""
+        _, flags, video_id, frame_seq, timestamp_us, packet_index, packet_count = HEADER.unpack_from(packet)[:7]
+        if video_id in self.cut:
+            return source_ip == self.new
+
+        frame = (video_id, frame_seq)
+        if source_ip == self.old:
+            self.old_latest[video_id] = max(self.old_latest.get(video_id, frame_seq), frame_seq)
+        else:
+            old_latest = self.old_latest.get(video_id)
+            timestamp = self.timestamps.get(frame)
+            if ((timestamp is not None and timestamp != timestamp_us)
+                    or (old_latest is not None and abs(frame_seq - old_latest) > SEQ_WINDOW)):
+                self.cut.add(video_id)
+                self.waiting.discard(video_id)
+                return True
+        self.timestamps.setdefault(frame, timestamp_us)
+
+        # The new upstream delivers a frame even when the old one's copies got here first
+        if source_ip == self.new and not flags & FLAG_PARITY and video_id in self.waiting:
+            self.received[frame] = self.received.get(frame, 0) + 1
+            if self.received[frame] == packet_count:
+                self.waiting.discard(video_id)
+
+        key = (video_id, frame_seq, flags, packet_index)
+        if key in self.forwarded:
+            return False
+        self.forwarded.add(key)
+        return True
+
+    def complete(self):
+        return not self.waiting or time.monotonic() > self.deadline
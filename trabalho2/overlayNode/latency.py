@@ -1,45 +1,78 @@
 import time
 import threading
-import socket
+from advert import AdvertFilter, forwarded, unpack_advert
+from catalog import CatalogIndex
+from probe import PROBE_PORT, Prober
+
+# Upstreams are ranked by a composite cost: the route latency in ms plus the load the origin
+# at the end of the route advertises, each figure weighted in ms per unit (egress in bytes/s,
+# deadline misses per advert interval). LatencyManager takes other weights as load_weights.
+LOAD_WEIGHTS = {"streams": 0.0, "subscribers": 0.5, "egress": 2 / 1_000_000, "deadline_misses": 1.0}
 
 class LatencyManager:
-    def __init__(self, timeout=15):
+    def __init__(self, timeout=15, load_weights=None):
         self.lock = threading.Lock()  # Ensure thread-safe access
-        self.server_latencies = {}  # Store latencies for each server
-        self.server_last_update = {}  # Track last update time for each server
         self.timeout = timeout  # Timeout duration in seconds
+        self.routes = {}  # (neighbour IP, origin id) -> (path cost in ms, time of the update)
+        self.catalog = CatalogIndex(timeout)  # Videos of each origin, origins of each video
+        self.origin_loads = {}  # Origin id -> OriginLoad from its latest advert
+        self.load_weights = dict(LOAD_WEIGHTS, **(load_weights or {}))
 
-    def update_latency(self, server_ip, latency):
-        """Update the latency for a given server."""
+    def update_latency(self, server_ip, latency, origin_id=0):
+        """Update the cost of the route to an origin through a given neighbour."""
         with self.lock:
-            self.server_latencies[server_ip] = latency
-            self.server_last_update[server_ip] = time.time()
-            #print(f"Updated latency for {server_ip}: {latency:.2f} ms")
+            self.routes[(server_ip, origin_id)] = (latency, time.time())
 
-    def get_best_server(self):
-        """Get the IP of the server with the lowest latency."""
+    def best_cost(self, origin_id):
+        """Our cheapest fresh path cost to an origin, or None if it is unreachable."""
         with self.lock:
-            if not self.server_latencies:
-                return None
-            # Return the server with the lowest latency that is not marked as infinite
-            return min(self.server_latencies, key=self.server_latencies.get)
-
-    def mark_stale_servers(self):
-        """Mark servers as inactive if they haven't updated within the timeout period."""
-        current_time = time.time()
+            now = time.time()
+            costs = [
+                cost for (_, origin), (cost, updated) in self.routes.items()
+                if origin == origin_id and now - updated <= self.timeout
+            ]
+            return min(costs) if costs else None
+
+    def update_load(self, origin_id, load):
+        """Record the OriginLoad carried by an origin's latest advert."""
         with self.lock:
-            for server_ip, last_update in list(self.server_last_update.items()):
-                if current_time - last_update > self.timeout:
-                    print(f"Server {server_ip} is unresponsive. Marking as unreachable.")
-                    self.server_latencies[server_ip] = float('inf')
-
-    def print_latencies(self):
-        """Print the current latencies for all tracked servers."""
+            self.origin_loads[origin_id] = load
+
+    def load_cost(self, origin_id):
+        """The load of an origin in ms of composite cost (caller holds lock)."""
+        load = self.origin_loads.get(origin_id)
+        if load is None:
+            return 0.0
+        return sum(weight * getattr(load, figure) for figure, weight in self.load_weights.items())
+
+    def video_costs(self, video_name, keep=None):
+        """Composite cost of the cheapest fresh route through each neighbour to an origin that has the video.
+
+        Routes to saturated origins are left out, except through keep (the neighbour the video
+        already comes from) or when every origin with the video is saturated.
+        """
+        origins = self.catalog.origins_for(video_name)
         with self.lock:
-            print("Current latencies for connected servers:")
-            for server, latency in self.server_latencies.items():
-                status = "Unreachable" if latency == float('inf') else f"{latency:.2f} ms"
-                print(f"Server {server}: {status}")
+            now = time.time()
+            costs, saturated_costs = {}, {}
+            for (neighbour, origin), (cost, updated) in self.routes.items():
+                if origin not in origins or now - updated > self.timeout:
+                    continue
+                load = self.origin_loads.get(origin)
+                candidates = saturated_costs if load and load.saturated and neighbour != keep else costs
+                cost += self.load_cost(origin)
+                if cost < candidates.get(neighbour, float('inf')):
+                    candidates[neighbour] = cost
+            return costs or saturated_costs
+
+    def expire_routes(self):
+        """Drop the routes that were not advertised again within the timeout period."""
+        current_time = time.time()
+        with self.lock:
+            for route, (_, updated) in list(self.routes.items()):
+                if current_time - updated > self.timeout:
+                    print(f"Route to origin {route[1]} through {route[0]} expired.")
+                    del self.routes[route]
 
 
 class LatencyHandler:
@@ -48,66 +81,55 @@ class LatencyHandler:
         self.vizinhos = vizinhos
         self.latency_manager = latency_manager
         self.check_interval = check_interval
-
-    def start(self):
-        """Start the thread to handle latency and check inactive servers."""
-        self.latency_thread = threading.Thread(target=self.receive_and_forward_timestamps)
-        self.latency_thread.start()
-
-        # Start a thread to monitor stale servers
-        self.monitor_thread = threading.Thread(target=self.monitor_stale_servers)
+        self.seen = AdvertFilter()  # Adverts already forwarded
+        self.channels = None  # Persistent advert channels to the neighbours
+        self.prober = Prober(lambda: self.vizinhos)  # RTT of the link to each neighbour
+
+    def start(self, control_plane):
+        """Serve adverts and link probes on the control plane and start expiring stale routes."""
+        control_plane.add_channel(self.port, self.handle_adverts)
+        control_plane.add_datagram(PROBE_PORT, self.prober)
+        # While a neighbour is unreachable only the newest adverts are kept for it
+        self.channels = control_plane.channels(self.port, max_pending=16, verbose=False)
+
+        # Start a thread to expire the routes of origins that stopped advertising
+        self.monitor_thread = threading.Thread(target=self.monitor_routes)
         self.monitor_thread.start()
 
-    def receive_and_forward_timestamps(self):
-        """Listen for incoming timestamp messages."""
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind(('0.0.0.0', self.port))
-        server_socket.listen(5)
-        print(f"Client listening for timestamp messages on port {self.port}...")
-
-        while True:
-            client_socket, addr = server_socket.accept()
-            try:
-                data = client_socket.recv(1024).decode()
-                if not data:
-                    client_socket.close()
-                    continue
-
-                # Parse and update latency
-                data_parts = data.split(',', 1)
-                if len(data_parts) < 2:
-                    print(f"Invalid data format received from {addr}: {data}")
-                    client_socket.close()
-                    continue
-
-                sent_time = float(data_parts[0])
-                received_time = time.time()
-                latency = (received_time - sent_time) * 1000  # Convert to milliseconds
-                self.latency_manager.update_latency(addr[0], latency)
-
-                # Forward timestamp to neighbors
-                self.forward_timestamp_to_neighbours(data, addr[0])
-                client_socket.close()
-
-            except Exception as e:
-                print(f"Error while receiving or processing timestamp from {addr}: {e}")
-                client_socket.close()
-
-    def forward_timestamp_to_neighbours(self, data, original_sender):
-        """Forward the received timestamp to all neighbors except the original sender."""
-        for ip in self.vizinhos:
-            if ip == original_sender:
+    async def handle_adverts(self, adverts, addr):
+        """Update the route through the sending neighbour and forward adverts seen for the first time."""
+        for data in adverts:
+            advert = unpack_advert(data)
+            if advert is None:
+                print(f"Invalid advert received from {addr}")
                 continue
-            try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-                    client_socket.settimeout(5)
-                    client_socket.connect((ip, self.port))
-                    client_socket.send(data.encode())
-            except Exception as e:
-                print(f"Failed to forward message to {ip}. Error: {e}")
-
-    def monitor_stale_servers(self):
-        """Periodically check for and mark stale servers."""
+            origin_id, seq, _, path_cost, video_list, load = advert
+            self.latency_manager.catalog.update(origin_id, video_list)
+            self.latency_manager.update_load(origin_id, load)
+
+            # Every copy gives the cost of the route through the neighbour that sent it, unless
+            # we have no RTT for this link yet (or it is down) or the neighbour has no route itself
+            link_cost = self.prober.link_cost(addr[0])
+            if link_cost is not None and path_cost != float('inf'):
+                self.latency_manager.update_latency(addr[0], path_cost + link_cost, origin_id)
+
+            # Only the first copy is flooded further, so adverts never loop. It is flooded even
+            # without a route here, so the nodes behind us still learn the origin and its videos
+            if self.seen.is_new(origin_id, seq):
+                cost = self.latency_manager.best_cost(origin_id)
+                self.forward_advert_to_neighbours(data, addr[0], float('inf') if cost is None else cost)
+
+    def forward_advert_to_neighbours(self, data, original_sender, cost):
+        """Forward an advert with our best cost to its origin to all neighbors except the one it came from."""
+        data = forwarded(data, cost)
+        if data is None:
+            return
+        for ip in self.vizinhos:
+            if ip != original_sender:
+                self.channels.send(ip, [data])
+
+    def monitor_routes(self):
+        """Periodically expire stale routes."""
         while True:
-            self.latency_manager.mark_stale_servers()
+            self.latency_manager.expire_routes()
             time.sleep(self.check_interval)
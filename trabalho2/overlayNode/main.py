@@ -2,8 +2,18 @@ from server import OverlayNode
 import sys
 
 def main():
+    # Optional number of forwarding processes (see forwardpool.py), for hosts with several cores
+    workers = 0
+    if "--workers" in sys.argv:
+        index = sys.argv.index("--workers")
+        if index + 1 >= len(sys.argv) or not sys.argv[index + 1].isdigit():
+            print("Error: --workers expects a number.")
+            sys.exit(1)
+        workers = int(sys.argv[index + 1])
+        del sys.argv[index:index + 2]
+
     if "--ip" not in sys.argv or len(sys.argv) != 3:
-        print("Usage: python3 main.py --ip <BOOTSTRAPPER_IP_ADDRESS>")
+        print("Usage: python3 main.py --ip <BOOTSTRAPPER_IP_ADDRESS> [--workers <N>]")
         sys.exit(1)
 
 
@@ -11,7 +21,7 @@ def main():
     ip_address = sys.argv[ip_index + 1]
 
     #A porta 12346 vai ser sempre a porta da stream
-    server = OverlayNode(streaming_port=12346,bootstrapper_ip=ip_address)
+    server = OverlayNode(streaming_port=12346,bootstrapper_ip=ip_address,forwarding_workers=workers)
     server.start()
 
 if __name__ == "__main__":
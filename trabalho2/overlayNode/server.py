@@ -2,227 +2,346 @@ import socket
 import threading
 import time
 import sys
+from advert import LATENCY_PORT
+from control import CHANNEL_PORT, ControlPlane
+from expiry import ExpiryQueue
 from latency import LatencyManager, LatencyHandler
+from forwarding import Forwarder
+from forwardpool import ForwardingPool
+from framecache import FrameCache
+from nack import NACK_PORT, LossDetector, RetransmitBuffer, unpack_nack
+from feedback import FEEDBACK_INTERVAL, FEEDBACK_PORT, FeedbackAggregator, unpack_report
+from packet import video_id_for
+from switching import SwitchPolicy
+from handover import Handover
 
 
 class OverlayNode:
-    def __init__(self, streaming_port, bootstrapper_ip, control_port=13333,heartbeat_port=22222):
+    def __init__(self, streaming_port, bootstrapper_ip, control_port=13333,heartbeat_port=22222, forwarding_workers=0):
         self.streaming_port = streaming_port
         self.control_port = control_port
         self.heartbeat_port = heartbeat_port
 
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.server_socket.bind(("0.0.0.0", streaming_port))
+        if forwarding_workers > 1:
+            # Several forwarding processes share the stream port (see forwardpool.py); they are
+            # forked here, before any thread exists
+            self.forwarder = ForwardingPool(streaming_port, forwarding_workers)
+        else:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.server_socket.bind(("0.0.0.0", streaming_port))
+            # Forwarding fast path: one send socket and a lock-free subscriber snapshot (see forwarding.py)
+            self.forwarder = Forwarder(self.server_socket, streaming_port)
+            # The latest frames of every video, sent to every new subscriber before the live packets
+            self.forwarder.cache = FrameCache()
+            # Lost packets are NACKed to our upstream, and repaired for our subscribers (see nack.py)
+            self.forwarder.retransmit = RetransmitBuffer()
+            self.forwarder.loss = LossDetector()
 
         self.neighbours = self.get_neighbours(bootstrapper_ip, retry_interval=5, max_retries=10)
         print(f"Neighbours are: {self.neighbours}")
 
         # Shared state for managing streaming
-        self.video_client_map = {}  # Maps video names to sets of client IPs
-        self.client_heartbeat_map = {}  # Tracks last heartbeat timestamp for each client
+        self.video_client_map = {}  # Maps stream names (video or video@rendition) to sets of client IPs
+        self.video_names = {}  # Maps the numeric video ids found in stream packets to video names
+        self.client_heartbeats = ExpiryQueue(6)  # Heartbeat deadline of each client IP (6-second timeout)
+        self.client_videos = {}  # Maps each client IP to the videos it is watching
+        self.feedback = FeedbackAggregator()  # Receiver reports from downstream, merged per video
 
         self.lock = threading.Lock()
-        self.current_server = None  # Current best server
+        # Each video is streamed from its own upstream, the neighbour on the cheapest route to an
+        # origin that has the video (see catalog.py), so catalogs spread over several origins work
+        self.upstreams = {}  # Maps stream names to the upstream node they are requested from
+        self.switch_policies = {}  # Hysteresis for the upstream switches of each stream (see switching.py)
+        self.handovers = {}  # Upstream switches in progress per stream, both upstreams feed us until they complete
         self.last_heartbeat_time = time.time()  # Track last heartbeat timestamp
 
         # Initialize latency and stream managers
         self.latency_manager = LatencyManager()
-        self.latency_handler = LatencyHandler(13334, self.neighbours, self.latency_manager)
+        self.latency_handler = LatencyHandler(LATENCY_PORT, self.neighbours, self.latency_manager)
+        self.control_plane = ControlPlane("overlay-control")
+        self.control_channels = self.control_plane.channels()  # Persistent command channels to upstream nodes
 
     def start(self):
         """Start all overlay node operations in separate threads."""
         print(f"Overlay node listening on UDP port {self.streaming_port}")
-        threading.Thread(target=self.latency_handler.start).start()
-        threading.Thread(target=self.receive_control_data).start()
+        # Control, heartbeat and latency traffic share one event loop; forwarding keeps its own thread
+        self.latency_handler.start(self.control_plane)
+        self.control_plane.add_tcp(self.control_port, self.handle_control_data)
+        self.control_plane.add_channel(CHANNEL_PORT, self.handle_control_batch)
+        self.control_plane.add_tcp(self.heartbeat_port, self.handle_heartbeat)
+        self.control_plane.start()
         threading.Thread(target=self.retransmit_stream).start()
         threading.Thread(target=self.monitor_and_switch_server).start()
         threading.Thread(target=self.send_heartbeat).start()
-        threading.Thread(target=self.receive_heartbeat_requests).start()
         threading.Thread(target=self.check_client_heartbeats).start()
+        threading.Thread(target=self.receive_feedback).start()
+        threading.Thread(target=self.forward_feedback).start()
+        if self.forwarder.retransmit is not None:
+            threading.Thread(target=self.receive_nacks).start()
+            threading.Thread(target=self.report_repairs).start()
         
     def monitor_and_switch_server(self):
-        """Periodically checks for the best server based on latency and switches if necessary."""
+        """Periodically checks for the best upstream of every watched video and switches if necessary."""
         while True:
             time.sleep(10)  # Adjust the interval as needed
-            best_server_ip = self.latency_manager.get_best_server()
+            with self.lock:
+                active_videos = {video_name: self.upstreams.get(video_name)
+                                 for video_name, clients in self.video_client_map.items() if clients}
+            # A saturated origin keeps the videos it already serves but gets no new ones
+            video_costs = {video_name: self.latency_manager.video_costs(video_name, keep=upstream)
+                           for video_name, upstream in active_videos.items()}
 
+            starts, stops = {}, {}  # Server IP -> videos, so every server gets one batch
             with self.lock:
-                if best_server_ip and best_server_ip != self.current_server:
-                    #print(f"Switching to a better server: {best_server_ip}")
-                    
-                    # Send STOP_STREAM to the current server for all active videos
-                    if self.current_server:
-                        for video_name in self.video_client_map:
-                            self.send_control_command(self.current_server, f"STOP_STREAM {video_name}")
-
-                    # Update the current server and send START_STREAM commands for active videos
-                    self.current_server = best_server_ip
-                    for video_name in self.video_client_map:
-                        if self.video_client_map[video_name]:  # Only if clients are requesting the video
-                            self.send_control_command(best_server_ip, f"START_STREAM {video_name}")
+                for video_name, costs in video_costs.items():
+                    if self.video_client_map.get(video_name):
+                        self.switch_upstream(video_name, costs, starts, stops)
+
+            # Sent outside the lock so forwarding is never held up
+            for server_ip, video_names in starts.items():
+                self.control_channels.send(server_ip, [f"START_STREAM {video_name}" for video_name in video_names])
+            for server_ip, video_names in stops.items():
+                self.stop_upstream(server_ip, video_names)
+
+    def switch_upstream(self, video_name, costs, starts, stops):
+        """Move a video to a better upstream if its policy agrees, queueing the commands (caller holds lock)."""
+        policy = self.switch_policies.setdefault(video_name, SwitchPolicy())
+        previous_server = self.upstreams.get(video_name)
+        best_server_ip = policy.choose(previous_server, costs)
+        if not best_server_ip:
+            return
+        #print(f"Switching {video_name} to a better server: {best_server_ip}")
+        self.upstreams[video_name] = best_server_ip
+        starts.setdefault(best_server_ip, []).append(video_name)
+
+        # Make before break: the previous server keeps streaming until the new one delivers
+        superseded = self.handovers.pop(video_name, None)
+        if superseded and superseded.old != best_server_ip:
+            stops.setdefault(superseded.old, []).append(video_name)
+        if previous_server and isinstance(self.forwarder, ForwardingPool):
+            # The forwarding processes can not filter the two upstreams' packets, cut over at once
+            stops.setdefault(previous_server, []).append(video_name)
+        elif previous_server:
+            self.handovers[video_name] = Handover(previous_server, best_server_ip, [video_name], [video_name])
+        self.handovers_changed()
+
+    def upstream_for(self, video_name):
+        """The upstream a video is requested from, picked on first use (caller holds lock)."""
+        upstream = self.upstreams.get(video_name)
+        if upstream is None:
+            policy = self.switch_policies.setdefault(video_name, SwitchPolicy())
+            upstream = policy.choose(None, self.latency_manager.video_costs(video_name))
+            if upstream:
+                self.upstreams[video_name] = upstream
+        return upstream
+
+    def stop_upstream(self, server_ip, video_names):
+        """Stop videos at an upstream we switched away from."""
+        self.control_channels.send(server_ip, [f"STOP_STREAM {video_name}" for video_name in video_names])
 
     def send_heartbeat(self):
-        """Periodically send a 'heartbeat' message to the current server."""
+        """Periodically send a 'heartbeat' message to every upstream we stream from."""
         while True:
-            if self.current_server:
+            self.expire_handovers()
+            with self.lock:
+                upstreams = set(self.upstreams.values()) | {handover.old for handover in self.handovers.values()}
+            for server_ip in upstreams:
                 try:
                     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as heartbeat_socket:
-                        heartbeat_socket.connect((self.current_server, self.heartbeat_port))
+                        heartbeat_socket.connect((server_ip, self.heartbeat_port))
                         heartbeat_socket.sendall("HEARTBEAT".encode())
-                        #print(f"Sent HEARTBEAT to {self.current_server}.")
+                        #print(f"Sent HEARTBEAT to {server_ip}.")
                 except Exception as e:
-                    print(f"Failed to send 'HEARTBEAT' to {self.current_server}. Error: {e}")
+                    print(f"Failed to send 'HEARTBEAT' to {server_ip}. Error: {e}")
             time.sleep(2)  # Send heartbeat every 2 seconds
 
-    def receive_heartbeat_requests(self):
-        """Listen for heartbeat messages on a separate TCP port."""
-        heartbeat_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        heartbeat_socket.bind(("0.0.0.0", self.heartbeat_port))
-        heartbeat_socket.listen(5)
-        heartbeat_socket.settimeout(1)  # Set a timeout for the socket to prevent blocking indefinitely
-        print(f"Server listening for heartbeat messages on TCP port {self.heartbeat_port}...")
+    def handle_heartbeat(self, data, addr):
+        """Record a heartbeat received on the heartbeat port (does not need the main lock)."""
+        if data == "HEARTBEAT":
+            self.client_heartbeats.touch(addr[0])
+            #print(f"Heartbeat received from client {addr[0]}.")
 
-        while True:
-            try:
-                client_socket, addr = heartbeat_socket.accept()
-                with client_socket:
-                    data = client_socket.recv(1024).decode()
-                    if data == "HEARTBEAT":
-                        with self.lock:
-                            self.client_heartbeat_map[addr[0]] = time.time()
-                            #print(f"Heartbeat received from client {addr[0]}.")
-            except socket.timeout:
-                # Timeout reached; loop back to handle timeouts or new connections
-                pass
-            except Exception as e:
-                print(f"Error while handling heartbeat requests: {e}")
-    
     def check_client_heartbeats(self):
-        """Periodically check client heartbeats and remove stale clients."""
+        """Periodically remove the clients whose heartbeats stopped and stop their streams."""
         while True:
             try:
-                current_time = time.time()
-                stale_clients = []
-
-                with self.lock:
-                    # Find stale clients (based only on IP)
-                    for client_ip, last_heartbeat in self.client_heartbeat_map.items():
-                        if current_time - last_heartbeat > 6:  # 6-second timeout
-                            stale_clients.append(client_ip)
-
-                    # Remove stale clients and stop their streams
-                    for client_ip in stale_clients:
-                        for video_name, clients in self.video_client_map.items():
-                            # Iterate over the tuples in `clients`
-                            for client in list(clients):  # Convert to list to allow removal during iteration
-                                if client == client_ip:  # Compare only the IP portion
-                                    print(f"Client {client} removed from video {video_name} due to heartbeat timeout.")
-                                    self.remove_client_from_video(client_ip, video_name)
-
-                        del self.client_heartbeat_map[client_ip]  # Remove from heartbeat map
+                # Only the expired IPs are visited, and only the videos they are watching
+                for client_ip in self.client_heartbeats.expired():
+                    with self.lock:
+                        for video_name in list(self.client_videos.get(client_ip, ())):
+                            print(f"Client {client_ip} removed from video {video_name} due to heartbeat timeout.")
+                            self.remove_client_from_video(client_ip, video_name)
 
                 time.sleep(1)  # Check every second
             except Exception as e:
                 print(f"Error while checking client heartbeats: {e}")
 
-    def receive_control_data(self):
-        """Listen for incoming TCP control commands."""
-        control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        control_socket.bind(("0.0.0.0", self.control_port))
-        control_socket.listen(5)
-        print(f"Listening for control data on TCP port {self.control_port}...")
+    def receive_feedback(self):
+        """Collect receiver reports from downstream nodes and clients."""
+        feedback_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        feedback_socket.bind(("0.0.0.0", FEEDBACK_PORT))
+        print(f"Listening for receiver reports on UDP port {FEEDBACK_PORT}...")
 
         while True:
-            client_socket, addr = control_socket.accept()
-            #print(f"Control connection established with {addr}")
+            try:
+                data, addr = feedback_socket.recvfrom(1024)
+                report = unpack_report(data)
+                if report is not None:
+                    self.feedback.add(report)
+            except Exception as e:
+                print(f"Error while handling receiver report: {e}")
+
+    def receive_nacks(self):
+        """Repair the packets our subscribers NACK, from the packets we forwarded recently."""
+        nack_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        nack_socket.bind(("0.0.0.0", NACK_PORT))
+        print(f"Listening for NACKs on UDP port {NACK_PORT}...")
 
+        while True:
             try:
-                data = client_socket.recv(1024).decode().strip()
-                if not data:
-                    client_socket.close()
-                    continue
-                
-                with self.lock:
-                    command_parts = data.split()
-                    if len(command_parts) == 2:
-                        command = command_parts[0]
-                        video_name = command_parts[1]
-
-                        if command == "START_STREAM":
-                            print(f"Received START_STREAM for {video_name} from {addr}. Added to active clients.")
-                            self.add_client_to_video(addr[0], video_name)
-                        elif command == "STOP_STREAM":
-                            print(f"Received STOP_STREAM for {video_name} from {addr}. Removed from active clients.")
-                            self.remove_client_from_video(addr[0], video_name)
-                client_socket.close()
+                data, addr = nack_socket.recvfrom(2048)
+                nack = unpack_nack(data)
+                if nack is not None:
+                    self.forwarder.repair(addr[0], *nack)
             except Exception as e:
-                print(f"Error while handling control data from {addr}: {e}")
-                client_socket.close()
+                print(f"Error while handling NACK: {e}")
+
+    def report_repairs(self):
+        """Periodically print the packets repaired for us and by us."""
+        last = (0, 0, 0, 0, 0)
+        while True:
+            time.sleep(10)
+            loss, retransmit = self.forwarder.loss, self.forwarder.retransmit
+            counts = (loss.nacks_sent, loss.recovered, loss.unrecoverable, retransmit.repaired, retransmit.missed)
+            if counts != last:
+                print(f"Repairs: {counts[0]} NACKs sent, {counts[1]} packets recovered, {counts[2]} unrecoverable; "
+                      f"{counts[3]} packets resent downstream, {counts[4]} asked for but not held")
+                last = counts
+
+    def forward_feedback(self):
+        """Periodically send the merged receiver reports to our upstream server."""
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as feedback_socket:
+            while True:
+                time.sleep(FEEDBACK_INTERVAL)
+                reports = self.feedback.drain()
+                # Each video's report goes to the upstream that video is streamed from
+                with self.lock:
+                    upstreams = {video_id: self.upstreams.get(self.video_names.get(video_id)) for video_id in reports}
+                for video_id, report in reports.items():
+                    upstream = upstreams[video_id]
+                    if not upstream:
+                        continue
+                    try:
+                        feedback_socket.sendto(report, (upstream, FEEDBACK_PORT))
+                    except Exception as e:
+                        print(f"Failed to forward receiver report to {upstream}. Error: {e}")
+
+    def handle_control_data(self, data, addr):
+        """Handle a START_STREAM/STOP_STREAM command received on the control port."""
+        with self.lock:
+            command_parts = data.split()
+            if len(command_parts) == 2:
+                command = command_parts[0]
+                video_name = command_parts[1]
+
+                if command == "START_STREAM":
+                    print(f"Received START_STREAM for {video_name} from {addr}. Added to active clients.")
+                    self.add_client_to_video(addr[0], video_name)
+                elif command == "STOP_STREAM":
+                    print(f"Received STOP_STREAM for {video_name} from {addr}. Removed from active clients.")
+                    self.remove_client_from_video(addr[0], video_name)
+
+    def handle_control_batch(self, commands, addr):
+        """Handle a batch of commands received on a persistent control channel."""
+        for command in commands:
+            if command:
+                self.handle_control_data(command.decode(), addr)
 
     def add_client_to_video(self, client_ip, video_name):
         """Add a client to the list for a specific video and manage start commands."""
         if video_name not in self.video_client_map:
             self.video_client_map[video_name] = set()
+            self.video_names[video_id_for(video_name)] = video_name
 
         if client_ip not in self.video_client_map[video_name]:
             self.video_client_map[video_name].add(client_ip)
+            if not self.forwarder.set_subscribers(video_id_for(video_name), self.video_client_map[video_name]):
+                # The forwarding processes' table is full, refuse rather than forward to nobody
+                self.video_client_map[video_name].discard(client_ip)
+                print(f"Refused {client_ip} for {video_name}: no room in the forwarding table.")
+                return
+            self.client_videos.setdefault(client_ip, set()).add(video_name)
             #print(f"Added client {client_ip} to video {video_name}.")
 
             if len(self.video_client_map[video_name]) == 1:
-                # First client for this video, send START_STREAM command to the server
-                best_server_ip = self.latency_manager.get_best_server()
-                if best_server_ip:
-                    self.send_control_command(best_server_ip, f"START_STREAM {video_name}")
+                # First client for this video, send START_STREAM command to the closest origin that has it
+                upstream = self.upstream_for(video_name)
+                if upstream:
+                    self.send_control_command(upstream, f"START_STREAM {video_name}")
 
     def remove_client_from_video(self, client_ip, video_name):
         """Remove a client from the list for a specific video and manage stop commands."""
         if video_name in self.video_client_map:
             if client_ip in self.video_client_map[video_name]:
                 self.video_client_map[video_name].remove(client_ip)
+                self.forwarder.set_subscribers(video_id_for(video_name), self.video_client_map[video_name])
+                self.forget_client_video(client_ip, video_name)
                 print(f"Removed client {client_ip} from video {video_name}.")
 
                 if len(self.video_client_map[video_name]) == 0:
-                    # Last client for this video, send STOP_STREAM command to the server
-                    best_server_ip = self.latency_manager.get_best_server()
-                    if best_server_ip:
-                        self.send_control_command(best_server_ip, f"STOP_STREAM {video_name}")
+                    # Last client for this video, send STOP_STREAM command to the servers we stream it from
+                    upstream = self.upstreams.pop(video_name, None)
+                    if upstream:
+                        self.send_control_command(upstream, f"STOP_STREAM {video_name}")
+                    handover = self.handovers.pop(video_name, None)
+                    self.handovers_changed()
+                    if handover:
+                        self.send_control_command(handover.old, f"STOP_STREAM {video_name}")
+
+    def forget_client_video(self, client_ip, video_name):
+        """Drop a video from a client's subscriptions (caller holds lock)."""
+        videos = self.client_videos.get(client_ip)
+        if videos is not None:
+            videos.discard(video_name)
+            if not videos:
+                del self.client_videos[client_ip]
 
     def retransmit_stream(self):
-        """Retransmit UDP stream chunks to the clients requesting each video."""
-        while True:
-            try:
-                data, addr = self.server_socket.recvfrom(60000)
-
-                # Extract the video identifier (first 16 bytes)
-                video_id_length = 16  # Fixed length of video ID in the header
-                video_id = data[:video_id_length].decode('utf-8').strip()  # Decode and strip padding
-                with self.lock:
-                    if video_id in self.video_client_map:
-                        for client_ip in self.video_client_map[video_id]:
-                            self.forward_stream_data(client_ip, data)
-
-            except Exception as e:
-                print(f"Error during retransmission: {e}")
-
-    def forward_stream_data(self, target_ip, data):
-        """Forward the received data to the specified target IP via UDP."""
-        try:
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            client_socket.sendto(data, (target_ip, self.streaming_port))
-            client_socket.close()
-        except Exception as e:
-            print(f"Failed to forward data to {target_ip}. Error: {e}")
+        """Retransmit UDP stream chunks to the clients requesting each video (see forwarding.py)."""
+        self.forwarder.run()
+
+    def handovers_changed(self):
+        """Filter duplicates on the fast path only while a handover is in progress (caller holds lock)."""
+        self.forwarder.accept = self.accept_during_handover if self.handovers else None
+
+    def expire_handovers(self):
+        """Release the old upstream of handovers past their timeout, even if no packet arrives."""
+        with self.lock:
+            for video_name, handover in list(self.handovers.items()):
+                if handover.complete():
+                    del self.handovers[video_name]
+                    self.stop_upstream(handover.old, handover.video_names)
+            self.handovers_changed()
+
+    def accept_during_handover(self, video_id, source_ip, packet):
+        """While both upstreams of a video stream it, forward each of its packets once."""
+        video_name = self.video_names.get(video_id)
+        handover = self.handovers.get(video_name)
+        if handover is None:
+            return True
+        if not handover.accept(source_ip, packet):
+            return False
+        if handover.complete():
+            with self.lock:
+                if self.handovers.get(video_name) is handover:
+                    del self.handovers[video_name]
+                    self.handovers_changed()
+                    self.stop_upstream(handover.old, handover.video_names)
+        return True
 
     def send_control_command(self, target_ip, command):
-        """Send a control command to a specified node."""
-        try:
-            control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            control_socket.connect((target_ip, self.control_port))
-            control_socket.send(command.encode())
-            control_socket.close()
-            print(f"Sent '{command}' to {target_ip}")
-        except Exception as e:
-            print(f"Failed to send '{command}' to {target_ip}. Error: {e}")
+        """Queue a control command on the persistent channel to a specified node (never blocks)."""
+        self.control_channels.send(target_ip, [command])
 
     def get_neighbours(self, bootstrapper_ip, port=12222, retry_interval=5, max_retries=10):
         """Retrieve a list of neighbor nodes."""
@@ -0,0 +1,89 @@
+import collections
+import time
+
+# A switch recorded in the history: when, from and to which source, their costs and why
+SwitchEvent = collections.namedtuple('SwitchEvent', 'time previous chosen previous_cost chosen_cost reason flaps')
+
+
+class SwitchPolicy:
+    """Decide when to move to another source (upstream server, PoP), with hysteresis.
+
+    A healthier source must beat the current one by min_improvement_ms and by the fraction
+    min_improvement of the current cost, and not within hold_down seconds of the previous
+    switch. Every switch inside the last flap_window seconds beyond max_flaps doubles the
+    hold-down, so a noisy pair of sources settles instead of flapping. Losing the current
+    source (no cost or an infinite one) always switches at once.
+    """
+
+    def __init__(self, min_improvement=0.2, min_improvement_ms=5, hold_down=30, flap_window=300,
+                 max_flaps=3, history_size=100):
+        self.min_improvement = min_improvement
+        self.min_improvement_ms = min_improvement_ms
+        self.hold_down = hold_down
+        self.flap_window = flap_window
+        self.max_flaps = max_flaps
+        self.history = collections.deque(maxlen=history_size)  # Recent SwitchEvents, oldest first
+        self.switch_times = collections.deque()  # Monotonic times of the switches inside flap_window
+        self.last_switch = None
+
+    def choose(self, current, costs):
+        """Return the source to switch to, or None to stay on the current one.
+
+        costs maps every candidate to its current cost (lower is better).
+        """
+        candidates = {source: cost for source, cost in costs.items() if cost != float('inf')}
+        if not candidates:
+            return None
+        best = min(candidates, key=candidates.get)
+        if best == current:
+            return None
+
+        now = time.monotonic()
+        current_cost = candidates.get(current)
+        if current_cost is None:
+            reason = "initial" if current is None else "failover"
+            return self._switch(now, current, best, current_cost, candidates[best], reason)
+
+        improvement = current_cost - candidates[best]
+        if improvement < max(self.min_improvement_ms, self.min_improvement * current_cost):
+            return None
+        if self.last_switch is not None and now - self.last_switch < self.current_hold_down(now):
+            return None
+        return self._switch(now, current, best, current_cost, candidates[best], "better")
+
+    def flaps(self, now=None):
+        """Number of switches within the last flap_window seconds."""
+        now = time.monotonic() if now is None else now
+        while self.switch_times and now - self.switch_times[0] > self.flap_window:
+            self.switch_times.popleft()
+        return len(self.switch_times)
+
+    def current_hold_down(self, now=None):
+        excess = self.flaps(now) - self.max_flaps
+        return min(self.hold_down * 2 ** max(excess + 1, 0), self.flap_window) if excess >= 0 else self.hold_down
+
+    def _switch(self, now, previous, chosen, previous_cost, chosen_cost, reason):
+        self.last_switch = now
+        if reason != "initial":
+            self.switch_times.append(now)
+        event = SwitchEvent(time.time(), previous, chosen, previous_cost, chosen_cost, reason, self.flaps(now))
+        self.history.append(event)
+        print(f"Switch {reason}: {previous} ({_format_cost(previous_cost)}) -> {chosen} ({_format_cost(chosen_cost)}), "
+              f"{event.flaps} switches in the last {self.flap_window} s")
+        if event.flaps > self.max_flaps:
+            # The hold-down is being stretched: show what led here, to tune the thresholds
+            print(f"Flapping, hold-down now {self.current_hold_down(now)} s. Switch history:\n{self.format_history()}")
+        return chosen
+
+    def format_history(self):
+        """The switch history as text, one switch per line, for tuning the thresholds."""
+        return "\n".join(
+            f"{time.strftime('%H:%M:%S', time.localtime(event.time))} {event.reason:>8} "
+            f"{event.previous} ({_format_cost(event.previous_cost)}) -> {event.chosen} ({_format_cost(event.chosen_cost)}) "
+            f"flaps={event.flaps}"
+            for event in self.history
+        )
+
+
+def _format_cost(cost):
+    return "none" if cost is None else f"{cost:.2f} ms"
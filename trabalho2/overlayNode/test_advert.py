@@ -0,0 +1,43 @@
+import unittest
+from advert import ADVERT, ADVERT_VERSION, MAX_HOPS, AdvertFilter, forwarded, unpack_advert
+
+
+def advert(origin_id, seq, cost, videos, hops=0):
+    video_list = videos.encode()
+    return ADVERT.pack(ADVERT_VERSION, hops, origin_id, seq, cost, 0, 0, 0, 0, 0, len(video_list)) + video_list
+
+
+class AdvertFilterTest(unittest.TestCase):
+    def test_each_advert_is_new_once(self):
+        seen = AdvertFilter()
+        self.assertTrue(seen.is_new(1, 5))
+        self.assertFalse(seen.is_new(1, 5))
+        self.assertFalse(seen.is_new(1, 4))  # Older than the newest seen
+        self.assertTrue(seen.is_new(1, 6))
+
+    def test_origins_are_independent(self):
+        seen = AdvertFilter()
+        self.assertTrue(seen.is_new(1, 5))
+        self.assertTrue(seen.is_new(2, 1))
+        self.assertFalse(seen.is_new(2, 0))
+
+
+class ForwardedTest(unittest.TestCase):
+    def test_one_hop_further_with_our_cost(self):
+        origin_id, seq, hops, cost, videos, _ = unpack_advert(forwarded(advert(7, 3, 0.0, "a,b"), 12.5))
+        self.assertEqual((origin_id, seq, hops, cost, videos), (7, 3, 1, 12.5, "a,b"))
+
+    def test_stops_at_max_hops(self):
+        self.assertIsNone(forwarded(advert(7, 3, 0.0, "a", hops=MAX_HOPS), 1.0))
+
+    def test_unreachable_cost_is_carried(self):
+        self.assertEqual(unpack_advert(forwarded(advert(7, 3, 0.0, "a"), float('inf')))[3], float('inf'))
+
+    def test_malformed_adverts_are_rejected(self):
+        data = advert(7, 3, 0.0, "a,b")
+        self.assertIsNone(unpack_advert(data[:-1]))
+        self.assertIsNone(unpack_advert(b"\x00" + data[1:]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import socket
+import threading
+import time
+import unittest
+from forwarding import Forwarder
+from framecache import FrameCache
+from packet import HEADER, STREAM_VERSION
+
+
+def full_frame(video_id, frame_seq):
+    payload = b"frame"
+    return HEADER.pack(STREAM_VERSION, 0, video_id, frame_seq, 0, 0, 1, 0, 0, len(payload), len(payload)) + payload
+
+
+def wakeup_pending(forwarder):
+    try:
+        return bool(forwarder.wakeup_receiver.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT))
+    except BlockingIOError:
+        return False
+
+
+class ForwarderJoinTest(unittest.TestCase):
+    def setUp(self):
+        self.subscriber = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.subscriber.bind(("127.0.0.1", 0))
+        self.receive_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receive_socket.bind(("127.0.0.1", 0))
+        self.addCleanup(self.subscriber.close)
+        self.forwarder = Forwarder(self.receive_socket, self.subscriber.getsockname()[1])
+        self.forwarder.cache = FrameCache()
+        for video_id in (1, 2):
+            self.forwarder.cache.add(video_id, full_frame(video_id, 1))
+
+    def test_joins_wait_for_the_forwarding_loop(self):
+        self.assertTrue(self.forwarder.set_subscribers(1, ["127.0.0.1"]))
+        self.assertEqual(self.forwarder.table, {})
+        self.forwarder.send_joins()
+        self.assertEqual(self.forwarder.table, {1: (self.subscriber.getsockname(),)})
+        self.assertEqual(self.subscriber.recv(2048), full_frame(1, 1))
+
+    def test_wakeup_is_drained_when_the_joins_were_already_sent(self):
+        # Both joins are sent by one send_joins() call that ran before the loop read the wakeup bytes
+        self.forwarder.set_subscribers(1, ["127.0.0.1"])
+        self.forwarder.set_subscribers(2, ["127.0.0.1"])
+        self.forwarder.send_joins()
+        self.assertFalse(self.forwarder.joining)
+        self.assertTrue(wakeup_pending(self.forwarder))
+
+        threading.Thread(target=self.forwarder.run, daemon=True).start()
+        deadline = time.monotonic() + 1
+        while wakeup_pending(self.forwarder) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(wakeup_pending(self.forwarder))
+
+
+if __name__ == "__main__":
+    unittest.main()
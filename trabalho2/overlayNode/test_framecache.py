@@ -0,0 +1,45 @@
+import unittest
+from framecache import DELTA_MAGIC, FrameCache
+from packet import HEADER, STREAM_VERSION
+
+VIDEO = 42
+
+
+def frame(frame_seq, delta=False):
+    """A one-packet frame."""
+    payload = (DELTA_MAGIC if delta else b"FF") + bytes([frame_seq])
+    return HEADER.pack(STREAM_VERSION, 0, VIDEO, frame_seq, 0, 0, 1, 0, 0, len(payload), len(payload)) + payload
+
+
+class FrameCacheTest(unittest.TestCase):
+    def test_gop_from_the_last_full_frame(self):
+        cache = FrameCache()
+        for packet in (frame(1, delta=True), frame(2), frame(3, delta=True), frame(4), frame(5, delta=True)):
+            cache.add(VIDEO, packet)
+        self.assertEqual(cache.frames(VIDEO), (frame(4), frame(5, delta=True)))
+
+    def test_lost_delta_frame_drops_the_gop(self):
+        cache = FrameCache()
+        for packet in (frame(1), frame(2, delta=True), frame(4, delta=True)):
+            cache.add(VIDEO, packet)
+        self.assertEqual(cache.frames(VIDEO), ())
+        cache.add(VIDEO, frame(5, delta=True))
+        self.assertEqual(cache.frames(VIDEO), ())
+        cache.add(VIDEO, frame(6))
+        self.assertEqual(cache.frames(VIDEO), (frame(6),))
+
+    def test_late_frame_does_not_restore_the_gop(self):
+        cache = FrameCache()
+        for packet in (frame(1), frame(2, delta=True), frame(4, delta=True), frame(3, delta=True)):
+            cache.add(VIDEO, packet)
+        self.assertEqual(cache.frames(VIDEO), ())
+
+    def test_gop_longer_than_max_frames_is_dropped(self):
+        cache = FrameCache(max_frames=2)
+        for packet in (frame(1), frame(2, delta=True), frame(3, delta=True)):
+            cache.add(VIDEO, packet)
+        self.assertEqual(cache.frames(VIDEO), ())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import unittest
+from nack import NACK_RETRY, REORDER_DELAY, LossDetector, RetransmitBuffer, pack_nack, unpack_nack
+from packet import FLAG_PARITY, HEADER, STREAM_VERSION
+
+VIDEO = 42
+UPSTREAM = "10.0.0.1"
+
+
+def packet(frame_seq, packet_index, packet_count, flags=0):
+    timestamp_us = frame_seq * 33_333
+    return HEADER.pack(STREAM_VERSION, flags, VIDEO, frame_seq, timestamp_us, packet_index, packet_count,
+                       0, 0, 4, 4 * packet_count) + b"data"
+
+
+class NackMessageTest(unittest.TestCase):
+    def test_round_trip(self):
+        self.assertEqual(unpack_nack(pack_nack(VIDEO, 7, [1, 3])), (VIDEO, 7, (1, 3)))
+        self.assertEqual(unpack_nack(pack_nack(VIDEO, 7)), (VIDEO, 7, ()))
+
+    def test_malformed(self):
+        self.assertIsNone(unpack_nack(pack_nack(VIDEO, 7, [1, 3])[:-1]))
+        self.assertIsNone(unpack_nack(b""))
+
+
+class LossDetectorTest(unittest.TestCase):
+    def nacks(self, detector, now):
+        return [(source_ip, unpack_nack(message)) for source_ip, message in detector.poll(now)]
+
+    def nacks_after_delay(self, detector, now):
+        """A gap is only NACKed REORDER_DELAY after the first poll that sees it."""
+        self.assertEqual(self.nacks(detector, now), [])
+        return self.nacks(detector, now + REORDER_DELAY)
+
+    def test_gap_is_nacked_after_the_reorder_delay(self):
+        detector = LossDetector()
+        for index in (0, 2, 3):
+            detector.observe(UPSTREAM, packet(1, index, 4), now=0)
+        self.assertEqual(self.nacks_after_delay(detector, 0), [(UPSTREAM, (VIDEO, 1, (1,)))])
+        self.assertEqual(detector.nacks_sent, 1)
+
+    def test_late_packet_fills_the_gap_before_the_delay(self):
+        detector = LossDetector()
+        for index in (0, 2):
+            detector.observe(UPSTREAM, packet(1, index, 3), now=0)
+        self.assertEqual(self.nacks(detector, 0), [])
+        detector.observe(UPSTREAM, packet(1, 1, 3), now=0.001)
+        self.assertEqual(self.nacks(detector, REORDER_DELAY), [])
+        self.assertEqual(detector.nacks_sent, 0)
+
+    def test_nack_is_repeated_until_the_packet_arrives(self):
+        detector = LossDetector()
+        for index in (0, 2):
+            detector.observe(UPSTREAM, packet(1, index, 3), now=0)
+        self.assertEqual(len(self.nacks_after_delay(detector, 0)), 1)
+        self.assertEqual(self.nacks(detector, REORDER_DELAY + NACK_RETRY / 2), [])
+        self.assertEqual(len(self.nacks(detector, REORDER_DELAY + NACK_RETRY)), 1)
+        detector.observe(UPSTREAM, packet(1, 1, 3), now=0.04)
+        self.assertEqual(self.nacks(detector, 0.04), [])
+        self.assertEqual(detector.recovered, 1)
+        self.assertFalse(detector.waiting())
+
+    def test_tail_loss_is_nacked_once_the_next_frame_starts(self):
+        detector = LossDetector()
+        for index in (0, 1):
+            detector.observe(UPSTREAM, packet(1, index, 4), now=0)
+        self.assertEqual(self.nacks(detector, 0.01), [])  # Packets 2 and 3 may still be on their way
+        detector.observe(UPSTREAM, packet(2, 0, 1), now=0.02)
+        self.assertEqual(self.nacks_after_delay(detector, 0.02), [(UPSTREAM, (VIDEO, 1, (2, 3)))])
+
+    def test_skipped_frame_is_nacked_whole(self):
+        detector = LossDetector()
+        detector.observe(UPSTREAM, packet(1, 0, 1), now=0)
+        detector.observe(UPSTREAM, packet(3, 0, 1), now=0.01)
+        self.assertEqual(self.nacks_after_delay(detector, 0.01), [(UPSTREAM, (VIDEO, 2, ()))])
+
+    def test_parity_packets_are_not_data(self):
+        detector = LossDetector()
+        detector.observe(UPSTREAM, packet(1, 0, 2), now=0)
+        detector.observe(UPSTREAM, packet(1, 0, 2, flags=FLAG_PARITY), now=0)
+        self.assertEqual(self.nacks_after_delay(detector, 0), [])  # Tail unknown until frame 2
+        detector.observe(UPSTREAM, packet(2, 0, 1), now=0.01)
+        self.assertEqual(self.nacks_after_delay(detector, 0.01), [(UPSTREAM, (VIDEO, 1, (1,)))])
+
+    def test_gives_up_at_the_deadline(self):
+        detector = LossDetector()
+        for index in (0, 2):
+            detector.observe(UPSTREAM, packet(1, index, 3), now=0)
+        self.assertEqual(self.nacks(detector, 10), [])
+        self.assertEqual(detector.unrecoverable, 1)
+        self.assertFalse(detector.waiting())
+
+
+class RetransmitBufferTest(unittest.TestCase):
+    def test_returns_the_packets_asked_for(self):
+        buffer = RetransmitBuffer(window=1.0)
+        packets = [packet(1, index, 3) for index in range(3)]
+        for sent in packets:
+            buffer.add(sent, now=0)
+        buffer.add(packet(1, 0, 3, flags=FLAG_PARITY), now=0)
+        self.assertEqual(buffer.get(VIDEO, 1, (2, 5)), [packets[2]])
+        self.assertEqual(buffer.missed, 1)
+        self.assertEqual(buffer.get(VIDEO, 1, ()), packets)
+
+    def test_old_frames_expire(self):
+        buffer = RetransmitBuffer(window=1.0)
+        buffer.add(packet(1, 0, 1), now=0)
+        buffer.add(packet(2, 0, 1), now=2)
+        self.assertEqual(buffer.get(VIDEO, 1, ()), [])
+        self.assertEqual(len(buffer.get(VIDEO, 2, ())), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import contextlib
+import io
+import unittest
+from unittest import mock
+from switching import SwitchPolicy
+
+
+class SwitchPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        clock = mock.patch("switching.time.monotonic", side_effect=lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        output = contextlib.redirect_stdout(io.StringIO())  # The policy prints every switch
+        output.__enter__()
+        self.addCleanup(output.__exit__, None, None, None)
+
+    def test_initial_choice(self):
+        policy = SwitchPolicy()
+        self.assertEqual(policy.choose(None, {"a": 20, "b": 10}), "b")
+        self.assertEqual(policy.history[-1].reason, "initial")
+
+    def test_stays_within_the_hysteresis_margin(self):
+        policy = SwitchPolicy(min_improvement=0.2, min_improvement_ms=5, hold_down=0)
+        self.assertIsNone(policy.choose("a", {"a": 100, "b": 85}))  # 15 ms < 20% of 100 ms
+        self.assertIsNone(policy.choose("a", {"a": 10, "b": 6}))  # 4 ms < 5 ms
+        self.assertEqual(policy.choose("a", {"a": 100, "b": 79}), "b")
+
+    def test_hold_down_after_a_switch(self):
+        policy = SwitchPolicy(hold_down=30)
+        policy.choose(None, {"a": 100})
+        self.now += 10
+        self.assertIsNone(policy.choose("a", {"a": 100, "b": 10}))
+        self.now += 25
+        self.assertEqual(policy.choose("a", {"a": 100, "b": 10}), "b")
+
+    def test_failover_ignores_hold_down(self):
+        policy = SwitchPolicy(hold_down=30)
+        policy.choose(None, {"a": 10, "b": 50})
+        self.assertEqual(policy.choose("a", {"a": float('inf'), "b": 50}), "b")
+        self.assertEqual(policy.history[-1].reason, "failover")
+
+    def test_no_candidates(self):
+        policy = SwitchPolicy()
+        self.assertIsNone(policy.choose("a", {}))
+        self.assertIsNone(policy.choose("a", {"a": float('inf')}))
+
+    def test_flapping_stretches_the_hold_down(self):
+        policy = SwitchPolicy(hold_down=10, flap_window=300, max_flaps=2)
+        current = "a"
+        for _ in range(3):
+            self.now += 20  # Beyond the hold-down, which is already doubled before the third switch
+            current = policy.choose(current, {"a": 100, "b": 10} if current == "a" else {"a": 10, "b": 100})
+        self.assertEqual(policy.flaps(self.now), 3)
+        self.assertEqual(policy.current_hold_down(self.now), 40)
+        self.now += 30
+        self.assertIsNone(policy.choose(current, {"a": 10, "b": 100}))
+        self.assertEqual(len(policy.format_history().splitlines()), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import threading
+import time
+from framestore import FrameStore
+
+# Quality levels the origin can step through, best first: (width, height, JPEG quality).
+# The first level is the encoding every video is served with by default.
+QUALITY_LADDER = [(640, 480, 90), (640, 480, 75), (640, 480, 60), (480, 360, 60), (320, 240, 50)]
+
+
+def quality_levels(min_quality=50, min_width=320, tile_size=None):
+    """Ladder levels within the configured bounds (delta mode also needs tiles that fit the frame)."""
+    return [
+        (width, height, quality) for width, height, quality in QUALITY_LADDER
+        if quality >= min_quality and width >= min_width
+        and (not tile_size or (width % tile_size == 0 and height % tile_size == 0))
+    ]
+
+
+class RateController:
+    """Pick a quality level from the receiver reports aggregated by the overlay.
+
+    Steps down one level when loss or lateness crosses the congestion threshold, at most
+    once per hold_down seconds, and steps back up only after probe_after seconds without
+    congestion, so the level does not oscillate.
+    """
+
+    def __init__(self, level_count, congested_loss=0.05, congested_late=0.1, clear_loss=0.01,
+                 hold_down=4, probe_after=10):
+        self.level_count = level_count
+        self.congested_loss = congested_loss
+        self.congested_late = congested_late
+        self.clear_loss = clear_loss
+        self.hold_down = hold_down
+        self.probe_after = probe_after
+        self.level = 0
+        self.last_change = 0
+        self.last_congestion = 0
+
+    def update(self, report):
+        """Feed one aggregated report; return the new level if it changed, else None."""
+        _, received, lost, late, _, worst_loss, _ = report
+        if received + lost == 0:
+            return None
+        loss = max(worst_loss, lost / (received + lost))
+        late_fraction = late / received if received else 1.0
+        now = time.monotonic()
+
+        if loss > self.congested_loss or late_fraction > self.congested_late:
+            self.last_congestion = now
+            if self.level < self.level_count - 1 and now - self.last_change >= self.hold_down:
+                return self._change(self.level + 1, now, loss, late_fraction)
+        elif (loss < self.clear_loss and self.level > 0
+              and now - max(self.last_congestion, self.last_change) >= self.probe_after):
+            return self._change(self.level - 1, now, loss, late_fraction)
+        return None
+
+    def _change(self, level, now, loss, late_fraction):
+        print(f"Rate adaptation: level {self.level} -> {level} (loss {loss:.1%}, late {late_fraction:.1%})")
+        self.level = level
+        self.last_change = now
+        return level
+
+
+class QualitySwitcher:
+    """Serve every frame from the store of the selected quality level.
+
+    The base store drives the timing and the other levels hold the same frames at the
+    same indexes, so switching keeps the playback position. A level is ingested in the
+    background the first time it is selected and used once it is ready.
+    """
+
+    def __init__(self, video_path, store_dir, levels, store_options=None):
+        self.video_path = video_path
+        self.store_dir = store_dir
+        self.levels = levels
+        self.store_options = store_options or {}
+        self.stores = {}  # Level -> open FrameStore (the base level is never opened here)
+        self.loading = set()
+        self.lock = threading.Lock()
+        self.selected = 0  # Level chosen by the rate controller
+        self.level = 0  # Level currently served
+        # Delta frames only decode on top of their own keyframes, so switch on keyframes only
+        self.keyframe_interval = self.store_options.get("keyframe_interval") if self.store_options.get("tile_size") else None
+
+    def select(self, level):
+        self.selected = level
+        if level == 0:
+            return
+        with self.lock:
+            if level in self.stores or level in self.loading:
+                return
+            self.loading.add(level)
+        threading.Thread(target=self._load, args=(level,), daemon=True).start()
+
+    def _load(self, level):
+        width, height, quality = self.levels[level]
+        options = dict(self.store_options, width=width, height=height, quality=quality)
+        try:
+            store = FrameStore.open(self.video_path, self.store_dir, **options)
+        except Exception as e:
+            print(f"Failed to prepare quality level {level} for {self.video_path}. Error: {e}")
+            store = None
+        with self.lock:
+            self.loading.discard(level)
+            if store is not None:
+                self.stores[level] = store
+
+    def frame(self, index, base_frame):
+        """Return the frame at this index in the level that should be served."""
+        selected = self.selected
+        if selected != self.level and (selected == 0 or selected in self.stores):
+            if self.keyframe_interval is None or index % self.keyframe_interval == 0:
+                self.level = selected
+        if self.level == 0:
+            return base_frame
+        store = self.stores[self.level]
+        return store.frame(index)[0] if index < len(store) else base_frame
+
+    def close(self):
+        with self.lock:
+            stores, self.stores = self.stores, {}
+        self.level = 0
+        for store in stores.values():
+            store.close()
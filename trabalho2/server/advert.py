@@ -0,0 +1,49 @@
+import collections
+import struct
+
+# Latency adverts are flooded from every origin through the overlay over persistent channels
+# (see control.py) on the latency port. Each one carries the id of the origin that created it and
+# a per-origin sequence number, so every node forwards a given advert at most once, whatever
+# the number of paths or cycles it arrives through: control traffic grows with the links,
+# not with the paths.
+#
+# Adverts also carry distance-vector routes: the path cost is the sender's best cumulative
+# cost to the origin in milliseconds, the origin advertising 0. A receiver adds the cost of
+# the link it arrived on (measured by probe.py) to get the cost of the route through that
+# neighbour, and forwards its own best cost (infinite while it has no route itself).
+#
+# The origin also reports its load, copied unchanged by every hop, so nodes can steer new
+# subscriptions away from busy origins: streams with subscribers, subscribers over all streams,
+# egress bytes/s and frames its senders skipped because they fell behind, since the previous
+# advert. LOAD_SATURATED is set once the origin is at one of its configured caps.
+#
+#   version, hop count, origin id, sequence number, path cost (ms),
+#   load flags, active streams, subscribers, egress bytes/s, deadline misses, size of the video list
+ADVERT = struct.Struct('>BBIIdBHIIIH')
+ADVERT_VERSION = 3
+LATENCY_PORT = 13334
+MAX_HOPS = 32  # Adverts are not forwarded any further than this
+LOAD_SATURATED = 0x01
+
+OriginLoad = collections.namedtuple('OriginLoad', 'streams subscribers egress deadline_misses saturated')
+NO_LOAD = OriginLoad(0, 0, 0, 0, False)
+
+
+def pack_advert(origin_id, seq, cost, videos, hops=0, load=NO_LOAD):
+    video_list = ",".join(videos).encode()
+    flags = LOAD_SATURATED if load.saturated else 0
+    return ADVERT.pack(
+        ADVERT_VERSION, hops, origin_id, seq, cost, flags, min(load.streams, 0xFFFF),
+        *(min(int(value), 0xFFFFFFFF) for value in (load.subscribers, load.egress, load.deadline_misses)),
+        len(video_list)
+    ) + video_list
+
+
+def forwarded(data, cost):
+    """The same advert one hop further with our path cost, or None if it has travelled MAX_HOPS."""
+    fields = list(ADVERT.unpack_from(data))
+    if fields[1] + 1 > MAX_HOPS:
+        return None
+    fields[1] += 1
+    fields[4] = cost
+    return ADVERT.pack(*fields) + data[ADVERT.size:]
@@ -0,0 +1,255 @@
+import asyncio
+import inspect
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Control messages are short text commands ("START_STREAM videoA", "HEARTBEAT", latency adverts);
+# TCP senders write one message and close the connection.
+MAX_MESSAGE_SIZE = 1024
+READ_TIMEOUT = 5  # Seconds a TCP peer gets to deliver its message before it is dropped
+
+# Between overlay hops, commands and latency adverts travel over one persistent connection per
+# neighbour pair and port. Each frame is a 4-byte big-endian length followed by a batch of
+# messages, each prefixed with its 2-byte length (commands are UTF-8 text, adverts are binary);
+# the receiver answers every batch with an "OK" frame once it has been handled.
+CHANNEL_PORT = 13337
+FRAME_LENGTH = struct.Struct('>I')
+MESSAGE_LENGTH = struct.Struct('>H')
+MAX_FRAME_SIZE = 1 << 16
+MAX_CHANNEL_MESSAGE = MAX_FRAME_SIZE - MESSAGE_LENGTH.size  # Larger messages can not be sent on a channel
+ACK_TIMEOUT = 5  # Seconds to wait for the "OK" before the connection is considered dead
+RECONNECT_INTERVAL = 1
+
+
+def encode_message(item):
+    return item.encode() if isinstance(item, str) else item
+
+
+def pack_frame(messages):
+    body = b"".join(MESSAGE_LENGTH.pack(len(message)) + message for message in map(encode_message, messages))
+    return FRAME_LENGTH.pack(len(body)) + body
+
+
+async def read_frame(reader):
+    """Read one frame and return its messages as bytes."""
+    size, = FRAME_LENGTH.unpack(await reader.readexactly(FRAME_LENGTH.size))
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f"Control frame of {size} bytes is too large")
+    body = await reader.readexactly(size)
+    messages = []
+    offset = 0
+    while offset < size:
+        length, = MESSAGE_LENGTH.unpack_from(body, offset)
+        offset += MESSAGE_LENGTH.size
+        if offset + length > size:
+            raise ValueError("Truncated control message")
+        messages.append(body[offset:offset + length])
+        offset += length
+    return messages
+
+
+class ControlPlane:
+    """Serve the control ports of a node from one asyncio event loop on its own thread.
+
+    Each port gets a handler called as handler(message, addr). Coroutine handlers run on
+    the event loop. Plain handlers run on the port's own thread pool, because they take
+    the node lock and may block on upstream I/O. A slow or half-open peer only holds its
+    own connection, and a busy port can not delay the commands of another one.
+    """
+
+    def __init__(self, name="control", handler_threads=8):
+        self.name = name
+        self.handler_threads = handler_threads
+        self.loop = asyncio.new_event_loop()
+        self.listeners = []  # (protocol, port, handler, executor)
+        self.tasks = []  # Coroutine functions started with the loop
+
+    def add_tcp(self, port, handler):
+        self.listeners.append(("tcp", port, handler, self._executor(handler, port)))
+
+    def add_datagram(self, port, protocol):
+        """Serve a UDP port with an asyncio DatagramProtocol instance of its own (e.g. probe.Prober)."""
+        self.listeners.append(("datagram", port, protocol, None))
+
+    def add_channel(self, port, handler):
+        """Accept persistent control channels; the handler gets each batch as a list of messages (bytes)."""
+        self.listeners.append(("channel", port, handler, self._executor(handler, port)))
+
+    def spawn(self, coroutine_function, *args):
+        """Run a long-lived coroutine (e.g. a periodic sender) on the control loop."""
+        self.tasks.append((coroutine_function, args))
+
+    def start(self):
+        ready = threading.Event()
+        threading.Thread(target=self._run, args=(ready,), name=self.name, daemon=True).start()
+        ready.wait()
+
+    def _executor(self, handler, port):
+        if inspect.iscoroutinefunction(handler):
+            return None
+        return ThreadPoolExecutor(self.handler_threads, thread_name_prefix=f"{self.name}-{port}")
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._listen())
+        finally:
+            ready.set()
+        self.loop.run_forever()
+
+    async def _listen(self):
+        for protocol, port, handler, executor in self.listeners:
+            if protocol in ("tcp", "channel"):
+                serve = self._serve_connection if protocol == "tcp" else self._serve_channel
+                await asyncio.start_server(
+                    lambda reader, writer, serve=serve, handler=handler, executor=executor:
+                        serve(reader, writer, handler, executor),
+                    "0.0.0.0", port, backlog=1024
+                )
+                print(f"Listening for control data on TCP port {port}...")
+            else:
+                await self.loop.create_datagram_endpoint(lambda protocol=handler: protocol, local_addr=("0.0.0.0", port))
+                print(f"Listening on UDP port {port}...")
+        for coroutine_function, args in self.tasks:
+            self.loop.create_task(coroutine_function(*args))
+
+    async def _serve_connection(self, reader, writer, handler, executor):
+        addr = writer.get_extra_info("peername")
+        data = b""
+        try:
+            # Read until the peer closes, as the senders do after their message, or until the
+            # timeout, after which whatever arrived is handled as the message
+            while len(data) < MAX_MESSAGE_SIZE:
+                chunk = await asyncio.wait_for(reader.read(MAX_MESSAGE_SIZE - len(data)), READ_TIMEOUT)
+                if not chunk:
+                    break
+                data += chunk
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+        if data:
+            await self.dispatch(handler, executor, data.decode(errors="replace").strip(), addr)
+
+    async def _serve_channel(self, reader, writer, handler, executor):
+        addr = writer.get_extra_info("peername")
+        try:
+            while True:
+                commands = await read_frame(reader)
+                await self.dispatch(handler, executor, commands, addr)
+                writer.write(pack_frame(["OK"]))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass  # The peer closed the channel or broke the framing; it reconnects on its own
+        finally:
+            writer.close()
+
+    def channels(self, port=CHANNEL_PORT, max_pending=None, verbose=True):
+        """Return ControlChannels that send from this control plane's loop."""
+        return ControlChannels(self.loop, port, max_pending, verbose)
+
+    async def dispatch(self, handler, executor, message, addr):
+        """Run a handler on a message and return its reply."""
+        try:
+            if executor is None:
+                return await handler(message, addr)
+            return await self.loop.run_in_executor(executor, handler, message, addr)
+        except Exception as e:
+            print(f"Error while handling control data from {addr}: {e}")
+
+
+class ControlChannels:
+    """Persistent control connections to neighbours, one per neighbour.
+
+    send() can be called from any thread and never blocks. Messages queued while a batch is
+    in flight go out together in the next frame, so switching every video upstream costs
+    one round trip. A batch is kept until the neighbour acknowledges it and is sent again
+    after a reconnect, which is safe because START_STREAM and STOP_STREAM are idempotent
+    per node and adverts are deduplicated. With max_pending, only the newest messages are
+    kept while a neighbour is unreachable. Batches larger than a frame go out as several
+    frames; a single message over MAX_CHANNEL_MESSAGE bytes is refused by send().
+    """
+
+    def __init__(self, loop, port=CHANNEL_PORT, max_pending=None, verbose=True):
+        self.loop = loop
+        self.port = port
+        self.max_pending = max_pending
+        self.verbose = verbose  # Print every delivered batch
+        self.pending = {}  # Neighbour IP -> messages not yet sent (only touched on the loop)
+        self.wakeups = {}  # Neighbour IP -> Event set when messages are queued
+
+    def send(self, ip, messages):
+        messages = [message for message in messages if self._fits(ip, message)]
+        if messages:
+            self.loop.call_soon_threadsafe(self._enqueue, ip, messages)
+
+    @staticmethod
+    def _fits(ip, message):
+        size = len(encode_message(message))
+        if size > MAX_CHANNEL_MESSAGE:
+            print(f"Not sending a control message of {size} bytes to {ip}, the limit is {MAX_CHANNEL_MESSAGE}.")
+            return False
+        return True
+
+    def _next_batch(self, ip):
+        """Take the pending messages of a neighbour that fit in one frame (only called on the loop)."""
+        pending = self.pending[ip]
+        size = 0
+        count = 0
+        for message in pending:
+            size += MESSAGE_LENGTH.size + len(encode_message(message))
+            if size > MAX_FRAME_SIZE:
+                break
+            count += 1
+        batch, self.pending[ip] = pending[:count], pending[count:]
+        if self.pending[ip]:
+            self.wakeups[ip].set()  # The rest goes in the next frame
+        return batch
+
+    def _enqueue(self, ip, messages):
+        if ip not in self.pending:
+            self.pending[ip] = []
+            self.wakeups[ip] = asyncio.Event()
+            self.loop.create_task(self._run(ip))
+        pending = self.pending[ip]
+        pending.extend(messages)
+        if self.max_pending is not None and len(pending) > self.max_pending:
+            del pending[:-self.max_pending]
+        self.wakeups[ip].set()
+
+    async def _run(self, ip):
+        """Keep the channel to one neighbour open and deliver its batches in order."""
+        wakeup = self.wakeups[ip]
+        batch = []  # Sent but not acknowledged yet
+        while True:
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, self.port), ACK_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as e:
+                print(f"Failed to open control channel to {ip}. Error: {e}")
+                await asyncio.sleep(RECONNECT_INTERVAL)
+                continue
+
+            try:
+                while True:
+                    if not batch:
+                        await wakeup.wait()
+                        wakeup.clear()
+                        batch = self._next_batch(ip)
+                        if not batch:
+                            continue
+                    writer.write(pack_frame(batch))
+                    await writer.drain()
+                    await asyncio.wait_for(read_frame(reader), ACK_TIMEOUT)
+                    if self.verbose:
+                        print(f"Sent {batch} to {ip}")
+                    batch = []
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError) as e:
+                print(f"Control channel to {ip} lost, reconnecting. Error: {e!r}")
+            except Exception as e:
+                # Keep the channel alive; the batch that caused this would only fail again
+                print(f"Control channel to {ip} failed, dropping {len(batch)} messages and reconnecting. Error: {e!r}")
+                batch = []
+            finally:
+                writer.close()
+            await asyncio.sleep(RECONNECT_INTERVAL)
@@ -0,0 +1,66 @@
+import struct
+
+import cv2
+import numpy as np
+
+# Delta frames start with this header instead of the JPEG SOI marker (0xFFD8), so receivers can
+# tell them apart from full frames. Each changed tile follows as TILE_HEADER + JPEG bytes.
+DELTA_MAGIC = b'DT'
+DELTA_HEADER = struct.Struct('>2sHHHH')  # magic, tile size, frame width, frame height, tile count
+TILE_HEADER = struct.Struct('>HHI')  # tile column, tile row, JPEG size
+
+
+class DeltaEncoder:
+    """Encode frames as a full JPEG keyframe or as JPEGs of the tiles that changed.
+
+    Tiles are compared against what the receiver has reconstructed so far (the decoded
+    JPEGs of the keyframe and of the tiles sent since), not against the previous source
+    frame, so small changes below the threshold and JPEG losses can not accumulate into
+    visible drift between keyframes.
+    """
+
+    def __init__(self, width, height, quality=90, tile_size=80, keyframe_interval=30, threshold=8):
+        if width % tile_size or height % tile_size:
+            raise ValueError(f"Tile size {tile_size} must divide the frame size {width}x{height}")
+        self.width = width
+        self.height = height
+        self.quality = quality
+        self.tile_size = tile_size
+        self.keyframe_interval = keyframe_interval
+        self.threshold = threshold
+        self.rows = height // tile_size
+        self.cols = width // tile_size
+        self.reference = None  # Frame as reconstructed by the receiver
+        self.frames_since_keyframe = 0
+
+    def encode(self, frame):
+        """Return the payload for a resized BGR frame."""
+        if self.reference is None or self.frames_since_keyframe >= self.keyframe_interval:
+            keyframe = self._jpeg(frame)
+            self.reference = self._decode(keyframe)
+            self.frames_since_keyframe = 1
+            return keyframe
+        self.frames_since_keyframe += 1
+
+        # Largest per-pixel difference inside each tile, computed for all tiles at once
+        diff = np.maximum(frame, self.reference) - np.minimum(frame, self.reference)
+        tile_diff = diff.reshape(self.rows, self.tile_size, self.cols, self.tile_size, -1).max(axis=(1, 3, 4))
+        changed = np.argwhere(tile_diff > self.threshold)
+
+        parts = [DELTA_HEADER.pack(DELTA_MAGIC, self.tile_size, self.width, self.height, len(changed))]
+        for row, col in changed:
+            y, x = row * self.tile_size, col * self.tile_size
+            tile_data = self._jpeg(frame[y:y + self.tile_size, x:x + self.tile_size])
+            self.reference[y:y + self.tile_size, x:x + self.tile_size] = self._decode(tile_data)
+            parts.append(TILE_HEADER.pack(col, row, len(tile_data)))
+            parts.append(tile_data)
+        return b''.join(parts)
+
+    def _jpeg(self, image):
+        _, img_encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return img_encoded.tobytes()
+
+    @staticmethod
+    def _decode(data):
+        """The pixels the receiver gets out of one of our JPEGs."""
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
@@ -0,0 +1,26 @@
+from packet import FLAG_PARITY
+
+# Forward error correction: after the data packets of a frame, the sender adds one XOR parity
+# packet per group of K consecutive data packets. The receiver can rebuild any single lost
+# packet of a group from the parity and the other members, without asking for a retransmission.
+#
+# Parity packets carry FLAG_PARITY, the group index as their packet index and K in the
+# FEC group size field of the stream header (see packet.py).
+
+
+def xor_parity(chunks):
+    """XOR of the chunks, each zero-padded on the right to the longest one."""
+    size = max(len(chunk) for chunk in chunks)
+    acc = 0
+    for chunk in chunks:
+        acc ^= int.from_bytes(chunk, 'big') << (8 * (size - len(chunk)))
+    return acc.to_bytes(size, 'big')
+
+
+def protect(chunks, group_size):
+    """Return (flags, packet_index, payload) triples: every data chunk followed by one parity per group."""
+    packets = [(0, packet_index, chunk) for packet_index, chunk in enumerate(chunks)]
+    if group_size:
+        for group, start in enumerate(range(0, len(chunks), group_size)):
+            packets.append((FLAG_PARITY, group, xor_parity(chunks[start:start + group_size])))
+    return packets
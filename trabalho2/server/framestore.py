@@ -0,0 +1,228 @@
+import mmap
+import os
+import struct
+import sys
+import time
+
+import cv2
+from delta import DeltaEncoder
+
+# Index layout: one header followed by one entry per frame
+INDEX_MAGIC = b'ESRF'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('>4sIdI')  # magic, version, fps, frame count
+INDEX_ENTRY = struct.Struct('>QId')  # offset into the data file, frame size, timestamp (seconds)
+
+
+class FrameStore:
+    """Pre-encoded frames of one video, memory-mapped from disk.
+
+    The data file holds every encoded frame back to back and the index file holds the
+    offset, size and timestamp of each one, so the live loop only slices the mapping.
+    """
+
+    def __init__(self, data_path, index_path):
+        self.data_path = data_path
+        self.index_path = index_path
+
+        with open(index_path, 'rb') as index_file:
+            index = index_file.read()
+        magic, version, self.fps, frame_count = INDEX_HEADER.unpack_from(index)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"Unsupported frame store index: {index_path}")
+        self.entries = list(INDEX_ENTRY.iter_unpack(index[INDEX_HEADER.size:]))
+        if len(self.entries) != frame_count or not self.entries:
+            raise ValueError(f"Corrupted frame store index: {index_path}")
+
+        self.data_file = open(data_path, 'rb')
+        self.mapping = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mapping)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def frame(self, index):
+        """Return (frame_bytes_view, timestamp) for a frame without copying it."""
+        offset, size, timestamp = self.entries[index]
+        return self.view[offset:offset + size], timestamp
+
+    @property
+    def duration(self):
+        """Length of one loop of the video, in seconds."""
+        return self.entries[-1][2] + 1.0 / self.fps
+
+    @property
+    def max_frame_size(self):
+        """Size of the largest frame in the store, in bytes."""
+        return max(size for _, size, _ in self.entries)
+
+    def play(self, publish, position=0, active=None):
+        """Call publish(frame_data, index) for every frame at the video's own pace, looping over the video.
+
+        Playback starts at frame `position`. When an `active` event is given, playback
+        stops as soon as it is cleared and the index of the next frame is returned.
+        """
+        index = position
+        loop_start = time.monotonic() - self.entries[index][2]
+
+        while active is None or active.is_set():
+            frame_data, timestamp = self.frame(index)
+
+            # Delay to sync with video FPS
+            delay = loop_start + timestamp - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -1:
+                # We fell far behind (e.g. the host was suspended), resync instead of bursting
+                loop_start = time.monotonic() - timestamp
+
+            publish(frame_data, index)
+
+            index += 1
+            if index == len(self):
+                # Restart the video if it reaches the end
+                index = 0
+                loop_start += self.duration
+
+        return index
+
+    def close(self):
+        self.view.release()
+        try:
+            self.mapping.close()
+        except BufferError:
+            pass  # A frame slice is still being sent; the mapping is freed together with it
+        self.data_file.close()
+
+    @staticmethod
+    def default_dir(video_path):
+        """Default store location: a .framestore directory next to the video."""
+        return os.path.join(os.path.dirname(os.path.abspath(video_path)), '.framestore')
+
+    @staticmethod
+    def paths(video_path, store_dir, width=640, height=480, quality=90, tile_size=None, keyframe_interval=30):
+        """Data and index file names for a video encoded with the given settings (width None keeps the native size)."""
+        name = os.path.splitext(os.path.basename(video_path))[0]
+        size = f"{width}x{height}" if width else "native"
+        base = os.path.join(store_dir, f"{name}_{size}_q{quality}")
+        if tile_size:
+            base += f"_t{tile_size}k{keyframe_interval}"
+        return base + '.frames', base + '.idx'
+
+    @classmethod
+    def is_fresh(cls, video_path, store_dir, **encoding):
+        """True if the store for these settings exists and is newer than the video."""
+        data_path, index_path = cls.paths(video_path, store_dir, **encoding)
+        return (os.path.exists(index_path) and os.path.exists(data_path)
+                and os.path.getmtime(index_path) >= os.path.getmtime(video_path))
+
+    @classmethod
+    def open(cls, video_path, store_dir, **encoding):
+        """Open the store for a video, transcoding it first if the store is missing or stale."""
+        if not cls.is_fresh(video_path, store_dir, **encoding):
+            cls.ingest(video_path, store_dir, [encoding])
+        return cls(*cls.paths(video_path, store_dir, **encoding))
+
+    @classmethod
+    def prepare(cls, video_path, store_dir, encodings):
+        """Make sure a store exists for every encoding, transcoding the stale ones in one decode pass."""
+        stale = [encoding for encoding in encodings if not cls.is_fresh(video_path, store_dir, **encoding)]
+        if stale:
+            cls.ingest(video_path, store_dir, stale)
+
+    @classmethod
+    def ingest(cls, video_path, store_dir, encodings=({},)):
+        """Decode every frame of a video once and write one store per encoding.
+
+        An encoding holds the FrameStore.paths settings: output size, JPEG quality and,
+        with a tile_size, changed-tile delta frames (see delta.py) with a full keyframe
+        every keyframe_interval frames.
+        """
+        os.makedirs(store_dir, exist_ok=True)
+
+        cap = cv2.VideoCapture(video_path)
+        if not cap.isOpened():
+            raise ValueError(f"Error opening video file: {video_path}")
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30
+
+        writers = [StoreWriter(*cls.paths(video_path, store_dir, **encoding), **encoding) for encoding in encodings]
+        print(f"Ingesting {video_path} into frame stores {[writer.data_path for writer in writers]}...")
+        frame_count = 0
+        try:
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                timestamp = frame_count / fps
+                for writer in writers:
+                    writer.write(frame, timestamp)
+                frame_count += 1
+        finally:
+            cap.release()
+            for writer in writers:
+                writer.close()
+
+        if not frame_count:
+            for writer in writers:
+                writer.discard()
+            raise ValueError(f"No frames could be read from {video_path}")
+
+        for writer in writers:
+            writer.commit(fps)
+        print(f"Stored {frame_count} frames for {video_path}")
+
+
+class StoreWriter:
+    """Encode frames with one set of settings and write them to a new frame store."""
+
+    def __init__(self, data_path, index_path, width=640, height=480, quality=90, tile_size=None, keyframe_interval=30):
+        self.data_path = data_path
+        self.index_path = index_path
+        self.size = (width, height) if width else None
+        self.quality = quality
+        self.tile_size = tile_size
+        self.keyframe_interval = keyframe_interval
+        self.encoder = None
+        self.entries = []
+        self.offset = 0
+        # Write to temporary files first so a crash never leaves a half-written store behind
+        self.data_file = open(data_path + '.tmp', 'wb')
+
+    def write(self, frame, timestamp):
+        if self.size:
+            frame = cv2.resize(frame, self.size)
+        if self.tile_size:
+            if self.encoder is None:
+                height, width = frame.shape[:2]
+                self.encoder = DeltaEncoder(width, height, self.quality, self.tile_size, self.keyframe_interval)
+            frame_data = self.encoder.encode(frame)
+        else:
+            _, img_encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            frame_data = img_encoded.tobytes()
+        self.data_file.write(frame_data)
+        self.entries.append(INDEX_ENTRY.pack(self.offset, len(frame_data), timestamp))
+        self.offset += len(frame_data)
+
+    def close(self):
+        self.data_file.close()
+
+    def discard(self):
+        os.remove(self.data_path + '.tmp')
+
+    def commit(self, fps):
+        with open(self.index_path + '.tmp', 'wb') as index_file:
+            index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, fps, len(self.entries)))
+            index_file.write(b''.join(self.entries))
+        os.replace(self.data_path + '.tmp', self.data_path)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+
+if __name__ == "__main__":
+    # Warm the store ahead of time: python3 framestore.py --store <dir> <video_path1> [<video_path2> ...]
+    if "--store" not in sys.argv or len(sys.argv) < 4:
+        print("Usage: python3 framestore.py --store <STORE_DIR> <video_path1> [<video_path2> ... <video_pathN>]")
+        sys.exit(1)
+    store_index = sys.argv.index("--store")
+    store_dir = sys.argv[store_index + 1]
+    for path in sys.argv[1:store_index] + sys.argv[store_index + 2:]:
+        FrameStore.ingest(path, store_dir)
@@ -1,44 +1,36 @@
-import time
-import threading
-import socket
+import asyncio
+import random
+from advert import NO_LOAD, pack_advert
 
 class LatencyHandler:
-    def __init__(self, port, vizinhos, available_videos):
+    def __init__(self, port, vizinhos, available_videos, interval=10, load=None):
         self.port = port
         self.vizinhos = vizinhos
         # Initialize with a list of available videos
         self.available_videos = available_videos if available_videos else []
+        self.interval = interval  # Seconds between rounds of adverts
+        self.load = load  # Returns our OriginLoad since the previous round (None advertises no load)
+        # Identifies this origin's adverts; a restarted origin starts over with a new id and sequence
+        self.origin_id = random.getrandbits(32)
+        self.seq = 0
+        self.channels = None
 
-    def start(self):
-        self.latency_thread = threading.Thread(target=self.sendLatencyStarter)
-        self.latency_thread.start()
+    def start(self, control_plane):
+        """Send adverts over persistent channels from the control plane loop."""
+        # While a neighbour is unreachable only the newest adverts are kept for it
+        self.channels = control_plane.channels(self.port, max_pending=4, verbose=False)
+        control_plane.spawn(self.send_adverts)
 
-    def sendLatencyStarter(self):
+    async def send_adverts(self):
+        """Send an advert with the video list to every neighbour, every interval seconds."""
         while True:
+            self.seq += 1
+            # The load figures take the server lock, so they are gathered off the event loop
+            load = await asyncio.get_running_loop().run_in_executor(None, self.load) if self.load else NO_LOAD
+            advert = pack_advert(self.origin_id, self.seq, 0.0, self.available_videos, load=load)  # We are the origin
             for ip in self.vizinhos:
-                try:
-                    # Create a TCP connection to the client
-                    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    client_socket.settimeout(5)  # Set a 5-second timeout for the connection attempt
-                    client_socket.connect((ip, self.port))
-    
-                    # Prepare the message with the timestamp and available videos
-                    timestamp = str(time.time())
-                    video_list_str = ",".join(self.available_videos)
-                    message = f"{timestamp},{video_list_str}"  # Format: "TIMESTAMP,video1,video2,..."
-    
-                    # Send the combined message
-                    client_socket.send(message.encode())
-                    #print(f"Sent latency initiation message with video list to {ip}")
-    
-                    # Close the connection
-                    client_socket.close()
-    
-                except socket.timeout:
-                    print(f"Connection to {ip} timed out after 5 seconds.")
-                except Exception as e:
-                    print(f"Failed to send message to {ip}. Error: {e}")
-    
-            # Wait for 10 seconds before sending the next round of messages
-            time.sleep(10)
+                self.channels.send(ip, [advert])
+                #print(f"Sent latency advert {self.seq} with video list to {ip}")
 
+            # Wait before sending the next round of messages
+            await asyncio.sleep(self.interval)
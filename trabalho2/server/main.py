@@ -1,9 +1,106 @@
 from server import Server
+from adaptation import quality_levels
+from packet import MIN_MTU, max_payload_size
 import sys
 
+def pop_option(flag, default=None, numeric=False):
+    """Remove an optional "<flag> <value>" pair from sys.argv and return the value."""
+    if flag not in sys.argv:
+        return default
+    index = sys.argv.index(flag)
+    if index + 1 >= len(sys.argv) or (numeric and not sys.argv[index + 1].isdigit()):
+        print(f"Error: {flag} expects a {'number' if numeric else 'value'}.")
+        sys.exit(1)
+    value = sys.argv[index + 1]
+    del sys.argv[index:index + 2]
+    return int(value) if numeric else value
+
+def parse_rates(value):
+    """Parse "key=kbps,key=kbps" into a dict of rates in bytes per second."""
+    rates = {}
+    for item in filter(None, value.split(",")):
+        key, _, kbps = item.partition("=")
+        if not kbps.isdigit():
+            print(f"Error: invalid rate '{item}', expected <name>=<kbit/s>.")
+            sys.exit(1)
+        rates[key.strip()] = int(kbps) * 1000 / 8
+    return rates
+
+def parse_renditions(value):
+    """Parse "name=WIDTHxHEIGHTqQUALITY,..." into a dict of (width, height, quality); "native" keeps the size."""
+    renditions = {}
+    for item in filter(None, value.split(",")):
+        name, _, spec = item.partition("=")
+        size, _, quality = spec.partition("q")
+        width, _, height = size.partition("x")
+        if not name or "@" in name or not quality.isdigit() or not (
+            size == "native" or (width.isdigit() and height.isdigit())
+        ):
+            print(f"Error: invalid rendition '{item}', expected <name>=<WIDTH>x<HEIGHT>q<QUALITY> or <name>=nativeq<QUALITY>.")
+            sys.exit(1)
+        if size == "native":
+            renditions[name.strip()] = (None, None, int(quality))
+        else:
+            renditions[name.strip()] = (int(width), int(height), int(quality))
+    return renditions
+
 def main():
+    # Directory for the pre-encoded frame store (defaults to .framestore next to each video)
+    store_dir = pop_option("--store")
+    # Number of worker processes that produce frames (0 keeps everything in one process)
+    workers = pop_option("--workers", 0, numeric=True)
+    # Seconds a video may stay without clients before its streamer is suspended
+    idle_timeout = pop_option("--idle-timeout", 30, numeric=True)
+
+    # Changed-tile delta frames: tile size in pixels and frames between full keyframes
+    store_options = {}
+    tile_size = pop_option("--delta", numeric=True)
+    keyframe_interval = pop_option("--keyframe-interval", 30, numeric=True)
+    if tile_size:
+        store_options.update(tile_size=tile_size, keyframe_interval=keyframe_interval)
+
+    # Extra renditions clients can subscribe to as "<video>@<name>" ("low=320x240q60,hd=nativeq90")
+    renditions = parse_renditions(pop_option("--renditions", ""))
+    for name, (width, height, _) in renditions.items():
+        if tile_size and width and (width % tile_size or height % tile_size):
+            print(f"Error: --delta tile size {tile_size} must divide the size of rendition '{name}'.")
+            sys.exit(1)
+
+    # Data packets per XOR parity packet (0 disables forward error correction)
+    fec_group_size = pop_option("--fec", 0, numeric=True)
+    if fec_group_size > 255:
+        print("Error: --fec group size must be at most 255.")
+        sys.exit(1)
+
+    # Path MTU; stream packets are sized so they are never fragmented
+    mtu = pop_option("--mtu", 1500, numeric=True)
+    if not MIN_MTU <= mtu <= 65535:
+        print(f"Error: --mtu must be between {MIN_MTU} and 65535 bytes "
+              f"(packets carry {mtu - max_payload_size(mtu)} bytes of headers).")
+        sys.exit(1)
+
+    # Rate adaptation from receiver feedback, bounded by a minimum JPEG quality and frame width
+    adapt = "--adapt" in sys.argv
+    if adapt:
+        sys.argv.remove("--adapt")
+    min_quality = pop_option("--min-quality", 50, numeric=True)
+    min_width = pop_option("--min-width", 320, numeric=True)
+    levels = quality_levels(min_quality, min_width, tile_size) if adapt else None
+
+    # Sender pacing, optionally with rates in kbit/s per stream ("videoA=4000,videoA@low=800")
+    # and per destination IP ("10.0.3.10=8000")
+    pacing = "--pace" in sys.argv
+    if pacing:
+        sys.argv.remove("--pace")
+    video_rates = parse_rates(pop_option("--video-rate", ""))
+    destination_rates = parse_rates(pop_option("--dest-rate", ""))
+
+    # Load caps: once reached, our adverts tell the overlay to steer new subscriptions elsewhere
+    max_subscribers = pop_option("--max-subscribers", numeric=True)
+    max_egress = pop_option("--max-egress", numeric=True)  # kbit/s
+
     if "--ip" not in sys.argv or "--video" not in sys.argv or len(sys.argv) < 5:
-        print("Usage: python3 main.py --ip <BOOTSTRAPPER_IP_ADDRESS> --video <video_path1> [<video_path2> ... <video_pathN>]")
+        print("Usage: python3 main.py --ip <BOOTSTRAPPER_IP_ADDRESS> [--store <STORE_DIR>] [--workers <N>] [--idle-timeout <SECONDS>] [--delta <TILE_SIZE> [--keyframe-interval <N>]] [--renditions <NAME=WxHqQ,...>] [--fec <K>] [--mtu <BYTES>] [--pace] [--video-rate <VIDEO=KBPS,...>] [--dest-rate <IP=KBPS,...>] [--max-subscribers <N>] [--max-egress <KBPS>] [--adapt [--min-quality <Q>] [--min-width <PIXELS>]] --video <video_path1> [<video_path2> ... <video_pathN>]")
         sys.exit(1)
 
     ip_index = sys.argv.index("--ip")
@@ -21,7 +118,10 @@ def main():
         sys.exit(1)
 
     # Initialize the server with the video paths and start it
-    server = Server(video_paths=video_paths, bootstrapper_ip=ip_address, streaming_port=12346)
+    server = Server(video_paths=video_paths, bootstrapper_ip=ip_address, streaming_port=12346, store_dir=store_dir, workers=workers, idle_timeout=idle_timeout, store_options=store_options, fec_group_size=fec_group_size, mtu=mtu,
+                    pacing=pacing, video_rates=video_rates, destination_rates=destination_rates,
+                    quality_levels=levels, renditions=renditions, max_subscribers=max_subscribers,
+                    max_egress=max_egress * 1000 / 8 if max_egress else None)
     server.start()
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+import collections
+import struct
+from packet import FLAG_PARITY, HEADER
+
+# Hop-by-hop repair of lost stream packets. The origin and every overlay node keep the packets
+# they sent for a short while in a RetransmitBuffer. A receiver (overlay node or client) that
+# sees a gap in a frame sends a NACK to the hop the frame came from, which sends the missing
+# packets again to its stream port. An overlay node that lost the packets itself has seen the
+# same gap and asked its own upstream; the repair is then forwarded to its subscribers like
+# any other packet, so every loss is repaired by the nearest hop that still holds the packets.
+NACK_PORT = 13339
+NACK_VERSION = 1
+# version, video id, frame sequence number, number of packet indexes (none asks for the whole frame),
+# followed by the 2-byte indexes of the missing data packets
+NACK = struct.Struct('>BIIH')
+NACK_INDEX = struct.Struct('>H')
+
+RETRANSMIT_WINDOW = 1.0  # Seconds a sent packet is kept for repairs
+MAX_RETRANSMIT_PACKETS = 10000  # Packets kept at most, the oldest frames are dropped first
+
+
+def unpack_nack(data):
+    """Return (video_id, frame_seq, packet indexes), or None if malformed; no indexes means the whole frame."""
+    if len(data) < NACK.size or data[0] != NACK_VERSION:
+        return None
+    _, video_id, frame_seq, count = NACK.unpack_from(data)
+    if len(data) != NACK.size + count * NACK_INDEX.size:
+        return None
+    return video_id, frame_seq, struct.unpack_from(f'>{count}H', data, NACK.size)
+
+
+class RetransmitBuffer:
+    """Data packets sent in the last window seconds, by video, frame and packet index.
+
+    Only one thread adds packets; get() can be called from any other thread.
+    """
+
+    def __init__(self, window=RETRANSMIT_WINDOW, max_packets=MAX_RETRANSMIT_PACKETS):
+        self.window = window
+        self.max_packets = max_packets
+        self.frames = {}  # (video id, frame seq) -> {packet index: packet}
+        self.order = collections.deque()  # (time first seen, (video id, frame seq)), oldest first
+        self.packets = 0
+        self.repaired = 0  # Packets sent again
+        self.missed = 0  # Packets asked for that were no longer (or never) here
+
+    def add(self, packet, now):
+        """Keep a copy of a packet that was just sent (parity packets are not kept)."""
+        _, flags, video_id, frame_seq, _, packet_index = HEADER.unpack_from(packet)[:6]
+        if flags & FLAG_PARITY:
+            return
+        key = (video_id, frame_seq)
+        frame = self.frames.get(key)
+        if frame is None:
+            frame = self.frames[key] = {}
+            self.order.append((now, key))
+            while self.order and (now - self.order[0][0] > self.window or self.packets > self.max_packets):
+                self.packets -= len(self.frames.pop(self.order.popleft()[1], ()))
+        if packet_index not in frame:
+            frame[packet_index] = bytes(packet)
+            self.packets += 1
+
+    def get(self, video_id, frame_seq, indexes):
+        """The packets held for the indexes of a frame (every packet of it if indexes is empty)."""
+        frame = self.frames.get((video_id, frame_seq), {})
+        if not indexes:
+            packets = list(frame.values())
+            self.missed += not packets
+        else:
+            packets = [packet for packet in map(frame.get, indexes) if packet is not None]
+            self.missed += len(indexes) - len(packets)
+        self.repaired += len(packets)
+        return packets
@@ -0,0 +1,94 @@
+import threading
+import time
+
+# Fraction of the frame interval over which an automatically paced frame is spread,
+# leaving some slack so a frame is out before the next one arrives
+SPREAD = 0.8
+
+
+class TokenBucket:
+    """Token bucket in its virtual-scheduling form: tells when a packet may be sent."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate  # Bytes per second
+        self.burst = burst  # Bytes that may be sent back to back
+        self.tat = 0.0  # Theoretical arrival time of the next byte
+        self.lock = threading.Lock()  # Destination buckets are shared by every video's sender
+
+    def reserve(self, size, now):
+        """Reserve size bytes and return the earliest time (>= now) at which they may be sent."""
+        with self.lock:
+            start = max(now, self.tat - self.burst / self.rate)
+            self.tat = max(self.tat, start) + size / self.rate
+            return start
+
+
+class Pacer:
+    """Spread the packets of each frame over the frame interval instead of sending them in one burst.
+
+    Every destination of a video gets its own bucket, running at the configured video rate or,
+    by default, at the rate that sends one frame in SPREAD of the frame interval. Destinations
+    can additionally be capped by a shared bucket that applies across all videos.
+    """
+
+    def __init__(self, rate=None, destination_buckets=None, burst=1500):
+        self.rate = rate  # Bytes per second for each destination, None to follow the frame rate
+        self.destination_buckets = destination_buckets if destination_buckets is not None else {}
+        self.burst = burst
+        self.flows = {}  # Destination address -> TokenBucket
+        self.frame_interval = 1 / 30  # Smoothed time between frames
+        self.last_frame_time = None
+        self.queue_depth = 0  # Packets of the current frame still waiting to be sent
+        self.peak_queue_depth = 0
+        self.late_packets = 0  # Packets sent after the next frame was due
+
+    def send(self, sendto, packets, targets):
+        """Send every packet to every target, paced; returns once the frame is out."""
+        now = time.monotonic()
+        if self.last_frame_time is not None:
+            interval = min(max(now - self.last_frame_time, 1 / 120), 1 / 5)
+            self.frame_interval += 0.125 * (interval - self.frame_interval)
+        self.last_frame_time = now
+
+        rate = self.rate or sum(len(packet) for packet in packets) / (SPREAD * self.frame_interval)
+        if self.flows.keys() != set(targets):
+            self.flows = {target: self.flows.get(target) or TokenBucket(rate, self.burst) for target in targets}
+
+        # Work out when each packet may leave, then send them in that order
+        schedule = []
+        for target in targets:
+            flow = self.flows[target]
+            flow.rate = rate
+            destination = self.destination_buckets.get(target[0])
+            for packet in packets:
+                send_at = flow.reserve(len(packet), now)
+                if destination is not None:
+                    send_at = destination.reserve(len(packet), send_at)
+                schedule.append((send_at, target, packet))
+        schedule.sort(key=lambda entry: entry[0])
+
+        self.queue_depth = len(schedule)
+        self.peak_queue_depth = max(self.peak_queue_depth, self.queue_depth)
+        deadline = now + self.frame_interval
+        for send_at, target, packet in schedule:
+            delay = send_at - time.monotonic()
+            if delay > 0.001:  # Packets due within a millisecond go out together
+                time.sleep(delay)
+            try:
+                sendto(packet, target)
+            except OSError as e:
+                print(f"Failed to send packet to {target}. Error: {e}")
+            if send_at > deadline:
+                self.late_packets += 1
+            self.queue_depth -= 1
+
+    def report(self):
+        """Return the pacing statistics and reset the peak queue depth."""
+        stats = {
+            "queue_depth": self.queue_depth,
+            "peak_queue_depth": self.peak_queue_depth,
+            "late_packets": self.late_packets,
+            "frame_interval": self.frame_interval,
+        }
+        self.peak_queue_depth = self.queue_depth
+        return stats
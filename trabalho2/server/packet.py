@@ -0,0 +1,43 @@
+import struct
+import zlib
+
+# Stream wire format, version 2. Every datagram starts with this fixed-size header:
+#
+#   offset  size  field
+#        0     1  version (2)
+#        1     1  flags (FLAG_PARITY for FEC parity packets)
+#        2     4  video id (CRC-32 of the video name)
+#        6     4  frame sequence number
+#       10     8  capture timestamp (microseconds since the epoch)
+#       18     2  packet index (the FEC group index for parity packets)
+#       20     2  number of data packets in the frame
+#       22     1  FEC group size (0 when FEC is off)
+#       23     1  reserved
+#       24     2  payload size
+#       26     4  frame size
+#
+# Overlay nodes route on the video id alone, which sits at a fixed offset.
+STREAM_VERSION = 2
+HEADER = struct.Struct('>BBIIQHHBBHI')
+FLAG_PARITY = 0x01
+
+# Largest datagram that fits in a 1500-byte Ethernet MTU without IP fragmentation
+# (20-byte IPv4 header and 8-byte UDP header)
+DEFAULT_MTU = 1500
+IP_UDP_OVERHEAD = 28
+MIN_MTU = 576  # Every IPv4 host accepts datagrams this large, and it leaves room for a payload
+
+
+def video_id_for(video_name):
+    """Numeric id of a video, the same on every node without any coordination."""
+    return zlib.crc32(video_name.encode('utf-8'))
+
+
+def max_payload_size(mtu=DEFAULT_MTU):
+    return mtu - IP_UDP_OVERHEAD - HEADER.size
+
+
+def pack_header(flags, video_id, frame_seq, timestamp_us, packet_index, packet_count,
+                fec_group_size, payload_size, frame_size):
+    return HEADER.pack(STREAM_VERSION, flags, video_id, frame_seq & 0xFFFFFFFF, timestamp_us,
+                       packet_index, packet_count, fec_group_size, 0, payload_size, frame_size)
@@ -3,11 +3,23 @@ import threading
 import time
 import sys
 import os  # Added for extracting file names
+from advert import LATENCY_PORT, OriginLoad
+from control import CHANNEL_PORT, ControlPlane
+from expiry import ExpiryQueue
+from feedback import FEEDBACK_PORT, unpack_report
+from nack import NACK_PORT, unpack_nack
+from framestore import FrameStore
 from latency import LatencyHandler
+from packet import DEFAULT_MTU, video_id_for
+from pacer import Pacer, TokenBucket
+from probe import PROBE_PORT, Prober
 from stream import VideoStreamer
+from worker import FrameWorker
 
 class Server:
-    def __init__(self, video_paths, bootstrapper_ip, streaming_port=12346, control_port=13333,heartbeat_port=22222):
+    def __init__(self, video_paths, bootstrapper_ip, streaming_port=12346, control_port=13333,heartbeat_port=22222, store_dir=None, workers=0, idle_timeout=30, store_options=None, fec_group_size=0, mtu=DEFAULT_MTU,
+                 pacing=False, video_rates=None, destination_rates=None, quality_levels=None, renditions=None,
+                 max_subscribers=None, max_egress=None):
         # Use original video file names without extensions as the keys
         self.video_paths = {
             os.path.splitext(os.path.basename(path))[0]: path for path in video_paths
@@ -18,135 +30,331 @@ class Server:
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.server_socket.bind(("0.0.0.0", streaming_port))
 
-        self.client_heartbeat_map = {}  # Tracks last heartbeat timestamp for each client (global tracking)
+        self.client_heartbeats = ExpiryQueue(6)  # Heartbeat deadline of each client IP (6-second timeout)
 
 
-        # Initialize the VideoStreamer for each video
+        # VideoStreamers are created on the first START_STREAM for their video (see start_stream_for_client)
         self.video_streamers = {}
-        
-        for name, path in self.video_paths.items():
-            print(f"Initializing VideoStreamer for {name} with path: {path}")
-            self.video_streamers[name] = VideoStreamer(path, name, streaming_port)
+        self.preparing = set()  # Stream keys whose frame store is being built, off the lock
+        self.store_dir = store_dir
+        self.store_options = store_options or {}  # Encoding settings, e.g. tile_size for delta frames
+        # Extra renditions of every video, requested as "<video>@<rendition>": name -> (width, height, quality),
+        # with width and height None for the native size. Each one is a separate stream with its own subscribers
+        self.renditions = renditions or {}
+        self.fec_group_size = fec_group_size  # Data packets per FEC parity packet (0 disables FEC)
+        self.mtu = mtu  # Path MTU, stream packets are sized to fit it
+
+        # Sender pacing: optional rates in bytes/s per video and per destination IP
+        self.video_rates = video_rates or {}
+        self.pacing = pacing or bool(self.video_rates) or bool(destination_rates)
+        self.destination_buckets = {
+            ip: TokenBucket(rate, burst=DEFAULT_MTU) for ip, rate in (destination_rates or {}).items()  # One datagram of burst
+        }
+        self.idle_timeout = idle_timeout  # Seconds without clients before a streamer is suspended
+
+        # Rate adaptation: receiver reports select one of these (width, height, quality) levels
+        self.quality_levels = quality_levels
+        self.video_ids = {video_id_for(name): name for name in self.video_paths}  # Ids used in reports
+
+        # In multi-process mode each worker owns a shard of the videos and publishes their frames
+        # through shared memory; they are forked before any streaming thread exists
+        self.video_workers = {}  # Maps stream keys to the FrameWorker that produces them
+        if workers > 0:
+            names = sorted(self.video_paths)
+            for worker_id in range(min(workers, len(names))):
+                # All the renditions of a video live in the same worker so they share one transcode
+                shard = [
+                    (stream_key, self.video_paths[name], self.stream_options(stream_key))
+                    for name in names[worker_id::workers] for stream_key in self.stream_keys(name)
+                ]
+                worker = FrameWorker(
+                    worker_id, shard, self.video_streamers, store_dir, idle_timeout, quality_levels
+                )
+                for stream_key, _, _ in shard:
+                    self.video_workers[stream_key] = worker
+                worker.start()
 
         self.vizinhos = self.getNeighbours(bootstrapper_ip, retry_interval=5, max_retries=10)
         print(f"Neighbours are: {self.vizinhos}")
 
-        self.latencyHandler = LatencyHandler(13334, self.vizinhos, list(self.video_paths.keys()))
+        # Our adverts carry our load; at max_subscribers or max_egress (bytes/s) we advertise being
+        # saturated and the overlay stops steering new subscriptions to us
+        self.max_subscribers = max_subscribers
+        self.max_egress = max_egress
+        self.load_sample = (time.monotonic(), 0, 0)  # Time, bytes sent and deadline misses at the previous advert
+        self.latencyHandler = LatencyHandler(LATENCY_PORT, self.vizinhos, list(self.video_paths.keys()), load=self.load)
 
-        # Dictionary to map video names to sets of client addresses
-        self.stream_active_clients = {video_name: set() for video_name in self.video_paths}
+        # Maps stream keys (video or video@rendition) to the clients watching them, as client IP -> address,
+        # and each client IP to its stream keys, so a client is removed without scanning every stream
+        self.stream_active_clients = {video_name: {} for video_name in self.video_paths}
+        self.client_streams = {}
         self.lock = threading.Lock()
-
-        self.latencyHandler.start()
+        self.control_plane = ControlPlane("server-control")
 
     def start(self):
         print(f"Server listening on UDP port {self.streaming_port}")
-        threading.Thread(target=self.receive_control_data).start()
-        threading.Thread(target=self.receive_heartbeat_requests).start()
+        # Control, heartbeat and latency traffic share one event loop; the stream senders keep their threads
+        self.control_plane.add_tcp(self.control_port, self.handle_control_data)
+        self.control_plane.add_channel(CHANNEL_PORT, self.handle_control_batch)
+        self.control_plane.add_tcp(self.heartbeat_port, self.handle_heartbeat)
+        self.latencyHandler.start(self.control_plane)
+        self.control_plane.add_datagram(PROBE_PORT, Prober())  # Answer the RTT probes of our neighbours
+        self.control_plane.start()
         threading.Thread(target=self.check_client_heartbeats).start()
+        threading.Thread(target=self.suspend_idle_streamers).start()
+        if self.pacing:
+            threading.Thread(target=self.report_pacing).start()
+        if self.quality_levels:
+            threading.Thread(target=self.receive_feedback).start()
+        threading.Thread(target=self.receive_nacks).start()
+        threading.Thread(target=self.report_repairs).start()
     
-    def receive_control_data(self):
-        """Listen for control data via TCP."""
-        control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        control_socket.bind(("0.0.0.0", self.control_port))
-        control_socket.listen(5)
-        print(f"Server listening for control data on TCP port {self.control_port}...")
+    def handle_control_data(self, data, addr):
+        """Handle a START_STREAM/STOP_STREAM command received on the control port."""
+        command_parts = data.split()
+        if not command_parts:
+            return  # Empty or whitespace only, ignored like any unknown command
+        with self.lock:
+            if command_parts[0] == "START_STREAM" and len(command_parts) == 2:
+                video_name = command_parts[1]
+                if self.is_stream_key(video_name):
+                    self.stream_active_clients.setdefault(video_name, {})[addr[0]] = addr
+                    self.client_streams.setdefault(addr[0], set()).add(video_name)
+                    print(f"Received START_STREAM for {video_name} from {addr}. Added to active clients.")
+                    self.start_stream_for_client(addr, video_name)
+                else:
+                    print(f"Invalid video name received from {addr}.")
+
+            elif command_parts[0] == "STOP_STREAM" and len(command_parts) == 2:
+                video_name = command_parts[1]
+
+                if self.remove_active_client(addr[0], video_name):
+                    print(f"Received STOP_STREAM for {video_name} from {addr}. Removed from active clients.")
+                    self.stop_stream_for_client(addr, video_name)
+
+    def remove_active_client(self, client_ip, video_name):
+        """Drop a client IP from a stream's active clients; return whether it was watching it (caller holds lock)."""
+        if self.stream_active_clients.get(video_name, {}).pop(client_ip, None) is None:
+            return False
+        streams = self.client_streams[client_ip]
+        streams.discard(video_name)
+        if not streams:
+            del self.client_streams[client_ip]
+            self.client_heartbeats.discard(client_ip)  # Nothing left to time out
+        return True
+
+    def handle_control_batch(self, commands, addr):
+        """Handle a batch of commands received on a persistent control channel."""
+        for command in commands:
+            if command:
+                self.handle_control_data(command.decode(), addr)
+
+    def stream_keys(self, video_name):
+        """Every stream of a video: the default encoding and one per rendition."""
+        return [video_name] + [f"{video_name}@{rendition}" for rendition in self.renditions]
+
+    def is_stream_key(self, stream_key):
+        video_name, _, rendition = stream_key.partition("@")
+        return video_name in self.video_paths and (not rendition or rendition in self.renditions)
+
+    def stream_options(self, stream_key):
+        """FrameStore encoding settings of a stream."""
+        rendition = stream_key.partition("@")[2]
+        if not rendition:
+            return self.store_options
+        width, height, quality = self.renditions[rendition]
+        return dict(self.store_options, width=width, height=height, quality=quality)
+
+    def create_streamer(self, video_name):
+        """Build the VideoStreamer for a stream (video or video@rendition), transcoding its store if needed.
+
+        This can take as long as a full transcode of the video, so it is never called with the lock held.
+        """
+        base_name = video_name.partition("@")[0]
+        path = self.video_paths[base_name]
+        store_dir = self.store_dir or FrameStore.default_dir(path)
+        external_source = video_name in self.video_workers
+        if not external_source:
+            # Transcode every rendition of the video in a single decode pass, so that the
+            # streamer only has to open its store
+            FrameStore.prepare(path, store_dir, [self.stream_options(key) for key in self.stream_keys(base_name)])
+        print(f"Initializing VideoStreamer for {video_name} with path: {path}")
+        return VideoStreamer(
+            path, video_name, self.streaming_port, mtu=self.mtu, store_dir=store_dir,
+            external_source=external_source, store_options=self.stream_options(video_name),
+            fec_group_size=self.fec_group_size, pacer=self.create_pacer(video_name),
+            # Explicit renditions are fixed, rate adaptation only drives the default stream
+            quality_levels=self.quality_levels if video_name == base_name else None
+        )
+
+    def prepare_streamer(self, video_name):
+        """Create a stream's VideoStreamer in the background, then start it for the clients that asked for it."""
+        try:
+            streamer = self.create_streamer(video_name)
+        except Exception as e:
+            print(f"Failed to prepare {video_name}. Error: {e}")
+            streamer = None
+
+        with self.lock:
+            self.preparing.discard(video_name)
+            clients = list(self.stream_active_clients.get(video_name, {}).values())
+            if streamer is None:
+                for client in clients:
+                    self.remove_active_client(client[0], video_name)
+                return
+            self.video_streamers[video_name] = streamer
+            self.video_ids[video_id_for(video_name)] = video_name
+            for client in clients:
+                self.start_stream_for_client(client, video_name)
+
+    def load(self):
+        """Our load since the previous call, advertised to the overlay (see advert.py)."""
+        with self.lock:
+            streams = sum(1 for clients in self.stream_active_clients.values() if clients)
+            subscribers = sum(len(clients) for clients in self.stream_active_clients.values())
+        streamers = list(self.video_streamers.values())
+        now = time.monotonic()
+        bytes_sent = sum(streamer.bytes_sent for streamer in streamers)
+        deadline_misses = sum(streamer.deadline_misses for streamer in streamers)
+
+        then, last_bytes_sent, last_deadline_misses = self.load_sample
+        self.load_sample = (now, bytes_sent, deadline_misses)
+        egress = (bytes_sent - last_bytes_sent) / (now - then) if now > then else 0
+        saturated = ((self.max_subscribers is not None and subscribers >= self.max_subscribers)
+                     or (self.max_egress is not None and egress >= self.max_egress))
+        return OriginLoad(streams, subscribers, egress, deadline_misses - last_deadline_misses, saturated)
+
+    def receive_feedback(self):
+        """Adapt each video's quality level to the receiver reports aggregated by the overlay."""
+        feedback_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        feedback_socket.bind(("0.0.0.0", FEEDBACK_PORT))
+        print(f"Server listening for receiver reports on UDP port {FEEDBACK_PORT}...")
 
         while True:
-            client_socket, addr = control_socket.accept()
-            #print(f"Control connection established with {addr}")
+            try:
+                data, addr = feedback_socket.recvfrom(1024)
+                report = unpack_report(data)
+                if report is None:
+                    continue
+                video_name = self.video_ids.get(report[0])
+                streamer = self.video_streamers.get(video_name)
+                if streamer is None or streamer.rate_controller is None:
+                    continue
+
+                level = streamer.rate_controller.update(report)
+                if level is not None:
+                    if video_name in self.video_workers:
+                        self.video_workers[video_name].send_command(f"SET_LEVEL {video_name} {level}")
+                    else:
+                        streamer.set_quality_level(level)
+            except Exception as e:
+                print(f"Error while handling receiver report: {e}")
 
+    def receive_nacks(self):
+        """Resend the packets our clients NACK (see nack.py)."""
+        nack_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        nack_socket.bind(("0.0.0.0", NACK_PORT))
+        print(f"Server listening for NACKs on UDP port {NACK_PORT}...")
+
+        while True:
             try:
-                data = client_socket.recv(1024).decode()
-                if not data:
-                    client_socket.close()
+                data, addr = nack_socket.recvfrom(2048)
+                nack = unpack_nack(data)
+                if nack is None:
                     continue
-                with self.lock:
-                    command_parts = data.split()
-                    if command_parts[0] == "START_STREAM" and len(command_parts) == 2:
-                        video_name = command_parts[1]
-                        if video_name in self.video_streamers:
-                            self.stream_active_clients[video_name].add(addr)
-                            print(f"Received START_STREAM for {video_name} from {addr}. Added to active clients.")
-                            self.start_stream_for_client(addr, video_name)
-                        else:
-                            print(f"Invalid video name received from {addr}.")
-
-                    elif command_parts[0] == "STOP_STREAM" and len(command_parts) == 2:
-                        video_name = command_parts[1]
-                        
-                        matching_clients = [
-                            client for client in self.stream_active_clients[video_name]
-                            if client[0] == addr[0]
-                        ]
-                        if matching_clients:
-                            for client in matching_clients:
-                                self.stream_active_clients[video_name].remove(client)  # Remove matching entries
-                            print(f"Received STOP_STREAM for {video_name} from {addr}. Removed from active clients.")
-                            self.stop_stream_for_client(addr, video_name)
-                        
-                client_socket.close()
+                video_id, frame_seq, indexes = nack
+                streamer = self.video_streamers.get(self.video_ids.get(video_id))
+                if streamer is not None:
+                    streamer.repair(addr[0], frame_seq, indexes)
             except Exception as e:
-                print(f"Error while receiving control data from {addr}: {e}")
-                client_socket.close()
+                print(f"Error while handling NACK: {e}")
+
+    def report_repairs(self):
+        """Periodically print the packets resent after NACKs, per video."""
+        reported = {}
+        while True:
+            time.sleep(10)
+            for video_name, streamer in list(self.video_streamers.items()):
+                counts = (streamer.retransmit.repaired, streamer.retransmit.missed)
+                if counts != reported.get(video_name, (0, 0)):
+                    print(f"Repairs for {video_name}: {counts[0]} packets resent, {counts[1]} asked for but no longer held")
+                    reported[video_name] = counts
+
+    def create_pacer(self, video_name):
+        """Return the Pacer for a video's sender, or None when pacing is disabled."""
+        if not self.pacing:
+            return None
+        return Pacer(self.video_rates.get(video_name), self.destination_buckets)
+
+    def report_pacing(self):
+        """Periodically print the pacer queue depth of every active video."""
+        while True:
+            time.sleep(10)
+            for video_name, streamer in list(self.video_streamers.items()):
+                if streamer.pacer and streamer.clients:
+                    stats = streamer.pacer.report()
+                    print(f"Pacer for {video_name}: queue depth {stats['queue_depth']} "
+                          f"(peak {stats['peak_queue_depth']}), {stats['late_packets']} late packets, "
+                          f"frame interval {stats['frame_interval'] * 1000:.1f} ms")
+
+    def suspend_idle_streamers(self):
+        """Periodically suspend streamers that have had no clients for idle_timeout seconds."""
+        while True:
+            for streamer in list(self.video_streamers.values()):
+                try:
+                    streamer.suspend_if_idle(self.idle_timeout)
+                except Exception as e:
+                    print(f"Error while suspending {streamer.video_name}: {e}")
+            time.sleep(1)
 
     def start_stream_for_client(self, client_addr, video_name):
-        """Start streaming a specific video to the specified client."""
-        self.video_streamers[video_name].add_client(client_addr)
+        """Start streaming a specific video to the specified client (caller holds lock).
+
+        The first client of a stream only starts it once its streamer is prepared; the
+        clients registered meanwhile are attached then (see prepare_streamer).
+        """
+        streamer = self.video_streamers.get(video_name)
+        if streamer is None:
+            if video_name not in self.preparing:
+                self.preparing.add(video_name)
+                print(f"Preparing {video_name} for {client_addr}")
+                threading.Thread(target=self.prepare_streamer, args=(video_name,), daemon=True).start()
+            return
+        if video_name in self.video_workers and not streamer.clients:
+            # First client: tell the worker that owns this video to start publishing frames
+            self.video_workers[video_name].send_command(f"START_STREAM {video_name}")
+        streamer.add_client(client_addr)
         print(f"Streaming {video_name} started for client {client_addr}")
 
     def stop_stream_for_client(self, client_addr, video_name):
-        """Stop streaming a specific video to the specified client."""
-        self.video_streamers[video_name].remove_client(client_addr)
+        """Stop streaming a specific video to the specified client (caller holds lock)."""
+        streamer = self.video_streamers.get(video_name)
+        if streamer is None:
+            return  # Still being prepared, the client is no longer registered and will not be attached
+        streamer.remove_client(client_addr)
+        if video_name in self.video_workers and not streamer.clients:
+            self.video_workers[video_name].send_command(f"STOP_STREAM {video_name}")
         print(f"Streaming {video_name} stopped for client {client_addr}")
 
 
-    def receive_heartbeat_requests(self):
-        """Listen for heartbeat messages on a separate TCP port."""
-        heartbeat_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        heartbeat_socket.bind(("0.0.0.0", self.heartbeat_port))
-        heartbeat_socket.listen(5)
-        heartbeat_socket.settimeout(1)  # Set a timeout for the socket to prevent blocking indefinitely
-        print(f"Server listening for heartbeat messages on TCP port {self.heartbeat_port}...")
-
-        while True:
-            try:
-                client_socket, addr = heartbeat_socket.accept()
-                with client_socket:
-                    data = client_socket.recv(1024).decode()
-                    if data == "HEARTBEAT":
-                        with self.lock:
-                            self.client_heartbeat_map[addr[0]] = time.time()
-                            #print(f"Heartbeat received from client {addr[0]}.")
-            except socket.timeout:
-                # Timeout reached; loop back to handle timeouts or new connections
-                pass
-            except Exception as e:
-                print(f"Error while handling heartbeat requests: {e}")
+    def handle_heartbeat(self, data, addr):
+        """Record a heartbeat received on the heartbeat port (does not need the main lock)."""
+        if data == "HEARTBEAT":
+            self.client_heartbeats.touch(addr[0])
+            #print(f"Heartbeat received from client {addr[0]}.")
     
     def check_client_heartbeats(self):
-        """Periodically check client heartbeats and remove stale clients."""
+        """Periodically remove the clients whose heartbeats stopped and stop their streams."""
         while True:
             try:
-                current_time = time.time()
-                stale_clients = []
-
-                with self.lock:
-                    # Find stale clients (based only on IP)
-                    for client_ip, last_heartbeat in self.client_heartbeat_map.items():
-                        if current_time - last_heartbeat > 6:  # 6-second timeout
-                            stale_clients.append(client_ip)
-
-                    # Remove stale clients and stop their streams
-                    for client_ip in stale_clients:
-                        for video_name, clients in self.stream_active_clients.items():
-                            # Iterate over the tuples in `clients`
-                            for client in list(clients):  # Convert to list to allow removal during iteration
-                                if client[0] == client_ip:  # Compare only the IP portion
-                                    clients.remove(client)
-                                    self.stop_stream_for_client(client, video_name)
-                                    print(f"Client {client} removed from video {video_name} due to heartbeat timeout.")
-                        del self.client_heartbeat_map[client_ip]  # Remove from heartbeat map
+                # Only the expired IPs are visited, and only the streams they are watching
+                for client_ip in self.client_heartbeats.expired():
+                    with self.lock:
+                        for video_name in list(self.client_streams.get(client_ip, ())):
+                            client = self.stream_active_clients[video_name][client_ip]
+                            self.remove_active_client(client_ip, video_name)
+                            self.stop_stream_for_client(client, video_name)
+                            print(f"Client {client} removed from video {video_name} due to heartbeat timeout.")
 
                 time.sleep(1)  # Check every second
             except Exception as e:
@@ -1,126 +1,216 @@
-import cv2
 import socket
-import struct
 import threading
 import time
+from adaptation import QualitySwitcher, RateController
+from fec import protect
+from framestore import FrameStore
+from nack import RetransmitBuffer
+from packet import DEFAULT_MTU, max_payload_size, pack_header, video_id_for
 
 class VideoStreamer:
-    def __init__(self, video_path, video_name, port=12346, max_packet_size=60000):
+    def __init__(self, video_path, video_name, port=12346, mtu=DEFAULT_MTU, store_dir=None, external_source=False, store_options=None, fec_group_size=0, pacer=None, quality_levels=None):
         self.video_path = video_path
         self.video_name = video_name  # Video name used as an identifier
         self.port = port
-        self.max_packet_size = max_packet_size
-        self.clients = set()
+        self.payload_size = max_payload_size(mtu)  # Largest payload that avoids IP fragmentation
+        self.fec_group_size = fec_group_size  # Data packets per XOR parity packet (0 disables FEC)
+        self.pacer = pacer  # Spreads each frame over the frame interval (None sends it in one burst)
+        self.clients = {}  # Client IP -> address it subscribed from
+        self.targets = ()  # Destination addresses, rebuilt whenever the client set changes
         self.client_lock = threading.Lock()
+        # Load figures advertised by the origin (see Server.load), only updated by the sender thread
+        self.bytes_sent = 0
+        self.deadline_misses = 0  # Frames replaced by the next one before they could be sent
+        self.retransmit = RetransmitBuffer()  # Packets sent recently, resent when a client NACKs them (see nack.py)
+
+        # Numeric video identifier carried in every packet header (see packet.py)
+        self.video_id = video_id_for(str(video_name))
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         
-        # Initialize the video capture
-        self.cap = cv2.VideoCapture(video_path)
-        if not self.cap.isOpened():
-            raise ValueError(f"Error opening video file: {video_path}")
-
-        # Shared frame buffer to hold the latest frame
+        # Frames are transcoded once into an on-disk store and served from a memory mapping,
+        # unless a worker process publishes them for us (see worker.py).
+        # The store is only opened while the video has clients (see resume/suspend)
+        self.external_source = external_source
+        self.store_dir = store_dir if store_dir is not None else FrameStore.default_dir(video_path)
+        self.store_options = store_options or {}  # Extra encoding settings for FrameStore.open
+        self.frame_store = None
+        self.position = 0  # Next frame to play, kept across suspensions
+        self.active = threading.Event()  # Set while frames are being read
+        self.state_lock = threading.Lock()  # Serializes resume/suspend
+        self.idle_since = time.monotonic()  # When the last client left (None while there are clients)
+
+        # Rate adaptation: receiver feedback picks one of the quality levels (see adaptation.py);
+        # in multi-process mode the worker switches levels, here we only decide
+        self.rate_controller = None
+        self.quality = None
+        if quality_levels and len(quality_levels) > 1:
+            self.rate_controller = RateController(len(quality_levels))
+            if not external_source:
+                self.quality = QualitySwitcher(video_path, self.store_dir, quality_levels, self.store_options)
+
+        # Shared frame buffer to hold the latest frame and its sequence number
         self.current_frame = None
+        self.frame_seq = 0  # Incremented for every new frame, never reused
+        self.frame_time = 0  # Capture timestamp of the current frame, in microseconds
         self.frame_lock = threading.Lock()
-        
-        # Start the background frame reading thread
-        self.streaming_thread = threading.Thread(target=self.read_frames)
-        self.streaming_thread.daemon = True
-        self.streaming_thread.start()
+        self.frame_ready = threading.Condition(self.frame_lock)  # Notified when a new frame is stored
 
-    def read_frames(self):
-        """Continuously read frames from the video file, independent of client connections."""
-        fps = self.cap.get(cv2.CAP_PROP_FPS) or 30
-        frame_delay = 1.0 / fps  # Calculate delay to match video FPS
+        # One sender per video, shared by all clients
+        self.sender_thread = threading.Thread(target=self.fan_out)
+        self.sender_thread.daemon = True
+        self.sender_thread.start()
 
-        while True:
-            ret, frame = self.cap.read()
-            if not ret:
-                # Restart the video if it reaches the end
-                self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-                ret, frame = self.cap.read()
-                if not ret:
-                    print("Failed to read frame after resetting video. Stopping.")
-                    break
-
-            # Resize and compress the frame
-            frame = cv2.resize(frame, (640, 480))
-            _, img_encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
-            frame_data = img_encoded.tobytes()
-
-            # Store the frame in a shared buffer
-            with self.frame_lock:
-                self.current_frame = frame_data
-
-            # Delay to sync with video FPS
-            time.sleep(frame_delay)
+    def read_frames(self):
+        """Publish frames from the frame store until the streamer is suspended."""
+        self.position = self.frame_store.play(self.publish_store_frame, self.position, self.active)
+
+    def publish_store_frame(self, frame_data, index):
+        """Publish a frame from the store, taken from the selected quality level."""
+        if self.quality:
+            frame_data = self.quality.frame(index, frame_data)
+        self.publish_frame(frame_data)
+
+    def set_quality_level(self, level):
+        """Serve frames from another quality level, as soon as it has been prepared."""
+        if self.quality:
+            self.quality.select(level)
+
+    def resume(self):
+        """Open the frame store and start reading frames from the stored position."""
+        if self.external_source:
+            return
+        with self.state_lock:
+            if self.active.is_set():
+                return
+            if self.frame_store is None:
+                self.frame_store = FrameStore.open(self.video_path, self.store_dir, **self.store_options)
+            if self.quality:
+                self.quality.select(self.quality.selected)  # Reopen the level we were serving
+            self.active.set()
+
+            # Start the background frame reading thread
+            self.streaming_thread = threading.Thread(target=self.read_frames)
+            self.streaming_thread.daemon = True
+            self.streaming_thread.start()
+            print(f"VideoStreamer for {self.video_name} resumed at frame {self.position}.")
+
+    def suspend(self):
+        """Stop reading frames and close the frame store, remembering the current position.
+
+        Nothing is done if a client is registered: add_client registers before it resumes, so
+        a client that arrives while we suspend gets the streamer resumed right after.
+        """
+        with self.state_lock:
+            if not self.active.is_set() or self.clients:
+                return
+            self.active.clear()
+            self.streaming_thread.join()
+
+            with self.frame_ready:
+                self.current_frame = None  # Drop our reference into the mapping
+            self.frame_store.close()
+            self.frame_store = None
+            if self.quality:
+                self.quality.close()
+            print(f"VideoStreamer for {self.video_name} suspended at frame {self.position}.")
+
+    def suspend_if_idle(self, idle_timeout):
+        """Suspend the streamer if it has had no clients for idle_timeout seconds."""
+        idle_since = self.idle_since
+        if idle_since is not None and self.active.is_set() and time.monotonic() - idle_since > idle_timeout:
+            self.suspend()
+
+    def publish_frame(self, frame_data):
+        """Store a new frame in the shared buffer and wake up the sender."""
+        with self.frame_ready:
+            self.current_frame = frame_data
+            self.frame_seq += 1
+            self.frame_time = int(time.time() * 1_000_000)
+            self.frame_ready.notify_all()
 
     def add_client(self, client_addr):
-        """Add a client to the list of active clients and start sending frames to them."""
+        """Add a client to the fan-out table; the shared sender thread picks it up on the next frame."""
         with self.client_lock:
-            if client_addr not in self.clients:
-                self.clients.add(client_addr)
+            if client_addr[0] not in self.clients:
+                self.clients[client_addr[0]] = client_addr
+                self._rebuild_targets()
+                self.idle_since = None
                 print(f"Client {client_addr} added for streaming.")
-                threading.Thread(target=self.start_stream, args=(client_addr,), daemon=True).start()
+        self.resume()
 
     def remove_client(self, client_addr):
         """Remove a client from the list of active clients based on the IP address."""
         with self.client_lock:
-            ip_to_remove = client_addr[0]  # Extract the IP part
-            clients_to_remove = {client for client in self.clients if client[0] == ip_to_remove}  # Find matching clients
-
-            if clients_to_remove:
-                for client in clients_to_remove:
-                    self.clients.remove(client)
+            if self.clients.pop(client_addr[0], None) is not None:
+                self._rebuild_targets()
+                if not self.clients:
+                    self.idle_since = time.monotonic()
                 #print(f"Clients with IP {ip_to_remove} removed from streaming.")
 
+    def _rebuild_targets(self):
+        """Rebuild the immutable destination tuple used by the sender (caller holds client_lock)."""
+        # Every client receives the stream on port 12346, so one entry per IP
+        self.targets = tuple(sorted((client_ip, 12346) for client_ip in self.clients))
 
-    def start_stream(self, client_addr):
-        """Send the latest frame to a specific client continuously."""
+    def fan_out(self):
+        """Single sender for this video: packetize each frame once and send it to every client."""
+        sendto = self.server_socket.sendto
+        last_sent_seq = 0
         while True:
-            with self.client_lock:
-                # Check if the IP of the client is still in the list
-                active_ips = {client[0] for client in self.clients}  # Extract only the IPs
-                
-                if client_addr[0] not in active_ips:  # Compare the IP part
-                    #print(f"Stopping stream to {client_addr} as they are no longer in the client list.")
-                    break
-
-            with self.frame_lock:
+            # Sleep until read_frames stores a frame we have not sent yet
+            with self.frame_ready:
+                self.frame_ready.wait_for(lambda: self.frame_seq != last_sent_seq)
                 frame_data = self.current_frame
-
-            if frame_data:
-                self.send_frame_to_client(frame_data, client_addr)
-
-            time.sleep(1 / 30)  # Adjust this to match video FPS or client streaming needs
-
-
-    def send_frame_to_client(self, frame_data, client_addr):
-        """Send the frame to a specific client in chunks, targeting port 12346."""
+                frame_time = self.frame_time
+                if last_sent_seq:
+                    self.deadline_misses += self.frame_seq - last_sent_seq - 1
+                last_sent_seq = self.frame_seq
+
+            targets = self.targets  # Immutable snapshot, replaced on add/remove
+            if not targets or not frame_data:
+                continue
+
+            # The same packet buffers are reused for every client
+            packets = self.packetize(frame_data, last_sent_seq, frame_time)
+            now = time.monotonic()
+            for packet in packets:
+                self.retransmit.add(packet, now)
+            self.bytes_sent += sum(len(packet) for packet in packets) * len(targets)
+            if self.pacer:
+                self.pacer.send(sendto, packets, targets)
+                continue
+
+            for target_addr in targets:
+                try:
+                    for packet in packets:
+                        sendto(packet, target_addr)
+                except OSError as e:
+                    print(f"Failed to send frame to {target_addr}. Error: {e}")
+
+    def repair(self, client_ip, frame_seq, indexes):
+        """Send a client the packets of a frame it NACKed, if we still hold them."""
+        target_addr = (client_ip, 12346)
+        if target_addr not in self.targets:
+            return
+        for packet in self.retransmit.get(self.video_id, frame_seq, indexes):
+            self.server_socket.sendto(packet, target_addr)
+
+    def packetize(self, frame_data, frame_seq, frame_time):
+        """Split a frame into MTU-sized packets with a v2 header, ready to be sent to any client.
+
+        With FEC enabled, one XOR parity packet per fec_group_size data packets is appended.
+        """
         frame_size = len(frame_data)
-        packet_id = 0
-        offset = 0
-    
-        # Ensure video_name is a string and encode it
-        if not isinstance(self.video_name, str):
-            self.video_name = str(self.video_name)
-    
-        # Encode the video name as a fixed-size identifier (e.g., 16 bytes, padded with spaces if needed)
-        video_id = self.video_name.encode('utf-8')[:16].ljust(16)
-        # Override the port in client_addr with 12346
-        target_addr = (client_addr[0], 12346)
-    
-        while offset < frame_size:
-            chunk = frame_data[offset:offset + self.max_packet_size - 24]  # Adjust for 16-byte video ID and 8-byte header
-            chunk_size = len(chunk)
-            offset += chunk_size
-    
-            # Pack the video ID, packet ID, and frame size into the header
-            packet_header = struct.pack('>16sHI', video_id, packet_id, frame_size)
-            self.server_socket.sendto(packet_header + chunk, target_addr)
-    
-            packet_id += 1
-
+        chunk_size = self.payload_size
+        view = memoryview(frame_data)
+        chunks = [view[offset:offset + chunk_size] for offset in range(0, frame_size, chunk_size)]
+
+        packets = []
+        for flags, packet_index, chunk in protect(chunks, self.fec_group_size):
+            packet_header = pack_header(flags, self.video_id, frame_seq, frame_time, packet_index, len(chunks),
+                                        self.fec_group_size, len(chunk), frame_size)
+            packets.append(packet_header + chunk)
+        return packets
 
     def stop_stream(self, client_addr):
         """Stop streaming to the specified client."""
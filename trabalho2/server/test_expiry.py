@@ -0,0 +1,38 @@
+import unittest
+from expiry import ExpiryQueue
+
+
+class ExpiryQueueTest(unittest.TestCase):
+    def test_expires_after_timeout(self):
+        queue = ExpiryQueue(5)
+        queue.touch("10.0.0.1", now=0)
+        self.assertEqual(queue.expired(now=4), [])
+        self.assertEqual(queue.expired(now=5), ["10.0.0.1"])
+        self.assertEqual(queue.expired(now=6), [])  # Reported once
+
+    def test_refresh_postpones_expiry(self):
+        queue = ExpiryQueue(5)
+        queue.touch("10.0.0.1", now=0)
+        queue.touch("10.0.0.1", now=3)
+        self.assertEqual(queue.expired(now=6), [])  # The first deadline is stale
+        self.assertEqual(queue.expired(now=8), ["10.0.0.1"])
+
+    def test_expires_in_deadline_order(self):
+        queue = ExpiryQueue(5)
+        queue.touch("10.0.0.2", now=2)
+        queue.touch("10.0.0.1", now=1)
+        queue.touch("10.0.0.3", now=10)
+        self.assertEqual(queue.expired(now=7), ["10.0.0.1", "10.0.0.2"])
+
+    def test_discarded_key_never_expires(self):
+        queue = ExpiryQueue(5)
+        queue.touch("10.0.0.1", now=0)
+        queue.discard("10.0.0.1")
+        queue.discard("10.0.0.2")  # Unknown keys are ignored
+        self.assertEqual(queue.expired(now=100), [])
+        queue.touch("10.0.0.1", now=100)
+        self.assertEqual(queue.expired(now=105), ["10.0.0.1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
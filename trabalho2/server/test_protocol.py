@@ -0,0 +1,78 @@
+import importlib.util
+import os
+import unittest
+
+# Every component keeps its own copy of the protocol modules, trimmed to what it uses. These
+# tests load the other components' copies next to ours and check that they still agree on
+# the wire format. Every copy is loaded from its file, so the tests do not depend on which
+# component's directory comes first on sys.path; a copy that imports packet gets whichever
+# packet is already loaded, they all have the same HEADER (see PacketTest).
+COMPONENTS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load(component, module):
+    spec = importlib.util.spec_from_file_location(f"{component}_{module}", os.path.join(COMPONENTS, component, f"{module}.py"))
+    loaded = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(loaded)
+    return loaded
+
+
+advert = load("server", "advert")
+feedback = load("server", "feedback")
+nack = load("server", "nack")
+packet = load("server", "packet")
+
+
+class PacketTest(unittest.TestCase):
+    def test_every_copy_has_the_same_header(self):
+        for component in ("overlayNode", "PoP", "cliente"):
+            copy = load(component, "packet")
+            self.assertEqual(copy.HEADER.format, packet.HEADER.format, component)
+            self.assertEqual((copy.STREAM_VERSION, copy.FLAG_PARITY), (packet.STREAM_VERSION, packet.FLAG_PARITY))
+
+    def test_video_ids_match(self):
+        for component in ("overlayNode", "PoP"):
+            self.assertEqual(load(component, "packet").video_id_for("videoA"), packet.video_id_for("videoA"))
+
+
+class AdvertTest(unittest.TestCase):
+    def test_nodes_read_our_adverts(self):
+        load_figures = advert.OriginLoad(2, 5, 1000, 1, True)
+        data = advert.pack_advert(7, 3, 0.0, ["videoA", "videoB"], load=load_figures)
+        for component in ("overlayNode", "PoP"):
+            copy = load(component, "advert")
+            self.assertEqual(copy.LATENCY_PORT, advert.LATENCY_PORT)
+            origin_id, seq, hops, cost, videos, origin_load = copy.unpack_advert(data)
+            self.assertEqual((origin_id, seq, hops, cost, videos), (7, 3, 0, 0.0, "videoA,videoB"))
+            self.assertEqual(tuple(origin_load), tuple(load_figures))
+
+    def test_the_pop_reads_forwarded_adverts(self):
+        data = load("overlayNode", "advert").forwarded(advert.pack_advert(7, 3, 0.0, ["videoA"]), 12.5)
+        self.assertEqual(load("PoP", "advert").unpack_advert(data)[:5], (7, 3, 1, 12.5, "videoA"))
+
+
+class FeedbackTest(unittest.TestCase):
+    def test_reports_reach_the_origin(self):
+        client = load("cliente", "feedback")
+        node = load("overlayNode", "feedback")
+        report = (42, 100, 2, 1, 3.5, 0.25, 1)
+        self.assertEqual(feedback.unpack_report(client.pack_report(*report)), report)
+
+        aggregator = node.FeedbackAggregator()
+        aggregator.add(report)
+        aggregator.add((42, 50, 0, 0, 1.0, 0.0, 1))
+        self.assertEqual(feedback.unpack_report(aggregator.drain()[42]), (42, 150, 2, 1, 3.5, 0.25, 2))
+        self.assertEqual({client.FEEDBACK_PORT, node.FEEDBACK_PORT}, {feedback.FEEDBACK_PORT})
+
+
+class NackTest(unittest.TestCase):
+    def test_we_read_the_nacks_of_every_receiver(self):
+        for component in ("overlayNode", "PoP", "cliente"):
+            copy = load(component, "nack")
+            self.assertEqual(copy.NACK_PORT, nack.NACK_PORT)
+            self.assertEqual(nack.unpack_nack(copy.pack_nack(42, 7, [1, 3])), (42, 7, (1, 3)), component)
+            self.assertEqual(nack.unpack_nack(copy.pack_nack(42, 7)), (42, 7, ()), component)
+
+
+if __name__ == "__main__":
+    unittest.main()
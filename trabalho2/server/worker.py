@@ -0,0 +1,242 @@
+import multiprocessing
+import struct
+import sys
+import threading
+from multiprocessing import resource_tracker, shared_memory
+from adaptation import QualitySwitcher
+from framestore import FrameStore
+
+# Messages from a worker to the server, sent with send_bytes (never pickled)
+MSG_READY = 0  # Followed by the video index and the UTF-8 name of the shared memory segment
+MSG_FRAME = 1  # A new frame was written to the video's segment
+READY_HEADER = struct.Struct('>BH')  # message type, video index
+FRAME_NOTICE = struct.Struct('>BHQ')  # message type, video index, frame sequence number
+
+# Each segment holds two frame slots so the server can copy one while the next is written.
+# A slot is a seqlock: its version is odd while the worker writes it
+SLOT_HEADER = struct.Struct('>QQI')  # version, frame sequence number, frame size
+READ_ATTEMPTS = 3
+
+
+class FrameSlots:
+    """Double-buffered frame slots of one video in a shared memory segment.
+
+    A frame larger than the capacity does not fit; the worker then moves the video to
+    larger slots (see fits) and announces the new segment before the frame.
+    """
+
+    def __init__(self, shm, capacity):
+        self.shm = shm
+        self.capacity = capacity
+        self.slot_size = SLOT_HEADER.size + capacity
+
+    @classmethod
+    def create(cls, capacity):
+        shm = shared_memory.SharedMemory(create=True, size=2 * (SLOT_HEADER.size + capacity))
+        return cls(shm, capacity)
+
+    @classmethod
+    def attach(cls, name):
+        """Map a segment the worker created; only the worker unlinks it, so we do not track it.
+
+        Before Python 3.13 attaching always registers the segment with the resource tracker.
+        The worker shares ours (see FrameWorker.start), so that only repeats the worker's own
+        registration, which goes away when the worker unlinks the segment.
+        """
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, shm.size // 2 - SLOT_HEADER.size)
+
+    def fits(self, frame_data):
+        return len(frame_data) <= self.capacity
+
+    def write(self, seq, frame_data):
+        """Copy a frame into the slot for this sequence number (worker side; the frame must fit)."""
+        offset = (seq % 2) * self.slot_size
+        size = len(frame_data)
+        version = SLOT_HEADER.unpack_from(self.shm.buf, offset)[0]
+        SLOT_HEADER.pack_into(self.shm.buf, offset, version + 1, seq, size)  # Odd: being written
+        self.shm.buf[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + size] = frame_data
+        SLOT_HEADER.pack_into(self.shm.buf, offset, version + 2, seq, size)
+
+    def read(self, seq):
+        """Copy the frame with this sequence number out of shared memory, or None if it was overwritten."""
+        offset = (seq % 2) * self.slot_size
+        for _ in range(READ_ATTEMPTS):
+            version, slot_seq, size = SLOT_HEADER.unpack_from(self.shm.buf, offset)
+            if version % 2:
+                continue  # The worker is writing the slot
+            if slot_seq != seq or size > self.capacity:
+                return None
+            frame_data = bytes(self.shm.buf[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + size])
+            # The worker may have started writing the slot again while we were copying
+            if SLOT_HEADER.unpack_from(self.shm.buf, offset)[0] == version:
+                return frame_data
+        return None
+
+    def close(self):
+        self.shm.close()
+
+
+def run_worker(connection, streams, store_dir, idle_timeout, quality_levels):
+    """Entry point of a worker process: play its shard of streams into shared memory.
+
+    Each stream is a (stream key, video path, FrameStore encoding settings) triple; the
+    renditions of a video are separate streams of the same path.
+    """
+    send_lock = threading.Lock()
+    indexes = {name: index for index, (name, _, _) in enumerate(streams)}
+    active = {name: threading.Event() for name in indexes}
+    slots = [None] * len(streams)
+    ingest_lock = threading.Lock()  # One transcode at a time, the renditions of a video share it
+    encodings = {}  # Video path -> encoding settings of all its streams
+    for _, path, store_options in streams:
+        encodings.setdefault(path, []).append(store_options)
+    switchers = {}
+    if quality_levels and len(quality_levels) > 1:
+        # Rate adaptation only drives the default stream of each video, not its renditions
+        switchers = {
+            name: QualitySwitcher(path, store_dir or FrameStore.default_dir(path), quality_levels, store_options)
+            for name, path, store_options in streams if "@" not in name
+        }
+
+    def announce_slots(index, capacity):
+        """Give a stream new frame slots and tell the server to use them from the next frame on."""
+        old_slots, slots[index] = slots[index], FrameSlots.create(capacity)
+        with send_lock:
+            connection.send_bytes(READY_HEADER.pack(MSG_READY, index) + slots[index].shm.name.encode())
+        if old_slots is not None:
+            # The server keeps its own mapping of the old segment until it attaches the new one
+            old_slots.close()
+            old_slots.shm.unlink()
+
+    def publisher(index, name, path, store_options):
+        # The store is opened on the first START_STREAM and closed again after idle_timeout
+        # seconds without clients; playback resumes from the same position
+        store = None
+        position = 0
+        seq = 0
+        quality = switchers.get(name)
+
+        def publish(frame_data, frame_index):
+            nonlocal seq
+            seq += 1
+            if quality:
+                frame_data = quality.frame(frame_index, frame_data)
+            if not slots[index].fits(frame_data):
+                # A frame of another quality level can be larger than any of the base store
+                announce_slots(index, max(len(frame_data), 2 * slots[index].capacity))
+            slots[index].write(seq, frame_data)
+            with send_lock:
+                connection.send_bytes(FRAME_NOTICE.pack(MSG_FRAME, index, seq))
+
+        while True:
+            if not active[name].wait(idle_timeout):
+                if store is not None:
+                    store.close()
+                    store = None
+                    if quality:
+                        quality.close()
+                    print(f"Worker suspended {name} at frame {position}.")
+                continue
+
+            if store is None:
+                video_store_dir = store_dir or FrameStore.default_dir(path)
+                if len(encodings[path]) > 1:
+                    # Transcode every rendition of the video in a single decode pass
+                    with ingest_lock:
+                        FrameStore.prepare(path, video_store_dir, encodings[path])
+                store = FrameStore.open(path, video_store_dir, **store_options)
+                if quality:
+                    quality.select(quality.selected)
+                if slots[index] is None:
+                    announce_slots(index, store.max_frame_size)
+            position = store.play(publish, position, active[name])
+
+    # Control commands routed by the server: "START_STREAM <stream>", "STOP_STREAM <stream>"
+    # and "SET_LEVEL <video> <level>", where a stream is a video or video@rendition
+    publishers = {}
+    try:
+        while True:
+            command_parts = connection.recv_bytes().decode().split()
+            if len(command_parts) < 2 or command_parts[1] not in active:
+                continue
+            command, name = command_parts[:2]
+            if command == "SET_LEVEL" and len(command_parts) == 3:
+                if name in switchers:
+                    switchers[name].select(int(command_parts[2]))
+                continue
+            if command == "START_STREAM":
+                if name not in publishers:
+                    index = indexes[name]
+                    publishers[name] = threading.Thread(
+                        target=publisher, args=(index, name) + streams[index][1:], daemon=True
+                    )
+                    publishers[name].start()
+                active[name].set()
+            elif command == "STOP_STREAM":
+                active[name].clear()
+    except (EOFError, OSError):
+        pass  # The server went away
+    finally:
+        for frame_slots in slots:
+            if frame_slots is not None:
+                frame_slots.close()
+                frame_slots.shm.unlink()
+
+
+class FrameWorker:
+    """Server-side handle of a worker process that owns a subset of the videos."""
+
+    def __init__(self, worker_id, streams, video_streamers, store_dir=None, idle_timeout=30, quality_levels=None):
+        self.worker_id = worker_id
+        self.video_names = [name for name, _, _ in streams]  # Stream keys, in the worker's index order
+        self.video_streamers = video_streamers
+        self.slots = [None] * len(streams)
+        self.send_lock = threading.Lock()
+
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=run_worker,
+            args=(child_connection, streams, store_dir, idle_timeout, quality_levels),
+            daemon=True
+        )
+
+    def start(self):
+        # Started before the worker so it inherits our resource tracker. Otherwise each would
+        # run its own, and ours would unlink the segments we attached when the server exits
+        resource_tracker.ensure_running()
+        self.process.start()
+        threading.Thread(target=self.receive_frames, daemon=True).start()
+        print(f"Worker {self.worker_id} (pid {self.process.pid}) serving videos: {self.video_names}")
+
+    def send_command(self, command):
+        """Route a START_STREAM/STOP_STREAM/SET_LEVEL command to the worker process."""
+        with self.send_lock:
+            self.connection.send_bytes(command.encode())
+
+    def receive_frames(self):
+        """Copy every frame the worker announces into the matching VideoStreamer."""
+        while True:
+            try:
+                message = self.connection.recv_bytes()
+            except (EOFError, OSError):
+                print(f"Worker {self.worker_id} exited.")
+                return
+
+            if message[0] == MSG_FRAME:
+                _, index, seq = FRAME_NOTICE.unpack(message)
+                frame_slots = self.slots[index]
+                frame_data = frame_slots.read(seq) if frame_slots else None
+                if frame_data:
+                    self.video_streamers[self.video_names[index]].publish_frame(frame_data)
+            elif message[0] == MSG_READY:
+                _, index = READY_HEADER.unpack_from(message)
+                if self.slots[index] is not None:
+                    self.slots[index].close()  # The worker moved the stream to larger slots
+                try:
+                    self.slots[index] = FrameSlots.attach(message[READY_HEADER.size:].decode())
+                except FileNotFoundError:
+                    self.slots[index] = None  # Already replaced by larger slots, announced next